@@ -0,0 +1,145 @@
+"""Rendered artifacts served over plain HTTP, with validators and precompression.
+
+An artifact is the rendered output of a gist revision, identified by a
+strong ETag. Each one is compressed once when it is stored, with gzip and,
+if the optional brotli package is installed, brotli; requests then get the
+best stored variant their Accept-Encoding allows. The store is an LRU
+bounded by the total size of all variants.
+"""
+
+import gzip
+import threading
+from collections import OrderedDict
+from dataclasses import dataclass, field
+from typing import Dict, Optional, Tuple
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+# Preferred first
+ENCODINGS = ["br", "gzip"]
+
+
+@dataclass
+class Artifact:
+    etag: str
+    media_type: str
+    # Content-Encoding ("identity" for the plain body) to bytes
+    variants: Dict[str, bytes] = field(default_factory=dict)
+    # Bytes the SVG optimizer took off the plain body
+    bytes_saved: int = 0
+    # What the artifact was rendered from, e.g. a gist id, for invalidation
+    group: str = ""
+
+    @property
+    def size(self) -> int:
+        return sum(len(body) for body in self.variants.values())
+
+
+def warn_missing_packages():
+    if brotli is None:
+        print(
+            "brotli is not installed, artifacts are compressed with gzip only "
+            "(install the assets extra)"
+        )
+
+
+def make_artifact(etag: str, media_type: str, body: bytes) -> Artifact:
+    """Build an artifact with its compressed variants. CPU bound, keep off the loop"""
+    variants = {"identity": body, "gzip": gzip.compress(body, compresslevel=9, mtime=0)}
+    if brotli is not None:
+        variants["br"] = brotli.compress(body, quality=11)
+    # A variant that does not save anything is not worth sending
+    for encoding in ENCODINGS:
+        if encoding in variants and len(variants[encoding]) >= len(body):
+            del variants[encoding]
+    return Artifact(etag, media_type, variants)
+
+
+def negotiate(accept_encoding: str, artifact: Artifact) -> Tuple[str, bytes]:
+    """Pick the best stored variant allowed by an Accept-Encoding header"""
+    accepted: Dict[str, float] = {}
+    for part in accept_encoding.split(","):
+        name, _, params = part.strip().partition(";")
+        quality = 1.0
+        params = params.strip()
+        if params.startswith("q="):
+            try:
+                quality = float(params[2:])
+            except ValueError:
+                quality = 0.0
+        if name:
+            accepted[name.strip().lower()] = quality
+    for encoding in ENCODINGS:
+        quality = accepted.get(encoding, accepted.get("*", 0.0))
+        if quality > 0 and encoding in artifact.variants:
+            return encoding, artifact.variants[encoding]
+    return "identity", artifact.variants["identity"]
+
+
+def etag_matches(if_none_match: str, etag: str) -> bool:
+    if if_none_match.strip() == "*":
+        return True
+    # Weak comparison, as RFC 9110 asks for If-None-Match
+    tags = [tag.strip() for tag in if_none_match.split(",")]
+    return any(tag.removeprefix("W/") == etag for tag in tags)
+
+
+class ArtifactStore:
+    def __init__(self, max_bytes: int = 64 * 1024 * 1024):
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self._bytes = 0
+        self._entries: "OrderedDict[str, Artifact]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __contains__(self, etag: str) -> bool:
+        with self._lock:
+            return etag in self._entries
+
+    def get(self, etag: str) -> Optional[Artifact]:
+        with self._lock:
+            artifact = self._entries.get(etag)
+            if artifact is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(etag)
+            self.hits += 1
+            return artifact
+
+    def put(self, artifact: Artifact):
+        with self._lock:
+            previous = self._entries.pop(artifact.etag, None)
+            if previous is not None:
+                self._bytes -= previous.size
+            if artifact.size > self.max_bytes:
+                return
+            self._entries[artifact.etag] = artifact
+            self._bytes += artifact.size
+            while self._bytes > self.max_bytes:
+                _, evicted = self._entries.popitem(last=False)
+                self._bytes -= evicted.size
+
+    def invalidate(self, group: str):
+        """Drop every artifact of a group"""
+        with self._lock:
+            stale = [
+                etag
+                for etag, artifact in self._entries.items()
+                if artifact.group == group
+            ]
+            for etag in stale:
+                self._bytes -= self._entries.pop(etag).size
+
+    def stats(self) -> dict:
+        return {
+            "entries": len(self._entries),
+            "bytes": self._bytes,
+            "max_bytes": self.max_bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+            "brotli": brotli is not None,
+        }
@@ -0,0 +1,149 @@
+"""Fingerprinted, precompressed static assets.
+
+At startup every script and stylesheet under static/ is minified, named
+after a hash of its content (main.js becomes main.1a2b3c4d5e.js) and
+compressed once, like the rendered artifacts. Templates link them with the
+asset() Jinja helper, and /assets/{name} serves them as immutable for a
+year with the best variant Accept-Encoding allows. Until the build is done,
+or if it is turned off, asset() points at the plain /static/ files.
+
+Scripts are minified by the optional rjsmin package and left as they are
+without it. Stylesheets use the optional rcssmin package, else a
+conservative pass over comments and whitespace. Relative ES module imports
+are rewritten to the hashed names, so a module's hash covers its imports.
+"""
+
+import hashlib
+import os
+import re
+from typing import Dict, List, Optional
+
+from app.artifacts import Artifact, make_artifact
+
+try:
+    import rjsmin
+except ImportError:
+    rjsmin = None
+
+try:
+    import rcssmin
+except ImportError:
+    rcssmin = None
+
+MEDIA_TYPES = {
+    ".js": "text/javascript; charset=utf-8",
+    ".css": "text/css; charset=utf-8",
+}
+# import ... from "./x.js", import "./x.js" and import("./x.js")
+IMPORT = re.compile(r"""(\bfrom\s*|\bimport\s*\(?\s*)(["'])\./([\w.-]+\.js)\2""")
+CSS_COMMENT = re.compile(r"/\*.*?\*/", re.DOTALL)
+CSS_SPACE = re.compile(r"\s*([{};])\s*")
+
+
+def minify_js(text: str) -> str:
+    return rjsmin.jsmin(text) if rjsmin is not None else text
+
+
+def minify_css(text: str) -> str:
+    if rcssmin is not None:
+        return rcssmin.cssmin(text)
+    lines = (line.strip() for line in CSS_COMMENT.sub("", text).splitlines())
+    return CSS_SPACE.sub(r"\1", " ".join(line for line in lines if line))
+
+
+class AssetManifest:
+    def __init__(self, directory: str, prefix: str = "/assets"):
+        self.directory = directory
+        self.prefix = prefix
+        self.bytes_in = 0
+        self.bytes_out = 0
+        # Changes whenever any asset does, for caches of pages that link them
+        self.version = ""
+        # Source name to hashed name, and hashed name to its variants
+        self._names: Dict[str, str] = {}
+        self._files: Dict[str, Artifact] = {}
+
+    def url(self, name: str) -> str:
+        """URL of a static file, fingerprinted once the build is done"""
+        hashed = self._names.get(name)
+        if hashed is None:
+            return f"/static/{name}"
+        return f"{self.prefix}/{hashed}"
+
+    def get(self, hashed: str) -> Optional[Artifact]:
+        return self._files.get(hashed)
+
+    def build(self):
+        """Minify, fingerprint and compress every asset. CPU bound, keep off the loop"""
+        missing = [
+            package
+            for package, module in (("rjsmin", rjsmin), ("rcssmin", rcssmin))
+            if module is None
+        ]
+        if missing:
+            print(
+                f"{' and '.join(missing)} not installed, assets are minified less "
+                "(install the assets extra)"
+            )
+        sources = sorted(
+            entry.name
+            for entry in os.scandir(self.directory)
+            if entry.is_file() and os.path.splitext(entry.name)[1] in MEDIA_TYPES
+        )
+        names: Dict[str, str] = {}
+        files: Dict[str, Artifact] = {}
+        for name in sources:
+            self._build(name, set(sources), names, files, [])
+        # Swapped in whole, so pages never link a half-built manifest
+        self._files, self._names = files, names
+        self.version = hashlib.sha256(
+            "".join(sorted(names.values())).encode("utf-8")
+        ).hexdigest()[:10]
+
+    def _build(
+        self,
+        name: str,
+        sources: set,
+        names: Dict[str, str],
+        files: Dict[str, Artifact],
+        stack: List[str],
+    ) -> str:
+        if name in names:
+            return names[name]
+        with open(os.path.join(self.directory, name), encoding="utf-8") as f:
+            text = f.read()
+        self.bytes_in += len(text.encode("utf-8"))
+        extension = os.path.splitext(name)[1]
+        if extension == ".js":
+
+            def rewrite(match: re.Match) -> str:
+                keyword, quote, imported = match.groups()
+                if imported not in sources:
+                    return match.group()
+                if imported in stack or imported == name:
+                    # Import cycles keep the plain file
+                    return f"{keyword}{quote}/static/{imported}{quote}"
+                hashed = self._build(imported, sources, names, files, stack + [name])
+                return f"{keyword}{quote}./{hashed}{quote}"
+
+            text = minify_js(IMPORT.sub(rewrite, text))
+        else:
+            text = minify_css(text)
+
+        body = text.encode("utf-8")
+        digest = hashlib.sha256(body).hexdigest()[:10]
+        hashed = f"{os.path.splitext(name)[0]}.{digest}{extension}"
+        files[hashed] = make_artifact(f'"{digest}"', MEDIA_TYPES[extension], body)
+        names[name] = hashed
+        self.bytes_out += len(body)
+        return hashed
+
+    def stats(self) -> dict:
+        return {
+            "files": len(self._files),
+            "bytes_in": self.bytes_in,
+            "bytes_out": self.bytes_out,
+            "variant_bytes": sum(artifact.size for artifact in self._files.values()),
+            "rjsmin": rjsmin is not None,
+            "rcssmin": rcssmin is not None,
+        }
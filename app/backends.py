@@ -0,0 +1,601 @@
+"""Compile backends used by mpost().
+
+SubprocessBackend spawns `mpost` for every job. MplibBackend keeps a few
+long-lived LuaTeX processes around and runs each job in a fresh mplib
+instance inside one of them, which saves process startup and format loading.
+Both read the source from `<workspace>/<id>.mp` and return the terminal
+output and the SVG of every shipped figure, the last one also on its own.
+With outputformat="png" they return a PNG rendering of the last figure at
+the requested resolution instead.
+
+Every job runs under Limits: a wall-clock timeout, rlimits on CPU time,
+address space, written file size and process count, and caps on how much
+SVG and log output is read back into memory.
+
+Results also carry how long the phases of the job took and, when the job
+ran with tracingstats, the memory and capacity statistics MetaPost writes
+to the end of its log.
+"""
+
+import glob
+import os
+import re
+import select
+import shlex
+import signal
+import subprocess
+import threading
+import time
+from dataclasses import dataclass, field
+from typing import Dict, List, Optional, Tuple
+
+from app.cancel import CancelToken
+from app.formats import FormatManager
+from app.limits import Limits, kill_process_group, spawn
+from app.timing import Stopwatch
+
+TIMEOUT_MESSAGE = (
+    "Compilation timeout: The process took longer than {timeout} seconds "
+    "and was aborted."
+)
+
+# End-of-job statistics in the log, printed when tracingstats is positive
+CAPACITY_HEADING = "Here is how much of MetaPost's memory you used:"
+CAPACITY_PATTERNS = [
+    ("strings", re.compile(r"(\d+) strings?\b")),
+    ("string_characters", re.compile(r"(\d+) (?:string )?characters?\b")),
+    ("memory_bytes", re.compile(r"(\d+) bytes of (?:node )?memory")),
+    ("memory_words", re.compile(r"(\d+) words of memory")),
+    ("symbolic_tokens", re.compile(r"(\d+) symbolic tokens")),
+]
+STACK_POSITIONS = re.compile(
+    r"(\d+)i,(\d+)n,(\d+)p,(\d+)b(?:,(\d+)f)? stack positions "
+    r"out of (\d+)i,(\d+)n,(\d+)p,(\d+)b(?:,(\d+)f)?"
+)
+STACK_NAMES = ["input_stack", "internals", "parameter_stack", "buffer", "open_files"]
+# The statistics are the last lines of the log
+LOG_TAIL_BYTES = 4096
+
+
+SIGNAL_MESSAGES = {
+    -signal.SIGXCPU: "Compilation aborted: CPU time limit exceeded.",
+    -signal.SIGXFSZ: "Compilation aborted: output file size limit exceeded.",
+    -signal.SIGKILL: "Compilation aborted: the process was killed.",
+}
+
+
+@dataclass
+class BackendResult:
+    returncode: int
+    stdout: str
+    stderr: str
+    svg: str
+    stdout_truncated: bool = False
+    svg_truncated: bool = False
+    png: bytes = b""
+    timed_out: bool = False
+    # (figure number, svg) in figure number order
+    figures: List[Tuple[int, str]] = field(default_factory=list)
+    # Seconds per phase of the job
+    timings: Dict[str, float] = field(default_factory=dict)
+    # Peak usage, and capacity where MetaPost reports it as "<name>_max"
+    capacity: Dict[str, int] = field(default_factory=dict)
+
+
+def read_capped_bytes(path: str, limit: int) -> Tuple[bytes, bool]:
+    """Read at most limit bytes of a file. Returns the data and whether it was cut"""
+    if not os.path.exists(path):
+        return b"", False
+    with open(path, "rb") as file_object:
+        data = file_object.read(limit + 1)
+    return data[:limit], len(data) > limit
+
+
+def read_capped(path: str, limit: int) -> Tuple[str, bool]:
+    """Read at most limit bytes of a text file"""
+    data, truncated = read_capped_bytes(path, limit)
+    return data.decode("utf-8", "replace"), truncated
+
+
+def read_tail(path: str, size: int) -> str:
+    """The last size bytes of a text file, or nothing if it does not exist"""
+    try:
+        with open(path, "rb") as file_object:
+            file_object.seek(0, os.SEEK_END)
+            file_object.seek(max(0, file_object.tell() - size))
+            return file_object.read().decode("utf-8", "replace")
+    except OSError:
+        return ""
+
+
+def parse_capacity(log: str) -> Dict[str, int]:
+    """Memory and capacity statistics at the end of a MetaPost log"""
+    start = log.rfind(CAPACITY_HEADING)
+    if start < 0:
+        return {}
+    capacity: Dict[str, int] = {}
+    for line in log[start + len(CAPACITY_HEADING) :].splitlines():
+        stack = STACK_POSITIONS.search(line)
+        if stack:
+            used, available = stack.groups()[:5], stack.groups()[5:]
+            for name, value, maximum in zip(STACK_NAMES, used, available):
+                if value is not None:
+                    capacity[name] = int(value)
+                    capacity[f"{name}_max"] = int(maximum)
+            break
+        for name, pattern in CAPACITY_PATTERNS:
+            match = pattern.search(line)
+            if match and name not in capacity:
+                capacity[name] = int(match.group(1))
+    return capacity
+
+
+def capped(text: str, limit: int) -> Tuple[str, bool]:
+    if len(text) <= limit:
+        return text, False
+    return text[:limit], True
+
+
+def oversized_svg(result: BackendResult, limits: Limits) -> BackendResult:
+    """Drop an image that was cut off at the size cap; a partial document is useless"""
+    kind = "PNG" if result.png else "SVG"
+    result.svg = ""
+    result.png = b""
+    result.figures = []
+    result.svg_truncated = True
+    result.returncode = result.returncode or 1
+    result.stderr += (
+        f"{kind} output exceeds {limits.max_svg_bytes // 1024} KB and was discarded.\n"
+    )
+    return result
+
+
+def figure_files(workspace: str, id: str, extension: str) -> List[Tuple[int, str]]:
+    """Figures written with the outputtemplate `<id>-%c.<extension>`, last shipped last"""
+    found = []
+    for path in glob.glob(os.path.join(workspace, f"{id}-*.{extension}")):
+        number = os.path.basename(path)[len(id) + 1 : -len(extension) - 1]
+        try:
+            found.append((os.stat(path).st_mtime_ns, int(number), path))
+        except (OSError, ValueError):
+            continue
+    found.sort()
+    return [(number, path) for _, number, path in found]
+
+
+def read_figures(
+    workspace: str, id: str, limits: Limits
+) -> Tuple[List[Tuple[int, str]], str, bool]:
+    """Read the figures within the size cap.
+
+    Returns them, the last shipped one and whether the cap was hit.
+    """
+    budget = limits.max_svg_bytes
+    figures, last = [], ""
+    for number, path in figure_files(workspace, id, "svg"):
+        svg, truncated = read_capped(path, budget)
+        if truncated:
+            return [], "", True
+        budget -= len(svg.encode("utf-8"))
+        figures.append((number, svg))
+        last = svg
+    figures.sort(key=lambda figure: figure[0])
+    return figures, last, False
+
+
+def points_per_pixel(resolution: float) -> str:
+    """hppp/vppp for a resolution in dots per inch; MetaPost counts 72 points an inch"""
+    return f"{72 / resolution:.6f}"
+
+
+def timeout_result(timeout: float) -> BackendResult:
+    return BackendResult(
+        returncode=-1,
+        stdout="",
+        stderr=TIMEOUT_MESSAGE.format(timeout=f"{timeout:g}"),
+        svg="",
+        timed_out=True,
+    )
+
+
+class SubprocessBackend:
+    name = "subprocess"
+
+    def __init__(
+        self,
+        mpost_bin: str,
+        formats: FormatManager,
+        limits: Limits,
+        tracing_stats: bool = False,
+    ):
+        self.mpost_bin = mpost_bin
+        self.formats = formats
+        self.limits = limits
+        # Run every job with tracingstats, for its capacity statistics
+        self.tracing_stats = tracing_stats
+        # Processes started, one per job
+        self.spawned = 0
+
+    def version(self) -> str:
+        try:
+            output = subprocess.run(
+                [self.mpost_bin, "--version"], capture_output=True, timeout=10
+            ).stdout
+            return output.decode("utf-8", "replace").splitlines()[0].strip()
+        except (OSError, IndexError, subprocess.TimeoutExpired):
+            return "unknown"
+
+    def compile(
+        self,
+        workspace: str,
+        id: str,
+        mp_code: str,
+        cancel: Optional[CancelToken] = None,
+        limits: Optional[Limits] = None,
+        outputformat: str = "svg",
+        resolution: float = 72,
+    ) -> BackendResult:
+        stopwatch = Stopwatch()
+        result = self._compile(
+            workspace, id, mp_code, cancel, limits, outputformat, resolution, stopwatch
+        )
+        result.timings = stopwatch.laps
+        return result
+
+    def _compile(
+        self,
+        workspace: str,
+        id: str,
+        mp_code: str,
+        cancel: Optional[CancelToken],
+        limits: Optional[Limits],
+        outputformat: str,
+        resolution: float,
+        stopwatch: Stopwatch,
+    ) -> BackendResult:
+        limits = limits or self.limits
+        mem, mp_code = self.formats.select(mp_code)
+        with open(os.path.join(workspace, id + ".mp"), "w") as file_object:
+            file_object.write(mp_code)
+        stopwatch.lap("write")
+        # One file per figure, so multi-figure programs keep every one
+        command_line: str = f"{self.mpost_bin} -s 'outputformat=\"{outputformat}\"' -s 'outputtemplate=\"{id}-%c.{outputformat}\"' {id}.mp"
+        cmd: list = shlex.split(command_line)
+        if outputformat == "png":
+            ppp = points_per_pixel(resolution)
+            cmd[1:1] = ["-s", f"hppp={ppp}", "-s", f"vppp={ppp}"]
+        if self.tracing_stats:
+            cmd[1:1] = ["-s", "tracingstats=1"]
+        if mem:
+            # Options must come before the input file name
+            cmd.insert(1, f"-mem={mem}")
+
+        # Terminal output goes to files, so RLIMIT_FSIZE bounds it and we
+        # only ever read back as much as we are willing to keep
+        stdout_path = os.path.join(workspace, id + ".stdout")
+        stderr_path = os.path.join(workspace, id + ".stderr")
+        self.spawned += 1
+        with open(stdout_path, "wb") as stdout, open(stderr_path, "wb") as stderr:
+            process: subprocess.Popen = spawn(
+                cmd,
+                limits,
+                stdin=subprocess.DEVNULL,
+                stdout=stdout,
+                stderr=stderr,
+                cwd=workspace,
+                env=self.formats.env(),
+            )
+        stopwatch.lap("spawn")
+        if cancel is not None:
+            cancel.on_cancel(lambda: kill_process_group(process))
+        try:
+            process.wait(timeout=limits.timeout)
+        except subprocess.TimeoutExpired:
+            kill_process_group(process)
+            process.wait()
+            stopwatch.lap("run")
+            return timeout_result(limits.timeout)
+        stopwatch.lap("run")
+        if cancel is not None:
+            cancel.raise_if_cancelled()
+
+        stdout_text, stdout_truncated = read_capped(stdout_path, limits.max_log_bytes)
+        stderr_text, _ = read_capped(stderr_path, limits.max_log_bytes)
+        if process.returncode in SIGNAL_MESSAGES:
+            stderr_text += SIGNAL_MESSAGES[process.returncode] + "\n"
+        result = BackendResult(
+            returncode=process.returncode,
+            stdout=stdout_text,
+            stderr=stderr_text,
+            svg="",
+            stdout_truncated=stdout_truncated,
+            capacity=parse_capacity(
+                read_tail(os.path.join(workspace, id + ".log"), LOG_TAIL_BYTES)
+            ),
+        )
+        if process.returncode == 0 and outputformat == "png":
+            pngs = figure_files(workspace, id, "png")
+            if pngs:
+                result.png, png_truncated = read_capped_bytes(
+                    pngs[-1][1], limits.max_svg_bytes
+                )
+                if png_truncated:
+                    return oversized_svg(result, limits)
+        elif process.returncode == 0:
+            result.figures, result.svg, svg_truncated = read_figures(
+                workspace, id, limits
+            )
+            if svg_truncated:
+                return oversized_svg(result, limits)
+        stopwatch.lap("read")
+        return result
+
+    def close(self):
+        pass
+
+
+class WorkerTimeout(Exception):
+    pass
+
+
+class MplibWorker:
+    """One LuaTeX process speaking the protocol of mplib_worker.lua"""
+
+    def __init__(self, cmd: List[str], env: dict, limits: Limits):
+        self.process = spawn(
+            cmd,
+            limits,
+            # CPU time accumulates over the worker's lifetime, so only the
+            # per-job wall-clock timeout bounds it
+            cpu=False,
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.DEVNULL,
+            env=env,
+        )
+        self.jobs = 0
+        self._buffer = b""
+
+    def run(
+        self,
+        workspace: str,
+        id: str,
+        limits: Limits,
+        outputformat: str = "svg",
+        resolution: float = 72,
+        tracing_stats: bool = False,
+    ) -> Tuple[int, str, List[Tuple[int, bytes]], str]:
+        """Run one job. Returns the mplib status, terminal output, figures and log.
+
+        Bodies larger than the caps are cut one byte past the cap, so the
+        caller can tell that they were truncated. Only the end of the log
+        is kept.
+        """
+        deadline = time.monotonic() + limits.timeout
+        ppp = points_per_pixel(resolution)
+        job = f"JOB {workspace} {id} {outputformat} {ppp} {int(tracing_stats)}\n"
+        self.process.stdin.write(job.encode("utf-8"))
+        self.process.stdin.flush()
+        self.jobs += 1
+
+        status, term, figures, log = 3, "", [], ""
+        while True:
+            header = self._read_line(deadline).split()
+            if header == [b"END"]:
+                return status, term, figures, log
+            tag, arg, size = header[0], int(header[1]), int(header[2])
+            keep = limits.max_log_bytes if tag == b"RESULT" else limits.max_svg_bytes
+            if tag == b"LOG":
+                # The worker sends the end of the log only
+                keep = LOG_TAIL_BYTES
+            body = self._read_exact(size, deadline, keep + 1)
+            if tag == b"LOG":
+                log = body.decode("utf-8", "replace")
+            elif tag == b"RESULT":
+                status, term = arg, body.decode("utf-8", "replace")
+            elif tag == b"FIG":
+                figures.append((arg, body))
+
+    def rss_bytes(self) -> int:
+        try:
+            with open(f"/proc/{self.process.pid}/statm") as statm:
+                return int(statm.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+        except (OSError, ValueError, IndexError):
+            return 0
+
+    def alive(self) -> bool:
+        return self.process.poll() is None
+
+    def kill(self):
+        kill_process_group(self.process)
+        self.process.wait()
+
+    def _fill(self, deadline: float):
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            raise WorkerTimeout()
+        fd = self.process.stdout.fileno()
+        ready, _, _ = select.select([fd], [], [], remaining)
+        if not ready:
+            raise WorkerTimeout()
+        chunk = os.read(fd, 65536)
+        if not chunk:
+            raise EOFError("mplib worker exited")
+        self._buffer += chunk
+
+    def _read_line(self, deadline: float) -> bytes:
+        while b"\n" not in self._buffer:
+            self._fill(deadline)
+        line, self._buffer = self._buffer.split(b"\n", 1)
+        return line
+
+    def _read_exact(self, size: int, deadline: float, keep: int) -> bytes:
+        """Consume size bytes, keeping only the first keep of them"""
+        data = b""
+        while size > 0:
+            if not self._buffer:
+                self._fill(deadline)
+            chunk, self._buffer = self._buffer[:size], self._buffer[size:]
+            size -= len(chunk)
+            if len(data) < keep:
+                data += chunk[: keep - len(data)]
+        return data
+
+
+class MplibBackend:
+    name = "mplib"
+
+    def __init__(
+        self,
+        luatex_bin: str,
+        formats: FormatManager,
+        limits: Limits,
+        max_jobs: int = 200,
+        max_rss_bytes: int = 512 * 1024 * 1024,
+        tracing_stats: bool = False,
+    ):
+        self.luatex_bin = luatex_bin
+        self.formats = formats
+        self.limits = limits
+        self.max_jobs = max_jobs
+        self.max_rss_bytes = max_rss_bytes
+        self.tracing_stats = tracing_stats
+        self.script = os.path.join(os.path.dirname(__file__), "mplib_worker.lua")
+        self.recycled = 0
+        # Worker processes started, each serving up to max_jobs jobs
+        self.spawned = 0
+        self._idle: List[MplibWorker] = []
+        self._lock = threading.Lock()
+
+    def version(self) -> str:
+        try:
+            output = subprocess.run(
+                [self.luatex_bin, "--version"], capture_output=True, timeout=10
+            ).stdout
+            return output.decode("utf-8", "replace").splitlines()[0].strip()
+        except (OSError, IndexError, subprocess.TimeoutExpired):
+            return "unknown"
+
+    def compile(
+        self,
+        workspace: str,
+        id: str,
+        mp_code: str,
+        cancel: Optional[CancelToken] = None,
+        limits: Optional[Limits] = None,
+        outputformat: str = "svg",
+        resolution: float = 72,
+    ) -> BackendResult:
+        stopwatch = Stopwatch()
+        result = self._compile(
+            workspace, id, mp_code, cancel, limits, outputformat, resolution, stopwatch
+        )
+        result.timings = stopwatch.laps
+        return result
+
+    def _compile(
+        self,
+        workspace: str,
+        id: str,
+        mp_code: str,
+        cancel: Optional[CancelToken],
+        limits: Optional[Limits],
+        outputformat: str,
+        resolution: float,
+        stopwatch: Stopwatch,
+    ) -> BackendResult:
+        limits = limits or self.limits
+        with open(os.path.join(workspace, id + ".mp"), "w") as file_object:
+            file_object.write(mp_code)
+        stopwatch.lap("write")
+
+        worker = self._checkout()
+        # Starting a worker is the only spawn; idle ones are handed out at once
+        stopwatch.lap("spawn")
+        job_lock = threading.Lock()
+        finished = False
+
+        def abort():
+            # Only kill the worker while it is still busy with this job
+            with job_lock:
+                if not finished:
+                    worker.kill()
+
+        if cancel is not None:
+            cancel.on_cancel(abort)
+        try:
+            status, term, figures, log = worker.run(
+                workspace, id, limits, outputformat, resolution, self.tracing_stats
+            )
+        except WorkerTimeout:
+            worker.kill()
+            stopwatch.lap("run")
+            return timeout_result(limits.timeout)
+        except (OSError, EOFError, ValueError, IndexError) as e:
+            stopwatch.lap("run")
+            worker.kill()
+            if cancel is not None:
+                cancel.raise_if_cancelled()
+            return BackendResult(
+                returncode=1, stdout="", stderr=f"mplib worker failed: {e}", svg=""
+            )
+        stopwatch.lap("run")
+        with job_lock:
+            finished = True
+        self._checkin(worker)
+
+        # mplib status: 0 spotless, 1 warnings, 2 errors, 3 fatal
+        returncode = 0 if status <= 1 else 1
+        stdout, stdout_truncated = capped(term, limits.max_log_bytes)
+        if returncode != 0:
+            figures = []
+        image = figures[-1][1] if figures else b""
+        result = BackendResult(
+            returncode=returncode,
+            stdout=stdout,
+            stderr="",
+            svg="",
+            stdout_truncated=stdout_truncated,
+            capacity=parse_capacity(log),
+        )
+        if outputformat == "png":
+            result.png = image
+            if len(image) > limits.max_svg_bytes:
+                return oversized_svg(result, limits)
+            return result
+        if sum(len(body) for _, body in figures) > limits.max_svg_bytes:
+            return oversized_svg(result, limits)
+        result.svg = image.decode("utf-8", "replace")
+        result.figures = sorted(
+            (number, body.decode("utf-8", "replace")) for number, body in figures
+        )
+        stopwatch.lap("read")
+        return result
+
+    def close(self):
+        with self._lock:
+            workers, self._idle = self._idle, []
+        for worker in workers:
+            worker.kill()
+
+    def _checkout(self) -> MplibWorker:
+        with self._lock:
+            while self._idle:
+                worker = self._idle.pop()
+                if worker.alive():
+                    return worker
+            self.spawned += 1
+        return MplibWorker(
+            [self.luatex_bin, "--luaonly", self.script],
+            self.formats.env(),
+            self.limits,
+        )
+
+    def _checkin(self, worker: MplibWorker):
+        if worker.jobs >= self.max_jobs or worker.rss_bytes() > self.max_rss_bytes:
+            self.recycled += 1
+            worker.kill()
+            return
+        with self._lock:
+            self._idle.append(worker)
+
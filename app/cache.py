@@ -0,0 +1,189 @@
+"""Content-addressed cache for MetaPost compile results.
+
+Results are kept in an in-memory LRU bounded by entry count and total size
+and, optionally, in an on-disk tier that is evicted by total size.
+Identical compiles are coalesced before they get here, in main.py.
+"""
+
+import hashlib
+import json
+import os
+import threading
+from collections import OrderedDict
+from typing import Callable, Dict, Optional, Tuple
+
+
+def cache_key(source: str, version: str) -> str:
+    """Hash of the normalized source and the compiler version"""
+    digest = hashlib.sha256()
+    digest.update(version.encode("utf-8"))
+    digest.update(b"\0")
+    digest.update(source.encode("utf-8"))
+    return digest.hexdigest()
+
+
+class CompileCache:
+    def __init__(
+        self,
+        max_entries: int = 256,
+        max_bytes: int = 64 * 1024 * 1024,
+        disk_dir: Optional[str] = None,
+        disk_max_bytes: int = 256 * 1024 * 1024,
+    ):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.disk_dir = disk_dir
+        self.disk_max_bytes = disk_max_bytes
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self._entries: "OrderedDict[str, dict]" = OrderedDict()
+        self._sizes: Dict[str, int] = {}
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self._disk_bytes = 0
+        if disk_dir:
+            os.makedirs(disk_dir, exist_ok=True)
+            self._disk_bytes = sum(size for _, size, _ in self._disk_files())
+
+    def get(self, key: str) -> Optional[dict]:
+        """Look up a result in memory, then on disk"""
+        with self._lock:
+            value = self._entries.get(key)
+            if value is not None:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return value
+        found = self._disk_get(key)
+        if found is None:
+            return None
+        value, size = found
+        with self._lock:
+            self.disk_hits += 1
+            self._remember(key, value, size)
+        return value
+
+    def peek(self, key: str) -> Optional[dict]:
+        """Look up a result in memory only, cheap enough for the event loop"""
+        with self._lock:
+            value = self._entries.get(key)
+            if value is not None:
+                self._entries.move_to_end(key)
+                self.hits += 1
+            return value
+
+    def put(self, key: str, value: dict):
+        # The JSON encoding stands in for the entry's size in memory too
+        data = json.dumps(value)
+        with self._lock:
+            self._remember(key, value, len(data))
+        self._disk_put(key, data.encode("utf-8"))
+
+    def get_or_compute(
+        self,
+        key: str,
+        compute: Callable[[], dict],
+        cacheable: Callable[[dict], bool] = lambda value: True,
+    ) -> dict:
+        """Return the cached value for key, computing and caching it on a miss.
+
+        Identical requests are coalesced by the caller before they reach a
+        worker thread, so nothing here waits on another computation.
+        """
+        value = self.get(key)
+        if value is not None:
+            return value
+        with self._lock:
+            self.misses += 1
+        value = compute()
+        if cacheable(value):
+            self.put(key, value)
+        return value
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "entries": len(self._entries),
+                "bytes": self._bytes,
+                "hits": self.hits,
+                "disk_hits": self.disk_hits,
+                "misses": self.misses,
+                "disk_bytes": self._disk_bytes,
+            }
+
+    def _remember(self, key: str, value: dict, size: int):
+        self._forget(key)
+        if size > self.max_bytes:
+            return
+        self._entries[key] = value
+        self._sizes[key] = size
+        self._bytes += size
+        while len(self._entries) > self.max_entries or self._bytes > self.max_bytes:
+            self._forget(next(iter(self._entries)))
+
+    def _forget(self, key: str):
+        if self._entries.pop(key, None) is not None:
+            self._bytes -= self._sizes.pop(key)
+
+    def _disk_path(self, key: str) -> str:
+        return os.path.join(self.disk_dir, key[:2], key + ".json")
+
+    def _disk_files(self):
+        for root, _, files in os.walk(self.disk_dir):
+            for name in files:
+                path = os.path.join(root, name)
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue
+                yield path, stat.st_size, stat.st_mtime
+
+    def _disk_get(self, key: str) -> Optional[Tuple[dict, int]]:
+        """The value stored on disk for key and the length of its encoding"""
+        if not self.disk_dir:
+            return None
+        path = self._disk_path(key)
+        try:
+            with open(path, "r") as file_object:
+                data = file_object.read()
+            value = json.loads(data)
+            # Touch the entry so that eviction is least-recently-used
+            os.utime(path)
+            return value, len(data)
+        except (OSError, ValueError):
+            return None
+
+    def _disk_put(self, key: str, data: bytes):
+        if not self.disk_dir:
+            return
+        path = self._disk_path(key)
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            temp_path = f"{path}.{threading.get_ident()}.tmp"
+            with open(temp_path, "wb") as file_object:
+                file_object.write(data)
+            os.replace(temp_path, path)
+        except OSError as e:
+            print(f"Compile cache write failed: {e}")
+            return
+        with self._lock:
+            self._disk_bytes += len(data)
+            over = self._disk_bytes > self.disk_max_bytes
+        if over:
+            self._disk_evict()
+
+    def _disk_evict(self):
+        files = sorted(self._disk_files(), key=lambda entry: entry[2])
+        total = sum(size for _, size, _ in files)
+        # Evict down to 90% of the budget so we don't rescan on every write
+        target = self.disk_max_bytes * 0.9
+        for path, size, _ in files:
+            if total <= target:
+                break
+            try:
+                os.remove(path)
+                total -= size
+            except OSError:
+                continue
+        with self._lock:
+            self._disk_bytes = total
@@ -0,0 +1,51 @@
+"""Cooperative cancellation for compile jobs.
+
+A CancelToken is handed down to the backend, which registers a callback that
+kills the running process. Cancelling the token from any thread, for example
+when the client disconnects or a newer compile supersedes this one, stops
+the job right away.
+"""
+
+import threading
+from typing import Callable, List
+
+
+class CompileCancelled(Exception):
+    pass
+
+
+class CancelToken:
+    def __init__(self):
+        self.reason = ""
+        self._event = threading.Event()
+        self._callbacks: List[Callable[[], None]] = []
+        self._lock = threading.Lock()
+
+    @property
+    def cancelled(self) -> bool:
+        return self._event.is_set()
+
+    def cancel(self, reason: str = "cancelled"):
+        with self._lock:
+            if self._event.is_set():
+                return
+            self.reason = reason
+            self._event.set()
+            callbacks, self._callbacks = self._callbacks, []
+        for callback in callbacks:
+            try:
+                callback()
+            except Exception as e:
+                print(f"Cancel callback failed: {e}")
+
+    def on_cancel(self, callback: Callable[[], None]):
+        """Run callback when cancelled, or right away if that already happened"""
+        with self._lock:
+            if not self._event.is_set():
+                self._callbacks.append(callback)
+                return
+        callback()
+
+    def raise_if_cancelled(self):
+        if self._event.is_set():
+            raise CompileCancelled(self.reason)
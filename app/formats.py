@@ -0,0 +1,200 @@
+"""Preloaded MetaPost formats for plain_ex and frequently reused preambles.
+
+Macro libraries are staged once into a shared formats directory that mpost
+finds through MPINPUTS, instead of being copied next to every job. When the
+installed mpost can still dump `.mem` files (`mpost -ini ... dump`), we dump
+one for plain_ex at startup and one for every user preamble (the macro block
+before the first `beginfig`) that has been seen often enough, and compile
+matching sources against it with `-mem=`. MetaPost 1.8 and later dropped mem
+dumping; there the probe fails and sources are compiled as they are.
+
+Preambles are user code, so they are dumped like any compile: in a leased
+workspace and under the compile limits. The finished `.mem` is then moved
+into the formats directory in one rename. Dumps run one at a time on a
+single builder thread, with a bounded number waiting.
+"""
+
+import hashlib
+import os
+import re
+import shutil
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from typing import Optional, Tuple
+
+from app.cancel import CancelToken
+from app.limits import Limits, run_limited
+from app.workspace import WorkspaceManager
+
+PLAIN_EX_INPUT = re.compile(r"\binput\s+plain_ex(\.mp)?\s*;?")
+BEGINFIG = re.compile(r"\bbeginfig\b")
+
+
+def blank_out(match: re.Match) -> str:
+    """Replace a match with spaces so that line and column numbers are kept"""
+    return " " * len(match.group(0))
+
+
+class FormatManager:
+    def __init__(
+        self,
+        mpost_bin: str,
+        formats_dir: str,
+        workspaces: WorkspaceManager,
+        limits: Limits,
+        preamble_threshold: int = 3,
+        preamble_min_lines: int = 5,
+        max_preambles: int = 64,
+        max_pending: int = 4,
+    ):
+        self.mpost_bin = mpost_bin
+        self.formats_dir = formats_dir
+        self.workspaces = workspaces
+        self.limits = limits
+        self.preamble_threshold = preamble_threshold
+        self.preamble_min_lines = preamble_min_lines
+        self.max_preambles = max_preambles
+        # Preamble dumps queued or running; more are not started until they finish
+        self.max_pending = max_pending
+        self.dump_supported = False
+        self.plain_ex_mem: Optional[str] = None
+        self.hits = 0
+        self._preamble_counts: "OrderedDict[str, int]" = OrderedDict()
+        self._preamble_mems: "OrderedDict[str, str]" = OrderedDict()
+        self._failed = set()
+        self._building = set()
+        self._lock = threading.Lock()
+        self._builder = ThreadPoolExecutor(1, thread_name_prefix="format-dump")
+        # Kills a running dump at shutdown
+        self._closing = CancelToken()
+
+    def prepare(self):
+        """Stage the macro libraries and dump the plain_ex format if mpost supports it"""
+        os.makedirs(self.formats_dir, exist_ok=True)
+        shutil.copyfile(
+            os.path.join("static", "plain_ex.mp"),
+            os.path.join(self.formats_dir, "plain_ex.mp"),
+        )
+        if self._dump("plain_ex", "input plain_ex;\n"):
+            self.dump_supported = True
+            self.plain_ex_mem = "plain_ex"
+        else:
+            print("mpost cannot dump mem files, compiling without preloaded formats")
+
+    def env(self) -> dict:
+        """Environment that lets mpost find the staged inputs and dumped formats"""
+        env = dict(os.environ)
+        for name in ("MPINPUTS", "MPMEMS"):
+            existing = env.get(name)
+            # A trailing separator keeps kpathsea's default search path
+            env[name] = f"{self.formats_dir}{os.pathsep}{existing or ''}"
+        return env
+
+    def select(self, mp_code: str) -> Tuple[Optional[str], str]:
+        """Pick a dumped format for the source and strip what it already contains"""
+        if not self.dump_supported:
+            return None, mp_code
+
+        match = BEGINFIG.search(mp_code)
+        if match and self.preamble_threshold > 0:
+            start = mp_code.rfind("\n", 0, match.start()) + 1
+            preamble = mp_code[:start]
+            if len([line for line in preamble.splitlines() if line.strip()]) >= (
+                self.preamble_min_lines
+            ):
+                mem = self._preamble_mem(preamble)
+                if mem:
+                    self.hits += 1
+                    # Keep the preamble's lines so error line numbers still match
+                    return mem, "\n" * preamble.count("\n") + mp_code[start:]
+
+        if self.plain_ex_mem and PLAIN_EX_INPUT.search(mp_code):
+            self.hits += 1
+            return self.plain_ex_mem, PLAIN_EX_INPUT.sub(blank_out, mp_code)
+        return None, mp_code
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "dump_supported": self.dump_supported,
+                "preamble_formats": len(self._preamble_mems),
+                "pending": len(self._building),
+                "hits": self.hits,
+            }
+
+    def close(self):
+        self._closing.cancel("shutting down")
+        self._builder.shutdown(wait=False, cancel_futures=True)
+
+    def _preamble_mem(self, preamble: str) -> Optional[str]:
+        digest = hashlib.sha256(preamble.encode("utf-8")).hexdigest()[:16]
+        with self._lock:
+            mem = self._preamble_mems.get(digest)
+            if mem:
+                self._preamble_mems.move_to_end(digest)
+                return mem
+            if digest in self._failed or digest in self._building:
+                return None
+            count = self._preamble_counts.pop(digest, 0) + 1
+            self._preamble_counts[digest] = count
+            while len(self._preamble_counts) > 16 * self.max_preambles:
+                self._preamble_counts.popitem(last=False)
+            if count < self.preamble_threshold:
+                return None
+            if len(self._building) >= self.max_pending:
+                # Counted already; a later compile asks again
+                return None
+            self._building.add(digest)
+
+        # Dump in the background; this compile goes ahead without the format
+        self._builder.submit(self._build_preamble, digest, preamble)
+        return None
+
+    def _build_preamble(self, digest: str, preamble: str):
+        name = f"preamble-{digest}"
+        built = self._dump(name, preamble)
+        with self._lock:
+            self._building.discard(digest)
+            if not built:
+                self._failed.add(digest)
+                return
+            self._preamble_counts.pop(digest, None)
+            self._preamble_mems[digest] = name
+            while len(self._preamble_mems) > self.max_preambles:
+                _, evicted = self._preamble_mems.popitem(last=False)
+                path = os.path.join(self.formats_dir, evicted + ".mem")
+                if os.path.exists(path):
+                    os.remove(path)
+
+    def _dump(self, name: str, body: str) -> bool:
+        with self.workspaces.lease() as workspace:
+            source = os.path.join(workspace.path, name + "-ini.mp")
+            with open(source, "w") as file_object:
+                file_object.write(f"input plain;\n{body}\ndump\n")
+            try:
+                status = run_limited(
+                    [
+                        self.mpost_bin,
+                        "-ini",
+                        "-interaction=batchmode",
+                        f"-jobname={name}",
+                        f"{name}-ini.mp",
+                    ],
+                    workspace.path,
+                    self.env(),
+                    self.limits,
+                    self._closing,
+                )
+            except OSError as e:
+                print(f"Failed to dump format {name}: {e}")
+                return False
+            mem = os.path.join(workspace.path, name + ".mem")
+            if status is None or not os.path.exists(mem):
+                return False
+            # Copied under a temporary name and renamed, so that no compile
+            # ever loads a half-written format
+            partial = os.path.join(self.formats_dir, f".{name}.mem.partial")
+            shutil.copyfile(mem, partial)
+            os.replace(partial, os.path.join(self.formats_dir, name + ".mem"))
+        return True
@@ -0,0 +1,200 @@
+"""Cache for GitHub gist API responses, revalidated with ETags.
+
+Responses are kept with their ETag and Last-Modified headers. A fresh entry
+is served without asking GitHub. Once it goes stale, it is still served
+right away while a background request revalidates it with If-None-Match;
+GitHub answers 304 without a body, and such requests do not count against
+the rate limit. Entries past the stale window are revalidated before they
+are served. If GitHub cannot be reached or fails, the cached copy is served
+however old it is.
+"""
+
+import asyncio
+import time
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import Any, Dict, Optional, Set
+from urllib.parse import urlencode
+
+from app.github import GitHubClient, GitHubError
+
+
+@dataclass
+class CachedResponse:
+    data: Any
+    etag: str = ""
+    last_modified: str = ""
+    # Pagination links of list responses
+    link: str = ""
+    validated: float = 0.0
+
+
+class GistCache:
+    def __init__(
+        self,
+        github: GitHubClient,
+        max_entries: int = 512,
+        fresh: float = 60,
+        stale: float = 86400,
+    ):
+        self.github = github
+        self.max_entries = max_entries
+        self.fresh = fresh
+        self.stale = stale
+        self.hits = 0
+        self.stale_hits = 0
+        self.misses = 0
+        self.not_modified = 0
+        self.outage_hits = 0
+        self._entries: "OrderedDict[str, CachedResponse]" = OrderedDict()
+        self._inflight: Dict[str, asyncio.Task] = {}
+        self._background: Set[asyncio.Task] = set()
+        # Bumped by invalidate, so fetches started before an edit are not stored.
+        # Only fetches compare them, so a path's counter lives while one runs
+        self._generations: Dict[str, int] = {}
+        self._fetching: Dict[str, int] = {}
+
+    async def get(
+        self, path: str, params: Optional[dict] = None
+    ) -> Optional[CachedResponse]:
+        """Cached GET of an API path. Returns None if GitHub answers 404"""
+        key = path + ("?" + urlencode(sorted(params.items())) if params else "")
+        entry = self._entries.get(key)
+        if entry is not None:
+            self._entries.move_to_end(key)
+            age = time.monotonic() - entry.validated
+            if age < self.fresh:
+                self.hits += 1
+                return entry
+            if age < self.fresh + self.stale:
+                self.stale_hits += 1
+                task = self._refresh(key, path, params)
+                self._background.add(task)
+                task.add_done_callback(self._background.discard)
+                return entry
+        else:
+            self.misses += 1
+        # Shielded, so a client that goes away does not cancel a shared refresh
+        return await asyncio.shield(self._refresh(key, path, params))
+
+    async def gist(self, gist_id: str) -> Optional[dict]:
+        entry = await self.get(f"/gists/{gist_id}")
+        return entry.data if entry is not None else None
+
+    def put(self, path: str, data: Any):
+        """Seed a path with a response we already have, e.g. that of an edit"""
+        self._entries[path] = CachedResponse(data=data, validated=time.monotonic())
+        self._entries.move_to_end(path)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def invalidate(self, path: str):
+        """Forget a path with any query parameters, e.g. after an edit"""
+        if path in self._fetching:
+            self._generations[path] = self._generations.get(path, 0) + 1
+        for key in [key for key in self._entries if self._matches(key, path)]:
+            del self._entries[key]
+        # Later reads start a fetch of their own instead of joining an older one
+        for key in [key for key in self._inflight if self._matches(key, path)]:
+            del self._inflight[key]
+
+    def stats(self) -> dict:
+        return {
+            "entries": len(self._entries),
+            "max_entries": self.max_entries,
+            "hits": self.hits,
+            "stale_hits": self.stale_hits,
+            "misses": self.misses,
+            "not_modified": self.not_modified,
+            "outage_hits": self.outage_hits,
+            "refreshing": len(self._inflight),
+        }
+
+    async def close(self):
+        for task in list(self._inflight.values()):
+            task.cancel()
+        await asyncio.gather(*self._inflight.values(), return_exceptions=True)
+
+    @staticmethod
+    def _matches(key: str, path: str) -> bool:
+        return key == path or key.startswith(path + "?")
+
+    def _refresh(self, key: str, path: str, params: Optional[dict]) -> asyncio.Task:
+        task = self._inflight.get(key)
+        if task is None:
+            task = asyncio.get_running_loop().create_task(
+                self._fetch(key, path, params)
+            )
+            self._inflight[key] = task
+            task.add_done_callback(lambda _: self._forget(key, task))
+            task.add_done_callback(self._log_failure)
+        return task
+
+    def _forget(self, key: str, task: asyncio.Task):
+        if self._inflight.get(key) is task:
+            del self._inflight[key]
+
+    def _log_failure(self, task: asyncio.Task):
+        if not task.cancelled() and task.exception() is not None:
+            print(f"Gist cache refresh failed: {task.exception()}")
+
+    async def _fetch(
+        self, key: str, path: str, params: Optional[dict]
+    ) -> Optional[CachedResponse]:
+        self._fetching[path] = self._fetching.get(path, 0) + 1
+        try:
+            return await self._revalidate(
+                key, path, params, self._generations.get(path, 0)
+            )
+        finally:
+            self._fetching[path] -= 1
+            if not self._fetching[path]:
+                del self._fetching[path]
+                self._generations.pop(path, None)
+
+    async def _revalidate(
+        self, key: str, path: str, params: Optional[dict], generation: int
+    ) -> Optional[CachedResponse]:
+        entry = self._entries.get(key)
+        headers = {}
+        if entry is not None and entry.etag:
+            headers["If-None-Match"] = entry.etag
+        elif entry is not None and entry.last_modified:
+            headers["If-Modified-Since"] = entry.last_modified
+        try:
+            response = await self.github.get(path, params=params, headers=headers)
+        except GitHubError:
+            if entry is None:
+                raise
+            self.outage_hits += 1
+            return entry
+
+        if response.status_code == 304 and entry is not None:
+            self.not_modified += 1
+            entry.validated = time.monotonic()
+            return entry
+        if response.status_code == 200:
+            entry = CachedResponse(
+                data=response.json(),
+                etag=response.headers.get("ETag", ""),
+                last_modified=response.headers.get("Last-Modified", ""),
+                link=response.headers.get("Link", ""),
+                validated=time.monotonic(),
+            )
+            # Invalidated while in flight, the answer may predate the edit: it
+            # goes to the callers waiting for it but is not stored
+            if self._generations.get(path, 0) == generation:
+                self._entries[key] = entry
+                self._entries.move_to_end(key)
+                while len(self._entries) > self.max_entries:
+                    self._entries.popitem(last=False)
+            return entry
+        if response.status_code in (404, 410):
+            if self._generations.get(path, 0) == generation:
+                self._entries.pop(key, None)
+            return None
+        # Rate limited or failing: keep showing what we have
+        if entry is not None:
+            self.outage_hits += 1
+            return entry
+        raise GitHubError(f"GET {path} returned {response.status_code}")
@@ -0,0 +1,184 @@
+"""Shared async client for the GitHub REST API and OAuth endpoints.
+
+One httpx.AsyncClient lives for the whole application, so connections to
+GitHub are kept alive and reused instead of opening a new TLS session per
+request. Every call has a timeout. Idempotent GETs are retried with jittered
+exponential backoff on network errors and 5xx responses; writes are never
+retried. The base URLs are configurable so the client can be pointed at a
+local stand-in server.
+"""
+
+import asyncio
+import random
+import time
+from typing import Optional
+
+import httpx
+
+from app import timing
+from app.metrics import Registry
+
+RETRY_STATUSES = {500, 502, 503, 504}
+
+
+class GitHubError(Exception):
+    """GitHub could not be reached, even after retrying"""
+
+
+class GitHubClient:
+    def __init__(
+        self,
+        api_base: str = "https://api.github.com",
+        oauth_base: str = "https://github.com",
+        client_id: str = "",
+        client_secret: str = "",
+        timeout: float = 10,
+        connect_timeout: float = 5,
+        retries: int = 2,
+        backoff: float = 0.25,
+        max_connections: int = 20,
+        transport: Optional[httpx.AsyncBaseTransport] = None,
+        metrics: Optional[Registry] = None,
+    ):
+        self.api_base = api_base.rstrip("/")
+        self.oauth_base = oauth_base.rstrip("/")
+        self.client_id = client_id
+        self.client_secret = client_secret
+        self.timeout = httpx.Timeout(timeout, connect=connect_timeout)
+        self.retries = retries
+        self.backoff = backoff
+        self.limits = httpx.Limits(
+            max_connections=max_connections,
+            max_keepalive_connections=max_connections,
+        )
+        self.transport = transport
+        self.requests = 0
+        self.retried = 0
+        self.failed = 0
+        # Left by the last API response, None until there is one
+        self.rate_limit_remaining: Optional[int] = None
+        self._latency = self._rate_limit = None
+        if metrics is not None:
+            self._latency = metrics.histogram(
+                "github_request_seconds",
+                "GitHub request latency by method and status, per attempt",
+                ("method", "status"),
+            )
+            self._rate_limit = metrics.gauge(
+                "github_rate_limit_remaining",
+                "X-RateLimit-Remaining of the last GitHub API response",
+            )
+        self._client: Optional[httpx.AsyncClient] = None
+
+    async def start(self):
+        if self._client is None:
+            self._client = httpx.AsyncClient(
+                timeout=self.timeout,
+                limits=self.limits,
+                transport=self.transport,
+                headers={"User-Agent": "metapost-sandbox"},
+            )
+
+    async def close(self):
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
+
+    @property
+    def client(self) -> httpx.AsyncClient:
+        if self._client is None:
+            raise RuntimeError("GitHub client is not started")
+        return self._client
+
+    def api_headers(self, token: Optional[str] = None) -> dict:
+        headers = {"Accept": "application/vnd.github.v3+json"}
+        if token:
+            headers["Authorization"] = f"token {token}"
+        return headers
+
+    async def api(
+        self,
+        method: str,
+        path: str,
+        token: Optional[str] = None,
+        timeout: Optional[float] = None,
+        headers: Optional[dict] = None,
+        **kwargs,
+    ) -> httpx.Response:
+        """Call the REST API as the user owning `token`, or as the app if there is none"""
+        if not token and self.client_id and self.client_secret:
+            # App credentials get the higher rate limit of an OAuth app
+            kwargs["auth"] = (self.client_id, self.client_secret)
+        return await self.request(
+            method,
+            f"{self.api_base}{path}",
+            headers={**self.api_headers(token), **(headers or {})},
+            timeout=timeout,
+            **kwargs,
+        )
+
+    async def get(self, path: str, **kwargs) -> httpx.Response:
+        return await self.api("GET", path, **kwargs)
+
+    async def exchange_code(self, code: str) -> dict:
+        """Trade an OAuth authorization code for a token response"""
+        response = await self.request(
+            "POST",
+            f"{self.oauth_base}/login/oauth/access_token",
+            headers={"Accept": "application/json"},
+            data={
+                "client_id": self.client_id,
+                "client_secret": self.client_secret,
+                "code": code,
+            },
+        )
+        return response.json()
+
+    async def request(
+        self, method: str, url: str, timeout: Optional[float] = None, **kwargs
+    ) -> httpx.Response:
+        if timeout is not None:
+            kwargs["timeout"] = httpx.Timeout(timeout, connect=self.timeout.connect)
+        attempts = 1 + (self.retries if method == "GET" else 0)
+        attempt = 0
+        while True:
+            self.requests += 1
+            attempt += 1
+            last = attempt == attempts
+            start = time.perf_counter()
+            try:
+                response = await self.client.request(method, url, **kwargs)
+            except httpx.TransportError as e:
+                self._observe(method, "error", start)
+                if last:
+                    self.failed += 1
+                    raise GitHubError(f"{method} {url} failed: {e!r}") from e
+            else:
+                self._observe(method, str(response.status_code), start)
+                remaining = response.headers.get("X-RateLimit-Remaining")
+                if remaining is not None and remaining.isdigit():
+                    self.rate_limit_remaining = int(remaining)
+                    if self._rate_limit is not None:
+                        self._rate_limit.set(value=self.rate_limit_remaining)
+                if response.status_code not in RETRY_STATUSES or last:
+                    return response
+            self.retried += 1
+            # Full jitter keeps retries from many requests from lining up
+            await asyncio.sleep(random.uniform(0, self.backoff * 2 ** (attempt - 1)))
+
+    def _observe(self, method: str, status: str, start: float):
+        elapsed = time.perf_counter() - start
+        # Server-Timing of the request that waited for GitHub
+        timing.record("github", elapsed)
+        if self._latency is not None:
+            self._latency.observe(elapsed, method, status)
+
+    def stats(self) -> dict:
+        return {
+            "api_base": self.api_base,
+            "max_connections": self.limits.max_connections,
+            "requests": self.requests,
+            "retried": self.retried,
+            "failed": self.failed,
+            "rate_limit_remaining": self.rate_limit_remaining,
+        }
@@ -0,0 +1,136 @@
+"""Resource limits for mpost runs, and running a process under them.
+
+Limits bound a run by wall-clock time and by rlimits on CPU time, address
+space, written file size and process count. The compile backends apply
+them to every job; `run_limited` applies them to helper runs such as
+format dumps.
+
+The rlimits are not set in a preexec_fn: that runs between fork and exec,
+which is unsafe in a process with threads. Commands go through prlimit(1)
+instead, which sets the limits and then execs them. Where prlimit is not
+installed, the limits are applied with prlimit(2) right after the spawn.
+"""
+
+import math
+import os
+import resource
+import shutil
+import signal
+import subprocess
+from dataclasses import dataclass, replace
+from typing import List, Optional, Tuple
+
+from app.cancel import CancelToken
+
+PRLIMIT = shutil.which("prlimit")
+PRLIMIT_OPTIONS = {
+    resource.RLIMIT_AS: "--as",
+    resource.RLIMIT_FSIZE: "--fsize",
+    resource.RLIMIT_CORE: "--core",
+    resource.RLIMIT_CPU: "--cpu",
+    resource.RLIMIT_NPROC: "--nproc",
+}
+
+
+@dataclass
+class Limits:
+    timeout: float = 60
+    cpu_seconds: int = 30
+    address_space_mb: int = 512
+    file_size_mb: int = 16
+    # RLIMIT_NPROC counts every process of the user, so it is off by default
+    processes: int = 0
+    # Caps all figures together, and PNG output
+    max_svg_bytes: int = 4 * 1024 * 1024
+    max_log_bytes: int = 256 * 1024
+
+    def with_timeout(self, timeout: Optional[float]) -> "Limits":
+        """Same limits with another wall-clock timeout, CPU time capped to match"""
+        if timeout is None:
+            return self
+        return replace(
+            self,
+            timeout=timeout,
+            cpu_seconds=min(self.cpu_seconds, math.ceil(timeout)),
+        )
+
+    def rlimits(self, cpu: bool = True) -> List[Tuple[int, int, int]]:
+        """(resource, soft, hard) of every rlimit that is set"""
+        rlimits = [
+            (resource.RLIMIT_AS, self.address_space_mb * 1024 * 1024),
+            (resource.RLIMIT_FSIZE, self.file_size_mb * 1024 * 1024),
+            (resource.RLIMIT_CORE, 0),
+        ]
+        if cpu:
+            rlimits.append((resource.RLIMIT_CPU, self.cpu_seconds))
+        if self.processes:
+            rlimits.append((resource.RLIMIT_NPROC, self.processes))
+        # A second of grace past the soft CPU limit, so that mpost gets
+        # SIGXCPU rather than an anonymous SIGKILL
+        return [
+            (which, value, value + 1 if which == resource.RLIMIT_CPU else value)
+            for which, value in rlimits
+            if value > 0 or which == resource.RLIMIT_CORE
+        ]
+
+
+def spawn(cmd: List[str], limits: Limits, cpu: bool = True, **kwargs):
+    """Popen cmd in a session of its own, under the rlimits"""
+    rlimits = limits.rlimits(cpu)
+    if PRLIMIT:
+        options = [
+            f"{PRLIMIT_OPTIONS[which]}={soft}:{hard}" for which, soft, hard in rlimits
+        ]
+        cmd = [PRLIMIT, *options, "--", *cmd]
+    # A session of its own lets us kill the process and any helpers it spawns
+    process = subprocess.Popen(cmd, start_new_session=True, **kwargs)
+    if not PRLIMIT:
+        for which, soft, hard in rlimits:
+            try:
+                resource.prlimit(process.pid, which, (soft, hard))
+            except ProcessLookupError:
+                break
+    return process
+
+
+def kill_process_group(process: subprocess.Popen):
+    """Kill a process started in its own session together with its children"""
+    if process.poll() is not None:
+        return
+    try:
+        os.killpg(process.pid, signal.SIGKILL)
+    except ProcessLookupError:
+        pass
+
+
+def run_limited(
+    cmd: List[str],
+    cwd: str,
+    env: dict,
+    limits: Limits,
+    cancel: Optional[CancelToken] = None,
+) -> Optional[int]:
+    """Run a command under the limits, output discarded.
+
+    Returns the exit status, or None if it timed out or was cancelled.
+    """
+    process = spawn(
+        cmd,
+        limits,
+        stdin=subprocess.DEVNULL,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+        cwd=cwd,
+        env=env,
+    )
+    if cancel is not None:
+        cancel.on_cancel(lambda: kill_process_group(process))
+    try:
+        returncode = process.wait(timeout=limits.timeout)
+    except subprocess.TimeoutExpired:
+        kill_process_group(process)
+        process.wait()
+        return None
+    if cancel is not None and cancel.cancelled:
+        return None
+    return returncode
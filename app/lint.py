@@ -0,0 +1,257 @@
+"""Pre-compile checks that catch obviously broken MetaPost without running mpost.
+
+A small tokenizer finds unterminated strings and checks the nesting of
+def/enddef, for/endfor, if/fi, begingroup/endgroup and beginfig/endfig.
+Diagnostics are worded like mpost's own log messages. Only mistakes that
+would make mpost fail are reported as errors. Anything that could be a
+macro trick is left to mpost: the nesting checks are skipped when the
+source reads other files, aliases tokens with `let`, or defines macros
+whose bodies are unbalanced on their own.
+"""
+
+import re
+from dataclasses import dataclass, field
+from typing import List
+
+TOKEN = re.compile(
+    r"(?P<comment>%[^\n]*)"
+    r'|(?P<string>"[^"\n]*"?)'
+    r"|(?P<symbol>[A-Za-z_]+)"
+    r"|(?P<newline>\n)"
+    r'|(?P<other>[^\sA-Za-z_%"]+)'
+    r"|(?P<space>\s)"
+)
+ETEX = re.compile(r"(?<![A-Za-z_])etex(?![A-Za-z_])")
+
+DEF_OPENERS = {"def", "vardef", "primarydef", "secondarydef", "tertiarydef"}
+FOR_OPENERS = {"for", "forsuffixes", "forever"}
+# Tokens that make the structure depend on something we cannot see
+OPAQUE = {"input", "scantokens", "let", "readfrom"}
+# Openers and closers whose balance inside a macro body we check
+BALANCED = [
+    ({"if"}, "fi"),
+    ({"begingroup"}, "endgroup"),
+    ({"beginfig"}, "endfig"),
+    (FOR_OPENERS, "endfor"),
+]
+
+
+@dataclass
+class Token:
+    text: str
+    kind: str
+    line: int
+    column: int
+
+
+@dataclass
+class Diagnostic:
+    message: str
+    line: int
+    # Where mpost would have stopped reading the line
+    column: int
+    error: bool = True
+
+    @classmethod
+    def after(cls, token: "Token", message: str, error: bool = True):
+        return cls(message, token.line, token.column + len(token.text), error)
+
+
+@dataclass
+class LintResult:
+    diagnostics: List[Diagnostic] = field(default_factory=list)
+    needs_end: bool = True
+
+    @property
+    def errors(self) -> List[Diagnostic]:
+        return [diagnostic for diagnostic in self.diagnostics if diagnostic.error]
+
+
+def tokenize(mp_code: str, diagnostics: List[Diagnostic]) -> List[Token]:
+    """Split into tokens, skipping comments and btex/verbatimtex text"""
+    tokens: List[Token] = []
+    line, line_start, position = 1, 0, 0
+    while position < len(mp_code):
+        match = TOKEN.match(mp_code, position)
+        kind, text = match.lastgroup, match.group()
+        column = position - line_start
+        position = match.end()
+        if kind == "newline":
+            line, line_start = line + 1, position
+        elif kind == "string":
+            if len(text) == 1 or not text.endswith('"'):
+                # mpost notices at the end of the line
+                diagnostics.append(
+                    Diagnostic(
+                        "Incomplete string token has been flushed",
+                        line,
+                        position - line_start,
+                    )
+                )
+            tokens.append(Token(text, kind, line, column))
+        elif kind == "symbol":
+            tokens.append(Token(text, kind, line, column))
+            if text in ("btex", "verbatimtex"):
+                etex = ETEX.search(mp_code, position)
+                if etex is None:
+                    # Unterminated TeX text: leave the rest to mpost
+                    tokens.append(Token("", "eof_in_tex", line, column))
+                    break
+                skipped = mp_code[position : etex.start()]
+                if "\n" in skipped:
+                    line += skipped.count("\n")
+                    line_start = position + skipped.rfind("\n") + 1
+                tokens.append(Token("etex", "symbol", line, etex.start() - line_start))
+                position = etex.end()
+        elif kind == "other":
+            tokens.append(Token(text, kind, line, column))
+    return tokens
+
+
+def unbalanced_macros(symbols: List[Token]) -> bool:
+    """Whether any macro body opens or closes more than it closes or opens"""
+    depth, counts = 0, {}
+    for token in symbols:
+        if token.text in DEF_OPENERS:
+            depth += 1
+            if depth == 1:
+                counts = {}
+        elif token.text == "enddef" and depth:
+            depth -= 1
+            if depth == 0 and any(
+                sum(counts.get(name, 0) for name in openers) != counts.get(closer, 0)
+                for openers, closer in BALANCED
+            ):
+                return True
+        elif depth:
+            counts[token.text] = counts.get(token.text, 0) + 1
+    return False
+
+
+def ends_program(tokens: List[Token]) -> bool:
+    significant = [token for token in tokens if token.text.strip(";")]
+    return bool(significant) and significant[-1].text in ("end", "dump")
+
+
+def lint(mp_code: str) -> LintResult:
+    result = LintResult()
+    diagnostics = result.diagnostics
+    tokens = tokenize(mp_code, diagnostics)
+    result.needs_end = not ends_program(tokens)
+
+    if any(token.kind == "eof_in_tex" for token in tokens):
+        return result
+    symbols = [token for token in tokens if token.kind == "symbol"]
+    if any(token.text in OPAQUE for token in symbols):
+        return result
+    check_nesting = not unbalanced_macros(symbols)
+
+    # def and for bodies are scanned as raw token lists, so inside them only
+    # their own openers and closers matter
+    scanning: List[Token] = []
+    conditions: List[Token] = []
+    groups: List[Token] = []
+    figures_closed = 0
+    for token in symbols:
+        text = token.text
+        if scanning and scanning[-1].text in DEF_OPENERS:
+            if text in DEF_OPENERS:
+                scanning.append(token)
+            elif text == "enddef":
+                scanning.pop()
+            continue
+        if scanning:
+            if text in FOR_OPENERS:
+                scanning.append(token)
+            elif text == "endfor":
+                scanning.pop()
+            continue
+
+        if text in ("end", "dump"):
+            break
+        if text in DEF_OPENERS or text in FOR_OPENERS:
+            scanning.append(token)
+        elif text == "enddef":
+            diagnostics.append(Diagnostic.after(token, "Extra `enddef'"))
+        elif text == "endfor" and check_nesting:
+            diagnostics.append(Diagnostic.after(token, "Extra `endfor'"))
+        elif not check_nesting:
+            continue
+        elif text == "if":
+            conditions.append(token)
+        elif text == "fi":
+            if conditions:
+                conditions.pop()
+            else:
+                diagnostics.append(Diagnostic.after(token, "Extra `fi'"))
+        elif text in ("else", "elseif") and not conditions:
+            diagnostics.append(Diagnostic.after(token, f"Extra `{text}'"))
+        elif text in ("begingroup", "beginfig"):
+            groups.append(token)
+        elif text in ("endgroup", "endfig"):
+            if groups:
+                if groups.pop().text == "beginfig":
+                    figures_closed += 1
+            else:
+                diagnostics.append(Diagnostic.after(token, "Extra `endgroup'"))
+
+    for token in scanning[:1]:
+        if token.text in DEF_OPENERS:
+            name = definition_name(symbols, token)
+            message = f"File ended while scanning the definition of {name}"
+        else:
+            message = "File ended while scanning the text of a for loop"
+        diagnostics.append(Diagnostic.after(token, message))
+    if check_nesting and groups and not scanning:
+        # mpost only warns, but a figure that never ends is never shipped;
+        # unless an earlier one was, there is nothing to show
+        unfinished = any(group.text == "beginfig" for group in groups)
+        diagnostics.append(
+            Diagnostic.after(
+                groups[-1],
+                f"end occurred inside a group at level {len(groups)}",
+                error=unfinished and figures_closed == 0,
+            )
+        )
+    for token in conditions[-1:]:
+        diagnostics.append(
+            Diagnostic.after(
+                token,
+                f"end occurred when if on line {token.line} was incomplete",
+                error=False,
+            )
+        )
+    return result
+
+
+def definition_name(symbols: List[Token], opener: Token) -> str:
+    for token in symbols:
+        if token.line > opener.line or (
+            token.line == opener.line and token.column > opener.column
+        ):
+            return token.text
+    return "?"
+
+
+def needs_end(mp_code: str) -> bool:
+    """Whether the program lacks a final `end` (or `dump`)"""
+    return not ends_program(tokenize(mp_code, []))
+
+
+def format_diagnostics(mp_code: str, diagnostics: List[Diagnostic]) -> str:
+    """Render diagnostics the way mpost prints errors on the terminal"""
+    lines = mp_code.split("\n")
+    output: List[str] = []
+    for diagnostic in diagnostics:
+        if not diagnostic.error:
+            output.append(f"({diagnostic.message})")
+            continue
+        text: str = lines[diagnostic.line - 1] if diagnostic.line <= len(lines) else ""
+        before, after = text[: diagnostic.column], text[diagnostic.column :]
+        context = f"l.{diagnostic.line} {before}"
+        output.append(f"! {diagnostic.message}.")
+        output.append(context)
+        if after.strip():
+            output.append(" " * len(context) + after)
+        output.append("")
+    return "\n".join(output)
@@ -0,0 +1,218 @@
+"""Live compile sessions of the editor over a WebSocket.
+
+The editor sends every edit as {"type": "compile", "seq", "code", "mode"}.
+Edits that arrive while a compile runs cancel it, and only the latest one
+is compiled next. Results carry the log and, for the SVG, whichever is
+smallest of:
+
+* "unchanged": true, when the SVG hash is the one the editor already has;
+* "delta": splices [start, end, text] that turn the editor's SVG (whose
+  hash is "base") into the new one, in ascending order of the old offsets;
+* "svg": the full document.
+
+An editor that lost track of its SVG sends {"type": "resync"} and gets the
+full document with its next result. Compile scheduling is unchanged: each
+compile still takes a pooled workspace, the session keeps only the SVG the
+editor has.
+"""
+
+import asyncio
+import hashlib
+import json
+import re
+from difflib import SequenceMatcher
+from typing import Awaitable, Callable, Dict, List, Optional
+
+from app.cancel import CancelToken, CompileCancelled
+from app.pool import QueueFullError, RateLimitedError
+
+# Characters that take two UTF-16 code units in JavaScript strings, which
+# would shift the offsets of a delta
+ASTRAL = re.compile("[\U00010000-\U0010ffff]")
+# Line diffs beyond this size fall back to a single splice
+MAX_DIFF_LINES = 20000
+
+
+def svg_hash(svg: str) -> str:
+    return hashlib.sha1(svg.encode("utf-8")).hexdigest()[:16]
+
+
+def common_prefix(a: str, b: str) -> int:
+    size = min(len(a), len(b))
+    low, high = 0, size
+    # Bisect on slices, which compare in C
+    while low < high:
+        middle = (low + high + 1) // 2
+        if a[:middle] == b[:middle]:
+            low = middle
+        else:
+            high = middle - 1
+    return low
+
+
+def common_suffix(a: str, b: str, limit: int) -> int:
+    low, high = 0, min(len(a), len(b), limit)
+    while low < high:
+        middle = (low + high + 1) // 2
+        if a[len(a) - middle :] == b[len(b) - middle :]:
+            low = middle
+        else:
+            high = middle - 1
+    return low
+
+
+def svg_delta(old: str, new: str) -> Optional[List[list]]:
+    """Splices that turn old into new, or None if they cannot be expressed"""
+    if not (old.isascii() and new.isascii()) and (
+        ASTRAL.search(old) or ASTRAL.search(new)
+    ):
+        return None
+    head = common_prefix(old, new)
+    tail = common_suffix(old, new, min(len(old), len(new)) - head)
+    old_middle, new_middle = old[head : len(old) - tail], new[head : len(new) - tail]
+    old_lines = old_middle.splitlines(keepends=True)
+    new_lines = new_middle.splitlines(keepends=True)
+    if len(old_lines) + len(new_lines) > MAX_DIFF_LINES:
+        return [[head, len(old) - tail, new_middle]]
+
+    old_offsets, new_offsets = [head], [0]
+    for line in old_lines:
+        old_offsets.append(old_offsets[-1] + len(line))
+    for line in new_lines:
+        new_offsets.append(new_offsets[-1] + len(line))
+    ops = []
+    matcher = SequenceMatcher(None, old_lines, new_lines, autojunk=False)
+    for tag, i1, i2, j1, j2 in matcher.get_opcodes():
+        if tag == "equal":
+            continue
+        # Trim what the changed lines still have in common
+        start, end = old_offsets[i1], old_offsets[i2]
+        text = new_middle[new_offsets[j1] : new_offsets[j2]]
+        first = common_prefix(old[start:end], text)
+        last = common_suffix(old[start:end], text, min(end - start, len(text)) - first)
+        ops.append([start + first, end - last, text[first : len(text) - last]])
+    return ops
+
+
+class LiveSession:
+    def __init__(
+        self,
+        compile: Callable[[str, CancelToken, bool], Awaitable],
+        send: Callable[[str], Awaitable],
+        stats: Dict[str, int],
+    ):
+        # compile(code, token, preview) returns a MetapostResponse
+        self.compile = compile
+        self.send = send
+        self.stats = stats
+        self.svg = ""
+        self.hash = ""
+        self._latest: Optional[dict] = None
+        self._wake = asyncio.Event()
+        self._token: Optional[CancelToken] = None
+
+    def receive(self, message: dict):
+        """Handle a message of the editor. Raises ValueError if it is malformed"""
+        kind = message.get("type")
+        if kind == "resync":
+            self.svg, self.hash = "", ""
+        elif kind == "compile":
+            if not isinstance(message.get("code"), str):
+                raise ValueError("code must be a string")
+            if self._latest is not None or self._token is not None:
+                self.stats["coalesced"] += 1
+            self._latest = message
+            if self._token is not None:
+                self._token.cancel("superseded by a newer edit")
+            self._wake.set()
+        else:
+            raise ValueError(f"Unknown message type {kind!r}")
+
+    def close(self):
+        if self._token is not None:
+            self._token.cancel("client disconnected")
+
+    async def run(self):
+        while True:
+            await self._wake.wait()
+            self._wake.clear()
+            message, self._latest = self._latest, None
+            if message is None:
+                continue
+            seq = message.get("seq")
+            token = CancelToken()
+            self._token = token
+            try:
+                result = await self.compile(
+                    message["code"], token, message.get("mode") == "preview"
+                )
+            except CompileCancelled:
+                continue
+            except (QueueFullError, RateLimitedError) as e:
+                await self._send(
+                    {
+                        "type": "busy",
+                        "seq": seq,
+                        "message": str(e),
+                        "retry_after": e.retry_after,
+                    }
+                )
+                continue
+            except Exception as e:
+                print(f"Live compile failed: {e!r}")
+                await self._send({"type": "error", "seq": seq, "message": str(e)})
+                continue
+            finally:
+                self._token = None
+            self.stats["compiles"] += 1
+            if self._latest is not None:
+                # Outdated already; the editor only wants the newest result
+                continue
+            await self._send(await self._result(seq, result))
+
+    async def _result(self, seq, result) -> dict:
+        reply = {
+            "type": "result",
+            "seq": seq,
+            "error": result.error,
+            "stdout": result.stdout,
+            "stderr": result.stderr,
+            "stdout_truncated": result.stdout_truncated,
+            "svg_truncated": result.svg_truncated,
+            "capacity": result.capacity,
+        }
+        if result.error != 0:
+            reply["hash"] = self.hash
+            return reply
+        svg = result.svg
+        if not svg:
+            # Nothing was drawn: the editor clears its preview
+            self.svg, self.hash = "", ""
+            reply["svg"] = ""
+            reply["hash"] = self.hash
+            return reply
+        digest = svg_hash(svg)
+        self.stats["full_bytes"] += len(svg)
+        if digest == self.hash:
+            self.stats["unchanged"] += 1
+            reply["unchanged"] = True
+        else:
+            ops = None
+            if self.svg:
+                loop = asyncio.get_running_loop()
+                ops = await loop.run_in_executor(None, svg_delta, self.svg, svg)
+            if ops is not None and len(json.dumps(ops)) < len(svg):
+                self.stats["deltas"] += 1
+                reply["delta"] = ops
+                reply["base"] = self.hash
+            else:
+                self.stats["full"] += 1
+                reply["svg"] = svg
+            self.svg, self.hash = svg, digest
+        reply["hash"] = self.hash
+        return reply
+
+    async def _send(self, reply: dict):
+        text = json.dumps(reply)
+        self.stats["sent_bytes"] += len(text)
+        await self.send(text)
@@ -1,7 +1,14 @@
-import subprocess
-from typing import List
-from fastapi import FastAPI, Request, Response
-from fastapi.responses import HTMLResponse, JSONResponse
+import asyncio
+from contextlib import asynccontextmanager
+from typing import Dict, List, Optional, Set, Tuple
+from fastapi import FastAPI, Request, Response, WebSocket, WebSocketDisconnect
+from fastapi.requests import HTTPConnection
+from fastapi.responses import (
+    HTMLResponse,
+    JSONResponse,
+    PlainTextResponse,
+    StreamingResponse,
+)
 from fastapi.staticfiles import StaticFiles
 from fastapi.templating import Jinja2Templates
 from pydantic.dataclasses import dataclass
@@ -9,22 +16,81 @@ from dotenv import load_dotenv
 import os
 import json
 import uuid
-import shlex
-import shutil
 import tempfile
-import requests
+import functools
+import dataclasses
+import hashlib
+import re
+import time
+
+from app import svgopt, timing
+from app.artifacts import (
+    Artifact,
+    ArtifactStore,
+    etag_matches,
+    make_artifact,
+    negotiate,
+    warn_missing_packages,
+)
+from app.assets import AssetManifest
+from app.backends import BackendResult, Limits, MplibBackend, SubprocessBackend
+from app.cache import CompileCache, cache_key
+from app.cancel import CancelToken, CompileCancelled
+from app.formats import FormatManager
+from app.gists import GistCache
+from app.github import GitHubClient
+from app.lint import format_diagnostics, lint, needs_end
+from app.live import LiveSession
+from app.metrics import (
+    SIZE_BUCKETS,
+    MetricsMiddleware,
+    Registry,
+    current_scope,
+    route_name,
+)
+from app.pool import (
+    BACKGROUND,
+    EMBED,
+    INTERACTIVE,
+    ClientQuotas,
+    CompilePool,
+    QueueFullError,
+    RateLimitedError,
+)
+from app.store import (
+    GitHubSampleStore,
+    Sample,
+    SQLiteSampleStore,
+    gist_complete,
+    sample_from_gist,
+)
+from app.timing import TimingMiddleware
+from app.workspace import WorkspaceManager
 
 # Load environment variables from .env file
 load_dotenv()
 
 
+@dataclass
+class MetapostFigure:
+    number: int
+    svg: str
+
+
 @dataclass
 class MetapostResponse:
     id: str
     error: int = 0
     stdout: str = None
     stderr: str = None
+    # The last shipped figure
     svg: str = None
+    stdout_truncated: bool = False
+    svg_truncated: bool = False
+    # Every figure, in figure number order
+    figures: List[MetapostFigure] = dataclasses.field(default_factory=list)
+    # Memory and capacity statistics of the run, if it had tracingstats on
+    capacity: Dict[str, int] = dataclasses.field(default_factory=dict)
 
 
 @dataclass
@@ -36,13 +102,225 @@ class MetapostSample:
     created: str
     updated: str
     svg: str = None
+    thumbnail: str = None
+
+
+MPOST_BIN = os.environ.get("MPOST_BIN", "/usr/bin/mpost")
+
+# Scraped at /metrics; stats the components keep anyway are collected there
+metrics = Registry()
+request_seconds = metrics.histogram(
+    "http_request_duration_seconds",
+    "Request latency by route, method and status",
+    ("route", "method", "status"),
+)
+requests_in_flight = metrics.gauge(
+    "http_requests_in_flight", "Requests and WebSocket sessions being served", ("type",)
+)
+compile_seconds = metrics.histogram(
+    "mpost_compile_seconds",
+    "Time to a compile result by route, and whether it came from the memory "
+    "cache, the linter, the worker pool or an identical compile in flight",
+    ("route", "source"),
+)
+queue_wait_seconds = metrics.histogram(
+    "mpost_queue_wait_seconds", "Time compiles spent queued, by route", ("route",)
+)
+mpost_runs = metrics.counter(
+    "mpost_runs_total", "mpost runs by output format and exit code", ("format", "code")
+)
+mpost_timeouts = metrics.counter(
+    "mpost_timeouts_total", "mpost runs killed by the timeout", ("format",)
+)
+svg_bytes = metrics.histogram(
+    "mpost_svg_bytes", "Size of the SVG of successful runs", buckets=SIZE_BUCKETS
+)
+log_bytes = metrics.histogram(
+    "mpost_log_bytes", "Size of the terminal output of runs", buckets=SIZE_BUCKETS
+)
+phase_seconds = metrics.histogram(
+    "http_request_phase_seconds",
+    "Time requests spent in each phase, as in their Server-Timing header",
+    ("route", "phase"),
+)
+
+# Server-Timing headers with the phases of every request, and optionally a
+# JSON log line per request with the phases and the capacity statistics
+SERVER_TIMING = os.environ.get("SERVER_TIMING", "on") == "on"
+TIMING_LOG = os.environ.get("TIMING_LOG", "off") == "on"
+# Run mpost with tracingstats, for the capacity statistics in its log
+MPOST_TRACING_STATS = os.environ.get("MPOST_TRACING_STATS", "on") == "on"
+
+compile_cache = CompileCache(
+    max_entries=int(os.environ.get("MPOST_CACHE_SIZE", "256")),
+    max_bytes=int(os.environ.get("MPOST_CACHE_MB", "64")) * 1024 * 1024,
+    disk_dir=os.environ.get("MPOST_CACHE_DIR") or None,
+    disk_max_bytes=int(os.environ.get("MPOST_CACHE_DISK_MB", "256")) * 1024 * 1024,
+)
+
+compile_limits = Limits(
+    timeout=float(os.environ.get("MPOST_TIMEOUT", "60")),
+    cpu_seconds=int(os.environ.get("MPOST_CPU_SECONDS", "30")),
+    address_space_mb=int(os.environ.get("MPOST_MEMORY_MB", "512")),
+    file_size_mb=int(os.environ.get("MPOST_FILE_SIZE_MB", "16")),
+    processes=int(os.environ.get("MPOST_MAX_PROCESSES", "0")),
+    max_svg_bytes=int(os.environ.get("MPOST_MAX_SVG_KB", "4096")) * 1024,
+    max_log_bytes=int(os.environ.get("MPOST_MAX_LOG_KB", "256")) * 1024,
+)
+# Live preview gives up early; explicit compiles get the full timeout
+PREVIEW_TIMEOUT = float(os.environ.get("MPOST_TIMEOUT_PREVIEW", "10"))
+RENDER_TIMEOUT = float(os.environ.get("MPOST_TIMEOUT_RENDER", "20"))
+
+compile_pool = CompilePool(
+    workers=int(os.environ.get("MPOST_WORKERS", str(os.cpu_count() or 2))),
+    max_queue=int(os.environ.get("MPOST_MAX_QUEUE", "32")),
+    quotas=ClientQuotas(
+        rate=float(os.environ.get("MPOST_CLIENT_RATE", "2")),
+        burst=float(os.environ.get("MPOST_CLIENT_BURST", "20")),
+    ),
+)
+
+workspace_manager = WorkspaceManager(
+    root=os.environ.get("MPOST_WORKSPACE_ROOT") or None,
+    pool_size=compile_pool.workers,
+    max_age=float(os.environ.get("MPOST_WORKSPACE_MAX_AGE", "300")),
+)
+
+# Preamble dumps run user code, so they get a workspace and the compile limits
+format_manager = FormatManager(
+    MPOST_BIN,
+    os.environ.get("MPOST_FORMATS_DIR")
+    or os.path.join(tempfile.gettempdir(), "mpost-sandbox-formats"),
+    workspace_manager,
+    compile_limits,
+    preamble_threshold=int(os.environ.get("MPOST_PREAMBLE_THRESHOLD", "3")),
+)
+
+MPOST_BACKEND = os.environ.get("MPOST_BACKEND", "subprocess")
+if MPOST_BACKEND == "mplib":
+    compile_backend = MplibBackend(
+        os.environ.get("MPLIB_LUATEX", "luatex"),
+        format_manager,
+        compile_limits,
+        max_jobs=int(os.environ.get("MPLIB_MAX_JOBS", "200")),
+        max_rss_bytes=int(os.environ.get("MPLIB_MAX_RSS_MB", "512")) * 1024 * 1024,
+        tracing_stats=MPOST_TRACING_STATS,
+    )
+else:
+    compile_backend = SubprocessBackend(
+        MPOST_BIN, format_manager, compile_limits, tracing_stats=MPOST_TRACING_STATS
+    )
 
 
-app = FastAPI()
+GITHUB_CLIENT_ID = os.environ.get("GITHUB_CLIENT_ID", "")
+GITHUB_CLIENT_SECRET = os.environ.get("GITHUB_CLIENT_SECRET", "")
+
+github = GitHubClient(
+    api_base=os.environ.get("GITHUB_API_BASE", "https://api.github.com"),
+    oauth_base=os.environ.get("GITHUB_OAUTH_BASE", "https://github.com"),
+    client_id=GITHUB_CLIENT_ID,
+    client_secret=GITHUB_CLIENT_SECRET,
+    timeout=float(os.environ.get("GITHUB_TIMEOUT", "10")),
+    retries=int(os.environ.get("GITHUB_RETRIES", "2")),
+    max_connections=int(os.environ.get("GITHUB_MAX_CONNECTIONS", "20")),
+    metrics=metrics,
+)
+
+gist_cache = GistCache(
+    github,
+    max_entries=int(os.environ.get("GIST_CACHE_SIZE", "512")),
+    fresh=float(os.environ.get("GIST_CACHE_FRESH", "60")),
+    stale=float(os.environ.get("GIST_CACHE_STALE", "86400")),
+)
+
+# Samples come from a local SQLite mirror of the sandbox gists, or straight
+# from GitHub with SAMPLE_STORE=github
+SAMPLE_STORE = os.environ.get("SAMPLE_STORE", "sqlite")
+if SAMPLE_STORE == "sqlite":
+    sample_store = SQLiteSampleStore(
+        os.environ.get("SAMPLE_DB")
+        or os.path.join(tempfile.gettempdir(), "mpost-sandbox-samples.sqlite3"),
+        GitHubSampleStore(gist_cache),
+        max_age=float(os.environ.get("SAMPLE_MAX_AGE", "300")),
+    )
+else:
+    sample_store = GitHubSampleStore(gist_cache)
+
+artifact_store = ArtifactStore(
+    max_bytes=int(os.environ.get("ARTIFACT_CACHE_MB", "64")) * 1024 * 1024
+)
+# Browser and shared (CDN) cache lifetimes of artifacts that follow the latest
+# revision; artifacts pinned with ?rev= never change
+ARTIFACT_MAX_AGE = int(os.environ.get("ARTIFACT_MAX_AGE", "60"))
+ARTIFACT_SHARED_MAX_AGE = int(os.environ.get("ARTIFACT_SHARED_MAX_AGE", "300"))
+
+# Rendered /m/{id}/embed pages, keyed by gist revision and template version
+embed_store = ArtifactStore(
+    max_bytes=int(os.environ.get("EMBED_CACHE_MB", "32")) * 1024 * 1024
+)
+
+# SVG optimizer: on by default for embeds and /m/{id}.svg, opt-in for /api/compile
+SVG_OPTIMIZE = os.environ.get("SVG_OPTIMIZE", "on") == "on"
+SVG_PRECISION = int(os.environ.get("SVG_PRECISION", "3"))
+svg_stats: Dict[str, int] = {"optimized": 0, "bytes_in": 0, "bytes_out": 0}
+
+# PNG thumbnails of the last figure, rendered by mpost at a fixed resolution
+THUMBNAIL_DPI = float(os.environ.get("THUMBNAIL_DPI", "48"))
+thumbnail_store = ArtifactStore(
+    max_bytes=int(os.environ.get("THUMBNAIL_CACHE_MB", "32")) * 1024 * 1024
+)
+
+# Render gists in the background as soon as they are saved, so the first
+# visitors of a freshly shared link find the caches warm
+PRERENDER_ON_SAVE = os.environ.get("PRERENDER_ON_SAVE", "on") == "on"
+prerender_tasks: Set[asyncio.Task] = set()
+prerender_stats: Dict[str, int] = {"queued": 0, "rendered": 0, "failed": 0}
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Resolve the compiler version and build the formats once, off the event loop
+    loop = asyncio.get_running_loop()
+    await loop.run_in_executor(None, compiler_version)
+    # Formats are dumped in workspaces
+    workspace_manager.start()
+    await loop.run_in_executor(None, format_manager.prepare)
+    warn_missing_packages()
+    if STATIC_FINGERPRINT:
+        await loop.run_in_executor(None, assets.build)
+    await github.start()
+    global gallery_limit
+    gallery_limit = asyncio.Semaphore(GALLERY_CONCURRENCY)
+    yield
+    for task in list(prerender_tasks):
+        task.cancel()
+    await asyncio.gather(*prerender_tasks, return_exceptions=True)
+    await sample_store.close()
+    await gist_cache.close()
+    await github.close()
+    compile_pool.shutdown()
+    compile_backend.close()
+    format_manager.close()
+    workspace_manager.close()
+
+
+app = FastAPI(lifespan=lifespan)
+app.add_middleware(
+    TimingMiddleware, header=SERVER_TIMING, log=TIMING_LOG, phases=phase_seconds
+)
+app.add_middleware(
+    MetricsMiddleware, duration=request_seconds, in_flight=requests_in_flight
+)
 
 app.mount("/static", StaticFiles(directory="static"), name="static")
 templates = Jinja2Templates(directory="templates")
 
+# Scripts and stylesheets are minified, fingerprinted and precompressed at
+# startup and linked from the templates with asset("main.js")
+STATIC_FINGERPRINT = os.environ.get("STATIC_FINGERPRINT", "on") == "on"
+assets = AssetManifest("static")
+templates.env.globals["asset"] = assets.url
+
 PLACEHOLDER = """
 beginfig(0);
 width:=100;
@@ -63,76 +341,351 @@ end
 """
 
 
-def get_unique_file_name():
-    return uuid.uuid4().urn[9:15]
+@functools.lru_cache(maxsize=None)
+def compiler_version() -> str:
+    """Backend name and version, part of every compile cache key"""
+    return f"{compile_backend.name}: {compile_backend.version()}"
 
 
-def remove_temp_files(id: str):
-    temp_dir: str = tempfile.gettempdir()
-    # Remove the temporary files
-    extensions: list = [".mp", ".svg", ".log"]
-    for ext in extensions:
-        file_path = os.path.join(temp_dir, id + ext)
-        if os.path.exists(file_path):
-            os.remove(file_path)
+def normalize_source(mp_code: str) -> str:
+    """Normalize line endings and trailing whitespace, and make sure the program ends"""
+    lines = [line.rstrip() for line in mp_code.replace("\r\n", "\n").split("\n")]
+    # Leading blank lines stay, so that line numbers in the log match the editor
+    mp_code = "\n".join(lines).rstrip("\n") + "\n"
+    if needs_end(mp_code):
+        mp_code += "end\n"
+    return mp_code
 
 
-def mpost(mp_code: str) -> MetapostResponse:
-    id: str = get_unique_file_name()
-    temp_dir: str = tempfile.gettempdir()
-    if not mp_code.strip().endswith("end"):
-        mp_code += "\nend\n"
+# "on" rejects broken sources before they reach mpost, "report" only counts
+# what would have been rejected and checks that against mpost's verdict
+MPOST_LINT = os.environ.get("MPOST_LINT", "on")
+lint_stats: Dict[str, int] = {
+    "checked": 0,
+    "rejected": 0,
+    "would_reject": 0,
+    "confirmed": 0,
+    "false_positives": 0,
+}
 
-    if "plain_ex" in mp_code:
-        shutil.copyfile(
-            os.path.join("static", "plain_ex.mp"), os.path.join(temp_dir, "plain_ex.mp")
-        )
 
-    with open(os.path.join(temp_dir, id + ".mp"), "w") as file_object:
-        file_object.write(mp_code)
-        file_object.close()
-    command_line: str = f"/usr/bin/mpost -s 'outputformat=\"svg\"' -s 'outputtemplate=\"{id}.svg\"' {id}.mp"
-    cmd: list = shlex.split(command_line)
-
-    process: subprocess.Popen = subprocess.Popen(
-        cmd,
-        stdin=subprocess.PIPE,
-        stdout=subprocess.PIPE,
-        stderr=subprocess.PIPE,
-        cwd=temp_dir,
+def get_unique_file_name():
+    return uuid.uuid4().hex
+
+
+def thumbnail_etag(key: str) -> str:
+    """Strong validator of a thumbnail, from the compile cache key of its source"""
+    digest = hashlib.sha256(f"{key}\0png@{THUMBNAIL_DPI:g}".encode("utf-8"))
+    return f'"{digest.hexdigest()[:32]}"'
+
+
+def mpost(
+    mp_code: str,
+    cancel: Optional[CancelToken] = None,
+    timeout: Optional[float] = None,
+    thumbnail: bool = False,
+) -> MetapostResponse:
+    """Compile metapost code, reusing cached results for identical sources.
+
+    With thumbnail, a PNG of the last figure is also rendered into the
+    thumbnail store unless it is there already.
+    """
+    mp_code = normalize_source(mp_code)
+    key: str = cache_key(mp_code, compiler_version())
+    limits: Limits = compile_limits.with_timeout(timeout)
+    result: dict = compile_cache.get_or_compute(
+        key,
+        lambda: cache_value(run_mpost(mp_code, cancel, limits)),
+        # Timeouts and resource-limit kills (negative codes) depend on the
+        # route's limits and the load, not only on the source
+        cacheable=lambda result: result["error"] >= 0,
     )
-    stdout: bytes
-    stderr: bytes
+    response = cached_response(result)
+    if thumbnail and response.error == 0 and thumbnail_etag(key) not in thumbnail_store:
+        png = run_thumbnail(mp_code, cancel, limits)
+        if png:
+            thumbnail_store.put(
+                Artifact(thumbnail_etag(key), "image/png", {"identity": png})
+            )
+    return response
+
+
+def client_id(request: HTTPConnection) -> str:
+    """Identify a client for fair scheduling: GitHub login cookie, else address"""
+    github_token = request.cookies.get("github_token")
+    if github_token:
+        return "gh:" + hashlib.sha256(github_token.encode("utf-8")).hexdigest()[:16]
+    return "ip:" + (request.client.host if request.client else "unknown")
+
+
+class CompileFlight:
+    """A compile queued or running in the pool and the requests waiting for it"""
+
+    def __init__(self):
+        self.future: asyncio.Future = asyncio.get_running_loop().create_future()
+        # An abandoned flight may fail with nobody left to see it
+        self.future.add_done_callback(lambda f: f.cancelled() or f.exception())
+        # Cancelled once every waiting request has given up
+        self.token = CancelToken()
+        self.waiters = 0
+        self.task: Optional[asyncio.Task] = None
+
+
+# Compiles in flight by source, timeout and thumbnail. Identical requests wait
+# here on the event loop, so only the first one takes a queue slot and a worker
+compile_flights: Dict[str, CompileFlight] = {}
+flight_stats: Dict[str, int] = {"started": 0, "joined": 0, "abandoned": 0}
+
+
+async def run_flight(
+    flight_key: str,
+    flight: CompileFlight,
+    mp_code: str,
+    timeout: Optional[float],
+    thumbnail: bool,
+    priority: int,
+    client: str,
+):
+    try:
+        result = await compile_pool.run(
+            mpost,
+            mp_code,
+            flight.token,
+            timeout,
+            thumbnail,
+            priority=priority,
+            client=client,
+        )
+    except asyncio.CancelledError:
+        if not flight.future.done():
+            flight.future.set_exception(CompileCancelled(flight.token.reason))
+    except Exception as e:
+        flight.future.set_exception(e)
+    else:
+        flight.future.set_result(result)
+    finally:
+        if compile_flights.get(flight_key) is flight:
+            del compile_flights[flight_key]
+
+
+def leave_flight(flight_key: str, flight: CompileFlight):
+    flight.waiters -= 1
+    if flight.waiters > 0 or flight.future.done():
+        return
+    # Nobody wants this result any more; later requests start afresh
+    flight_stats["abandoned"] += 1
+    if compile_flights.get(flight_key) is flight:
+        del compile_flights[flight_key]
+    flight.token.cancel("abandoned by all waiting clients")
+    flight.task.cancel()
+
+
+async def wait_for_flight(
+    flight_key: str, flight: CompileFlight, cancel: Optional[CancelToken]
+) -> Tuple[MetapostResponse, float]:
+    """Wait for a flight until it lands or the caller's token is cancelled"""
+    loop = asyncio.get_running_loop()
+    cancelled = loop.create_future()
+
+    def wake():
+        if not cancelled.done():
+            cancelled.set_result(None)
+
+    flight.waiters += 1
     try:
-        stdout, stderr = process.communicate(timeout=60)
-    except subprocess.TimeoutExpired:
-        process.kill()
-        stdout, stderr = process.communicate()
-        remove_temp_files(id)
-        return MetapostResponse(
-            id=id,
-            error=-1,
-            stdout="",
-            stderr="Compilation timeout: The process took longer than 60 seconds and was aborted.",
-            svg="",
+        if cancel is not None:
+            # Tokens may be cancelled from any thread
+            cancel.on_cancel(lambda: loop.call_soon_threadsafe(wake))
+        await asyncio.wait(
+            {flight.future, cancelled}, return_when=asyncio.FIRST_COMPLETED
         )
+        if not flight.future.done():
+            raise CompileCancelled(cancel.reason)
+        return flight.future.result()
+    finally:
+        wake()
+        leave_flight(flight_key, flight)
+
+
+async def compile_async(
+    mp_code: str,
+    cancel: Optional[CancelToken] = None,
+    priority: int = INTERACTIVE,
+    client: str = "",
+    timeout: Optional[float] = None,
+    thumbnail: bool = False,
+) -> Tuple[MetapostResponse, float]:
+    """Compile in the worker pool. Returns the result and the seconds spent queued"""
+    start = time.perf_counter()
+    route = route_name(current_scope.get())
+    with timing.span("cache"):
+        mp_code = normalize_source(mp_code)
+        key: str = cache_key(mp_code, compiler_version())
+        cached = compile_cache.peek(key)
+    if cached is not None and (
+        not thumbnail or cached["error"] != 0 or thumbnail_etag(key) in thumbnail_store
+    ):
+        compile_seconds.observe(time.perf_counter() - start, route, "cache")
+        result = cached_response(cached)
+        timing.note("capacity", result.capacity)
+        return result, 0.0
+
+    limit = timeout if timeout is not None else compile_limits.timeout
+    flight_key = f"{key}:{limit:g}:{thumbnail}"
+    flight = compile_flights.get(flight_key)
+    if flight is not None:
+        flight_stats["joined"] += 1
+        result, waited = await wait_for_flight(flight_key, flight, cancel)
+        compile_seconds.observe(time.perf_counter() - start, route, "coalesced")
+        timing.note("capacity", result.capacity)
+        return result, waited
+
+    errors = []
+    if MPOST_LINT in ("on", "report"):
+        lint_stats["checked"] += 1
+        with timing.span("lint"):
+            errors = lint(mp_code).errors
+        if errors and MPOST_LINT == "on":
+            # Every rejection here is an mpost spawn saved
+            lint_stats["rejected"] += 1
+            compile_seconds.observe(time.perf_counter() - start, route, "lint")
+            return (
+                MetapostResponse(
+                    id=get_unique_file_name(),
+                    error=1,
+                    stdout=format_diagnostics(mp_code, errors),
+                    stderr="",
+                    svg="",
+                ),
+                0.0,
+            )
 
-    svgcontent = ""
-    if process.returncode == 0:
-        svg_path = os.path.join(temp_dir, id + ".svg")
-        if os.path.exists(svg_path):
-            with open(svg_path, "r") as svg_file_object:
-                svgcontent = svg_file_object.read()
-    remove_temp_files(id)
+    flight = CompileFlight()
+    compile_flights[flight_key] = flight
+    flight_stats["started"] += 1
+    # A task of its own, so the compile outlives this request if others wait for it
+    flight.task = asyncio.ensure_future(
+        run_flight(flight_key, flight, mp_code, timeout, thumbnail, priority, client)
+    )
+    result, waited = await wait_for_flight(flight_key, flight, cancel)
+    queue_wait_seconds.observe(waited, route)
+    compile_seconds.observe(time.perf_counter() - start, route, "pool")
+    timing.record("queue", waited)
+    timing.note("capacity", result.capacity)
+    if errors:
+        lint_stats["would_reject"] += 1
+        lint_stats["confirmed" if result.error != 0 else "false_positives"] += 1
+    return result, waited
+
+
+def run_mpost(
+    mp_code: str, cancel: Optional[CancelToken] = None, limits: Optional[Limits] = None
+) -> MetapostResponse:
+    id: str = get_unique_file_name()
+    if cancel is not None:
+        # Jobs cancelled while they were queued never start
+        cancel.raise_if_cancelled()
+    with workspace_manager.lease() as workspace:
+        result = compile_backend.compile(workspace.path, id, mp_code, cancel, limits)
+    record_run(result, "svg")
+    timing.record_laps(result.timings, "mpost-")
     return MetapostResponse(
         id=id,
-        error=process.returncode,
-        stdout=stdout.decode("utf-8"),
-        stderr=stderr.decode("utf-8"),
-        svg=svgcontent,
+        error=result.returncode,
+        stdout=result.stdout,
+        stderr=result.stderr,
+        svg=result.svg,
+        stdout_truncated=result.stdout_truncated,
+        svg_truncated=result.svg_truncated,
+        figures=[MetapostFigure(number, svg) for number, svg in result.figures],
+        capacity=result.capacity,
     )
 
 
+def cache_value(response: MetapostResponse) -> dict:
+    """A compile result for the cache, its svg kept only as a figure number"""
+    value = dataclasses.asdict(response)
+    for figure in value["figures"]:
+        if value["svg"] and figure["svg"] == value["svg"]:
+            value["svg"], value["svg_figure"] = "", figure["number"]
+            break
+    return value
+
+
+def cached_response(value: dict) -> MetapostResponse:
+    """The compile result stored by cache_value"""
+    value = dict(value)
+    number = value.pop("svg_figure", None)
+    response = MetapostResponse(**value)
+    for figure in response.figures:
+        if figure.number == number:
+            response.svg = figure.svg
+    return response
+
+
+def record_run(result: BackendResult, outputformat: str):
+    mpost_runs.inc(outputformat, str(result.returncode))
+    if result.timed_out:
+        mpost_timeouts.inc(outputformat)
+    log_bytes.observe(len(result.stdout) + len(result.stderr))
+    if result.returncode == 0 and result.svg:
+        svg_bytes.observe(len(result.svg))
+
+
+async def optimize_svg(svg: str) -> Tuple[str, int]:
+    """Optimize an SVG off the event loop. Returns it and the bytes saved"""
+    if not svg:
+        return svg, 0
+    loop = asyncio.get_running_loop()
+    with timing.span("optimize"):
+        optimized = await loop.run_in_executor(
+            None, svgopt.optimize, svg, SVG_PRECISION
+        )
+    before, after = len(svg.encode("utf-8")), len(optimized.encode("utf-8"))
+    svg_stats["optimized"] += 1
+    svg_stats["bytes_in"] += before
+    svg_stats["bytes_out"] += after
+    return optimized, before - after
+
+
+def run_thumbnail(
+    mp_code: str, cancel: Optional[CancelToken] = None, limits: Optional[Limits] = None
+) -> bytes:
+    """Render the last figure as a PNG. Returns nothing if that fails"""
+    id: str = get_unique_file_name()
+    if cancel is not None:
+        cancel.raise_if_cancelled()
+    with workspace_manager.lease() as workspace:
+        result = compile_backend.compile(
+            workspace.path,
+            id,
+            mp_code,
+            cancel,
+            limits,
+            outputformat="png",
+            resolution=THUMBNAIL_DPI,
+        )
+    record_run(result, "png")
+    timing.record_laps(result.timings, "thumbnail-")
+    return result.png if result.returncode == 0 else b""
+
+
+@app.get("/assets/{name}")
+async def asset_file(name: str, request: Request):
+    """A fingerprinted static file; its URL changes with its content"""
+    artifact = assets.get(name)
+    if artifact is None:
+        return JSONResponse({"message": "Asset not found"}, status_code=404)
+    headers = {
+        "ETag": artifact.etag,
+        "Cache-Control": "public, max-age=31536000, immutable",
+        "Vary": "Accept-Encoding",
+    }
+    if etag_matches(request.headers.get("if-none-match", ""), artifact.etag):
+        return Response(status_code=304, headers=headers)
+    return artifact_response(request, artifact, headers)
+
+
 @app.get("/", response_class=HTMLResponse)
 async def root_view(request: Request):
     context = {
@@ -159,42 +712,426 @@ async def about_view(request: Request):
     return templates.TemplateResponse("about.html", context=context)
 
 
+# Latest compile per editor session, so that a newer one supersedes it
+compile_sessions: Dict[str, CancelToken] = {}
+
+
+def figure_numbers(value) -> Optional[set]:
+    """Parse the figures a client asked for; None means all of them"""
+    if value is None:
+        return None
+    if not isinstance(value, list):
+        raise TypeError("not a list")
+    return {int(number) for number in value}
+
+
+def select_figures(result: MetapostResponse, wanted: Optional[set]) -> List[dict]:
+    return [
+        dataclasses.asdict(figure)
+        for figure in result.figures
+        if wanted is None or figure.number in wanted
+    ]
+
+
+async def wait_unless_disconnected(request: Request, task: asyncio.Task, token):
+    """Await task, cancelling it if the client goes away in the meantime"""
+    while True:
+        done, _ = await asyncio.wait({task}, timeout=0.25)
+        if done:
+            return task.result()
+        if await request.is_disconnected():
+            token.cancel("client disconnected")
+            task.cancel()
+            raise CompileCancelled(token.reason)
+
+
 @app.post("/api/compile")
 async def compile(request: Request) -> Response:
-    request_obj: dict = await request.json()
+    with timing.span("parse"):
+        request_obj: dict = await request.json()
 
     mp_code: str = request_obj["code"]
+    session: Optional[str] = request_obj.get("session")
+    timeout: Optional[float] = (
+        PREVIEW_TIMEOUT if request_obj.get("mode") == "preview" else None
+    )
+    optimize: bool = bool(request_obj.get("optimize", False))
+    try:
+        wanted = figure_numbers(request_obj.get("figures"))
+    except (TypeError, ValueError):
+        return JSONResponse(
+            {"message": "figures must be a list of figure numbers"}, status_code=400
+        )
 
-    result: MetapostResponse = mpost(mp_code)
+    token = CancelToken()
+    if session:
+        previous = compile_sessions.get(session)
+        if previous is not None:
+            previous.cancel("superseded by a newer compile")
+        compile_sessions[session] = token
+    try:
+        task = asyncio.ensure_future(
+            compile_async(mp_code, token, INTERACTIVE, client_id(request), timeout)
+        )
+        result, waited = await wait_unless_disconnected(request, task, token)
+    except QueueFullError as e:
+        return JSONResponse(
+            {"message": str(e), "queue": compile_pool.stats()},
+            status_code=503,
+            headers={"Retry-After": str(e.retry_after)},
+        )
+    except RateLimitedError as e:
+        return JSONResponse(
+            {"message": str(e)},
+            status_code=429,
+            headers={"Retry-After": str(e.retry_after)},
+        )
+    except CompileCancelled as e:
+        # 499 is what proxies log for requests the client closed
+        return JSONResponse(
+            {"message": f"Compilation cancelled: {e}"},
+            status_code=409 if token.reason.startswith("superseded") else 499,
+        )
+    finally:
+        if session and compile_sessions.get(session) is token:
+            del compile_sessions[session]
+    queue_headers: dict = {
+        "X-Compile-Queue-Depth": str(compile_pool.queued),
+        "X-Compile-Queue-Wait": f"{waited * 1000:.1f}ms",
+    }
     if result.error != 0:
-        return Response(
-            content=json.dumps(
+        with timing.span("serialize"):
+            content = json.dumps(
                 {
                     "stdout": result.stdout,
                     "stderr": result.stderr,
+                    "stdout_truncated": result.stdout_truncated,
+                    "svg_truncated": result.svg_truncated,
+                    "capacity": result.capacity,
                 }
-            ),
+            )
+        return Response(
+            content=content,
             media_type="application/json",
             status_code=400,
+            headers=queue_headers,
+        )
+
+    svg: str = result.svg
+    figures: List[dict] = select_figures(result, wanted)
+    if optimize:
+        svg, saved = await optimize_svg(svg)
+        for figure in figures:
+            figure["svg"], figure_saved = await optimize_svg(figure["svg"])
+            saved += figure_saved
+        queue_headers["X-SVG-Bytes-Saved"] = str(saved)
+
+    with timing.span("serialize"):
+        responsejson: dict = json.dumps(
+            {
+                "id": result.id,
+                "svg": svg,
+                "figures": figures,
+                "stdout": result.stdout,
+                "stderr": result.stderr,
+                "stdout_truncated": result.stdout_truncated,
+                "capacity": result.capacity,
+            }
         )
 
-    responsejson: dict = json.dumps(
+    response: Response = Response(
+        content=responsejson, media_type="application/json", headers=queue_headers
+    )
+    return response
+
+
+live_stats: Dict[str, int] = {
+    "sessions": 0,
+    "open": 0,
+    "compiles": 0,
+    "coalesced": 0,
+    "unchanged": 0,
+    "deltas": 0,
+    "full": 0,
+    "full_bytes": 0,
+    "sent_bytes": 0,
+}
+
+
+@app.websocket("/ws/compile")
+async def compile_socket(websocket: WebSocket):
+    """Live compile session of the editor; /api/compile remains the fallback"""
+    await websocket.accept()
+    client = client_id(websocket)
+
+    async def compile(code: str, token: CancelToken, preview: bool):
+        timeout = PREVIEW_TIMEOUT if preview else None
+        result, _ = await compile_async(code, token, INTERACTIVE, client, timeout)
+        return result
+
+    session = LiveSession(compile, websocket.send_text, live_stats)
+    runner = asyncio.create_task(session.run())
+    live_stats["sessions"] += 1
+    live_stats["open"] += 1
+    try:
+        while True:
+            try:
+                session.receive(await websocket.receive_json())
+            except (ValueError, AttributeError) as e:
+                # Malformed JSON or message; the session goes on
+                await websocket.send_text(
+                    json.dumps({"type": "error", "message": str(e)})
+                )
+    except WebSocketDisconnect:
+        pass
+    finally:
+        live_stats["open"] -= 1
+        session.close()
+        runner.cancel()
+        await asyncio.gather(runner, return_exceptions=True)
+
+
+BATCH_MAX_ITEMS = int(os.environ.get("MPOST_BATCH_MAX_ITEMS", "100"))
+# Items of one batch compiling at once; the rest wait in the batch, not the pool queue
+BATCH_CONCURRENCY = int(
+    os.environ.get("MPOST_BATCH_CONCURRENCY", str(compile_pool.workers))
+)
+
+
+async def compile_batch_item(
+    index: int,
+    name: str,
+    mp_code: str,
+    token: CancelToken,
+    client: str,
+    timeout: Optional[float],
+    optimize: bool,
+    wanted: Optional[set],
+    limit: asyncio.Semaphore,
+) -> dict:
+    """Compile one batch item into its result line; failures never raise"""
+    start = time.monotonic()
+    line: dict = {"index": index, "name": name}
+    key = cache_key(normalize_source(mp_code), compiler_version())
+    line["cached"] = compile_cache.peek(key) is not None
+    try:
+        if line["cached"]:
+            result, _ = await compile_async(mp_code, token, BACKGROUND, client, timeout)
+        else:
+            async with limit:
+                result, _ = await compile_async(
+                    mp_code, token, BACKGROUND, client, timeout
+                )
+    except (QueueFullError, RateLimitedError, CompileCancelled) as e:
+        line.update(ok=False, error=type(e).__name__, message=str(e))
+    except Exception as e:
+        print(f"Batch item {name} failed: {e}")
+        line.update(ok=False, error=type(e).__name__, message=str(e))
+    else:
+        svg = result.svg
+        figures = select_figures(result, wanted)
+        if optimize and result.error == 0:
+            svg, line["svg_bytes_saved"] = await optimize_svg(svg)
+            for figure in figures:
+                figure["svg"], saved = await optimize_svg(figure["svg"])
+                line["svg_bytes_saved"] += saved
+        line.update(
+            ok=result.error == 0,
+            error=result.error,
+            id=result.id,
+            svg=svg if result.error == 0 else None,
+            figures=figures,
+            stdout=result.stdout,
+            stderr=result.stderr,
+            stdout_truncated=result.stdout_truncated,
+            svg_truncated=result.svg_truncated,
+            capacity=result.capacity,
+        )
+    line["elapsed_ms"] = round((time.monotonic() - start) * 1000, 1)
+    return line
+
+
+@app.post("/api/compile/batch")
+async def compile_batch(request: Request) -> Response:
+    """Compile many sources, streaming one NDJSON line per item as it finishes.
+
+    The body is {"items": [{"name": ..., "code": ...}, ...], "options":
+    {"mode": "preview", "timeout": seconds, "optimize": bool, "figures":
+    [numbers]}}. Items are
+    compiled at background priority and the batch is charged to the client's
+    quota once. The last line summarizes the batch.
+    """
+    try:
+        request_obj: dict = await request.json()
+        items: list = request_obj["items"]
+        options: dict = request_obj.get("options") or {}
+        sources = [
+            (str(item.get("name", index)), item["code"])
+            for index, item in enumerate(items)
+        ]
+        if not all(isinstance(code, str) for _, code in sources):
+            raise TypeError("code must be a string")
+        timeout: Optional[float] = None
+        if options.get("mode") == "preview":
+            timeout = PREVIEW_TIMEOUT
+        if options.get("timeout") is not None:
+            timeout = min(float(options["timeout"]), compile_limits.timeout)
+        wanted = figure_numbers(options.get("figures"))
+    except (ValueError, KeyError, TypeError, AttributeError) as e:
+        return JSONResponse({"message": f"Invalid batch: {e}"}, status_code=400)
+    if len(sources) > BATCH_MAX_ITEMS:
+        return JSONResponse(
+            {"message": f"A batch holds at most {BATCH_MAX_ITEMS} items"},
+            status_code=413,
+        )
+
+    client = client_id(request)
+    try:
+        compile_pool.quotas.charge(client)
+    except RateLimitedError as e:
+        return JSONResponse(
+            {"message": str(e)},
+            status_code=429,
+            headers={"Retry-After": str(e.retry_after)},
+        )
+
+    optimize = bool(options.get("optimize", False))
+    token = CancelToken()
+    limit = asyncio.Semaphore(BATCH_CONCURRENCY)
+    tasks = [
+        asyncio.ensure_future(
+            compile_batch_item(
+                index, name, code, token, client, timeout, optimize, wanted, limit
+            )
+        )
+        for index, (name, code) in enumerate(sources)
+    ]
+
+    async def stream():
+        start = time.monotonic()
+        failed = 0
+        try:
+            for next_line in asyncio.as_completed(tasks):
+                line = await next_line
+                failed += not line["ok"]
+                yield json.dumps(line) + "\n"
+            summary = {
+                "done": True,
+                "count": len(tasks),
+                "failed": failed,
+                "elapsed_ms": round((time.monotonic() - start) * 1000, 1),
+            }
+            yield json.dumps(summary) + "\n"
+        finally:
+            # Also runs when the client goes away mid-stream
+            if not all(task.done() for task in tasks):
+                token.cancel("client disconnected")
+                for task in tasks:
+                    task.cancel()
+
+    return StreamingResponse(stream(), media_type="application/x-ndjson")
+
+
+@app.get("/api/compile/stats")
+async def compile_stats():
+    """Compile queue and cache statistics"""
+    return JSONResponse(
         {
-            "id": result.id,
-            "svg": result.svg,
-            "stdout": result.stdout,
-            "stderr": result.stderr,
+            "backend": compile_backend.name,
+            "queue": compile_pool.stats(),
+            "cache": compile_cache.stats(),
+            "flights": {"inflight": len(compile_flights), **flight_stats},
+            "formats": format_manager.stats(),
+            "lint": {"mode": MPOST_LINT, **lint_stats},
+            "github": github.stats(),
+            "gists": gist_cache.stats(),
+            "samples": {"store": SAMPLE_STORE, **(await sample_store.stats())},
+            "artifacts": artifact_store.stats(),
+            "thumbnails": thumbnail_store.stats(),
+            "embeds": embed_store.stats(),
+            "svg_optimizer": {"enabled": SVG_OPTIMIZE, **svg_stats},
+            "live": live_stats,
+            "prerender": {"enabled": PRERENDER_ON_SAVE, **prerender_stats},
+            "workspaces": workspace_manager.stats(),
+            "assets": {"enabled": STATIC_FINGERPRINT, **assets.stats()},
         }
     )
 
-    response: Response = Response(content=responsejson, media_type="application/json")
-    return response
+
+@metrics.collector
+def cache_metrics():
+    """Lookups of every cache by outcome; hit ratios are hits over the sum"""
+    caches = {
+        "compile": (
+            {**compile_cache.stats(), "coalesced": flight_stats["joined"]},
+            ("hits", "disk_hits", "misses", "coalesced"),
+        ),
+        "gist": (
+            gist_cache.stats(),
+            ("hits", "stale_hits", "misses", "not_modified", "outage_hits"),
+        ),
+        "sample": (sample_store.lookups(), ("hits", "stale_hits", "misses")),
+        "artifact": (artifact_store.stats(), ("hits", "misses")),
+        "thumbnail": (thumbnail_store.stats(), ("hits", "misses")),
+        "embed": (embed_store.stats(), ("hits", "misses")),
+        "format": (format_manager.stats(), ("hits",)),
+    }
+    lookups = [
+        ({"cache": cache, "outcome": outcome}, stats[outcome])
+        for cache, (stats, outcomes) in caches.items()
+        for outcome in outcomes
+        if outcome in stats
+    ]
+    entries = [
+        ({"cache": cache}, stats["entries"])
+        for cache, (stats, _) in caches.items()
+        if "entries" in stats
+    ]
+    yield "cache_lookups_total", "counter", "Cache lookups by outcome", lookups
+    yield "cache_entries", "gauge", "Entries held by each cache", entries
+
+
+@metrics.collector
+def compile_metrics():
+    queue = compile_pool.stats()
+    yield "mpost_queue_depth", "gauge", "Compiles waiting for a worker", [
+        ({}, queue["queued"])
+    ]
+    yield "mpost_running", "gauge", "Compiles running", [({}, queue["running"])]
+    yield "mpost_rejected_total", "counter", "Compiles refused", [
+        ({"reason": "queue_full"}, queue["rejected"]),
+        ({"reason": "rate_limited"}, queue["rate_limited"]),
+    ]
+    yield "mpost_flights_total", "counter", "Compiles started, joined or abandoned", [
+        ({"outcome": outcome}, count) for outcome, count in flight_stats.items()
+    ]
+    yield "mpost_spawns_total", "counter", "Processes started by the backend", [
+        ({"backend": compile_backend.name}, compile_backend.spawned)
+    ]
+    yield "mpost_lint_total", "counter", "Sources checked by the linter by verdict", [
+        ({"verdict": verdict}, count) for verdict, count in lint_stats.items()
+    ]
+    yield "live_sessions", "gauge", "Open live compile sessions", [
+        ({}, live_stats["open"])
+    ]
+    github_stats = github.stats()
+    yield "github_requests_total", "counter", "GitHub request attempts", [
+        ({}, github_stats["requests"])
+    ]
+    yield "github_retries_total", "counter", "GitHub requests retried", [
+        ({}, github_stats["retried"])
+    ]
+
+
+@app.get("/metrics")
+def metrics_view():
+    """Metrics for Prometheus to scrape"""
+    return PlainTextResponse(
+        metrics.render(), media_type="text/plain; version=0.0.4; charset=utf-8"
+    )
 
 
 # GitHub OAuth and Gist endpoints
-GITHUB_CLIENT_ID = os.environ.get("GITHUB_CLIENT_ID", "")
-GITHUB_CLIENT_SECRET = os.environ.get("GITHUB_CLIENT_SECRET", "")
-GITHUB_API_BASE = "https://api.github.com"
 
 
 @app.post("/api/auth/github/callback")
@@ -210,17 +1147,7 @@ async def github_callback(request: Request):
             )
 
         # Exchange code for token
-        token_response = requests.post(
-            "https://github.com/login/oauth/access_token",
-            headers={"Accept": "application/json"},
-            data={
-                "client_id": GITHUB_CLIENT_ID,
-                "client_secret": GITHUB_CLIENT_SECRET,
-                "code": code,
-            },
-        )
-
-        token_data = token_response.json()
+        token_data = await github.exchange_code(code)
         access_token = token_data.get("access_token")
 
         if not access_token:
@@ -229,13 +1156,7 @@ async def github_callback(request: Request):
             )
 
         # Get user info
-        user_response = requests.get(
-            f"{GITHUB_API_BASE}/user",
-            headers={
-                "Authorization": f"token {access_token}",
-                "Accept": "application/vnd.github.v3+json",
-            },
-        )
+        user_response = await github.get("/user", token=access_token)
 
         if user_response.status_code != 200:
             return JSONResponse(
@@ -291,12 +1212,10 @@ async def create_gist(request: Request):
         public = data.get("public", True)
         files = data.get("files", {})
 
-        response = requests.post(
-            f"{GITHUB_API_BASE}/gists",
-            headers={
-                "Authorization": f"token {github_token}",
-                "Accept": "application/vnd.github.v3+json",
-            },
+        response = await github.api(
+            "POST",
+            "/gists",
+            token=github_token,
             json={
                 "description": description,
                 "public": public,
@@ -310,7 +1229,11 @@ async def create_gist(request: Request):
                 status_code=response.status_code,
             )
 
-        return JSONResponse(response.json())
+        gist = response.json()
+        gist_cache.invalidate(f"/users/{gist['owner']['login']}/gists")
+        await sample_store.put(gist)
+        schedule_prerender(gist, client_id(request))
+        return JSONResponse(gist)
 
     except Exception as e:
         return JSONResponse(
@@ -330,12 +1253,10 @@ async def update_gist(gist_id: str, request: Request):
         description = data.get("description", "")
         files = data.get("files", {})
 
-        response = requests.patch(
-            f"{GITHUB_API_BASE}/gists/{gist_id}",
-            headers={
-                "Authorization": f"token {github_token}",
-                "Accept": "application/vnd.github.v3+json",
-            },
+        response = await github.api(
+            "PATCH",
+            f"/gists/{gist_id}",
+            token=github_token,
             json={
                 "description": description,
                 "files": files,
@@ -348,7 +1269,13 @@ async def update_gist(gist_id: str, request: Request):
                 status_code=response.status_code,
             )
 
-        return JSONResponse(response.json())
+        gist = response.json()
+        gist_cache.invalidate(f"/gists/{gist_id}")
+        embed_store.invalidate(gist_id)
+        gist_cache.invalidate(f"/users/{gist['owner']['login']}/gists")
+        await sample_store.put(gist)
+        schedule_prerender(gist, client_id(request))
+        return JSONResponse(gist)
 
     except Exception as e:
         return JSONResponse(
@@ -356,252 +1283,440 @@ async def update_gist(gist_id: str, request: Request):
         )
 
 
-@app.get("/m/{sample_id}", response_class=HTMLResponse)
-async def sample_view(sample_id: str, request: Request):
-    """View a metapost sample from GitHub Gist"""
-    try:
-        # Fetch from GitHub Gists API with auth for higher rate limits
-        url = f"{GITHUB_API_BASE}/gists/{sample_id}"
-        response = requests.get(
-            url,
-            auth=(GITHUB_CLIENT_ID, GITHUB_CLIENT_SECRET),
-        )
+REVISION = re.compile(r"[0-9a-f]{40}")
 
-        if response.status_code == 404:
-            context = {"request": request}
-            return templates.TemplateResponse("index.html", context=context)
 
-        if response.status_code != 200:
-            context = {"request": request}
-            return templates.TemplateResponse("index.html", context=context)
+def source_key(code: str) -> str:
+    """Compile cache key of a sample's code"""
+    return cache_key(normalize_source(code), compiler_version())
 
-        gist = response.json()
 
-        # Extract data from gist
-        description = gist.get("description", "")
-        title = (
-            description.replace("#metapost-sandbox", "").strip()
-            if description
-            else "Untitled"
+def artifact_etag(revision: str, code: str) -> str:
+    """Strong validator of the rendering of a revision by the current compiler"""
+    key = source_key(code)
+    digest = hashlib.sha256(f"{revision}\0{key}".encode("utf-8")).hexdigest()
+    return f'"{digest[:32]}"'
+
+
+async def fetch_sample(
+    sample_id: str, rev: str
+) -> Tuple[Optional[Sample], Optional[Response]]:
+    """The sample behind an artifact URL, or the error response to send instead"""
+    if rev and not REVISION.fullmatch(rev):
+        return None, JSONResponse({"message": "Invalid revision"}, status_code=400)
+    try:
+        with timing.span("sample"):
+            if rev:
+                entry = await gist_cache.get(f"/gists/{sample_id}/{rev}")
+                sample = sample_from_gist(entry.data) if entry is not None else None
+            else:
+                sample = await sample_store.get(sample_id)
+    except Exception as e:
+        print(f"Error fetching gist {sample_id}: {e}")
+        return None, JSONResponse(
+            {"message": "GitHub is unavailable"}, status_code=502
         )
+    if sample is None:
+        return None, JSONResponse({"message": "Sample not found"}, status_code=404)
+    return sample, None
+
+
+async def render_sample(sample: Sample, client: str) -> Tuple[str, str, int]:
+    """SVG of the last figure of a sample, from the store if it has it.
+
+    Returns the SVG, or "" and the mpost log if it does not compile, and the
+    mpost error code, negative if the compile timed out or was killed.
+    """
+    key = source_key(sample.code)
+    if sample.svg and sample.svg_key == key:
+        return sample.svg, "", 0
+    result, _ = await compile_async(
+        sample.code, priority=EMBED, client=client, timeout=RENDER_TIMEOUT
+    )
+    if result.error != 0 or not result.svg or result.svg_truncated:
+        return "", compile_log(result), result.error
+    await sample_store.save_svg(sample.id, sample.revision, key, result.svg)
+    return result.svg, "", 0
+
+
+def artifact_cache_control(pinned: bool) -> str:
+    if pinned:
+        return "public, max-age=31536000, immutable"
+    return (
+        f"public, max-age={ARTIFACT_MAX_AGE}, s-maxage={ARTIFACT_SHARED_MAX_AGE}, "
+        "stale-while-revalidate=86400"
+    )
 
-        main_file = gist.get("files", {}).get("main.mp", {})
-        code = main_file.get("content", "")
 
-        context = {
-            "request": request,
-            "id": gist["id"],
-            "title": title,
-            "author": gist["owner"]["login"],
-            "metapost": code,
-            "created": gist["created_at"],
-            "updated": gist["updated_at"],
-        }
-        return templates.TemplateResponse("index.html", context=context)
+def artifact_response(request: Request, artifact: Artifact, headers: dict) -> Response:
+    """Send the best variant of an artifact the client accepts"""
+    encoding, body = negotiate(request.headers.get("accept-encoding", ""), artifact)
+    if encoding != "identity":
+        headers["Content-Encoding"] = encoding
+    return Response(body, media_type=artifact.media_type, headers=headers)
 
-    except Exception:
-        context = {"request": request}
-        return templates.TemplateResponse("index.html", context=context)
 
+def busy_response(e: Exception) -> JSONResponse:
+    return JSONResponse(
+        {"message": str(e)},
+        status_code=503 if isinstance(e, QueueFullError) else 429,
+        headers={"Retry-After": str(e.retry_after)},
+    )
 
-@app.get("/m/{sample_id}/embed", response_class=HTMLResponse)
-async def sample_embed_view(sample_id: str, request: Request):
-    """Embed view of a metapost sample from GitHub Gist"""
-    try:
-        # Fetch from GitHub Gists API with auth for higher rate limits
-        url = f"{GITHUB_API_BASE}/gists/{sample_id}"
-        response = requests.get(
-            url,
-            auth=(GITHUB_CLIENT_ID, GITHUB_CLIENT_SECRET),
-        )
 
-        if response.status_code != 200:
-            context = {"request": request}
-            return templates.TemplateResponse("embed.html", context=context)
+def compile_log(result: MetapostResponse) -> str:
+    """The mpost log of a failed compile, with the reason it was stopped if it was"""
+    return "\n".join(log for log in (result.stdout, result.stderr) if log)
 
-        gist = response.json()
 
-        description = gist.get("description", "")
-        title = (
-            description.replace("#metapost-sandbox", "").strip()
-            if description
-            else "Untitled"
+def render_failed(message: str, error: int) -> Response:
+    # A negative error is a compile that timed out or was killed, not bad code
+    return Response(
+        message or "Compilation failed",
+        status_code=504 if error < 0 else 422,
+        media_type="text/plain",
+        headers={"Cache-Control": "no-store"},
+    )
+
+
+async def store_svg_artifact(etag: str, svg: str) -> Artifact:
+    """Optimize and precompress a rendered SVG, and keep it in the artifact store"""
+    saved = 0
+    if SVG_OPTIMIZE:
+        svg, saved = await optimize_svg(svg)
+    loop = asyncio.get_running_loop()
+    with timing.span("compress"):
+        artifact = await loop.run_in_executor(
+            None, make_artifact, etag, "image/svg+xml", svg.encode("utf-8")
         )
+    artifact.bytes_saved = saved
+    artifact_store.put(artifact)
+    return artifact
+
+
+async def prerender(gist: dict, client: str):
+    """Warm the compile cache and the artifacts of a saved gist"""
+    # GitHub leaves large files out of the response; the routes fetch them
+    if not gist_complete(gist):
+        return
+    sample = sample_from_gist(gist)
+    if not sample.code:
+        return
+    result, _ = await compile_async(
+        sample.code,
+        priority=BACKGROUND,
+        client=client,
+        timeout=RENDER_TIMEOUT,
+        thumbnail=True,
+    )
+    if result.error != 0 or not result.svg or result.svg_truncated:
+        return
+    key = source_key(sample.code)
+    await sample_store.save_svg(sample.id, sample.revision, key, result.svg)
+    etag = artifact_etag(sample.revision, sample.code)
+    if etag not in artifact_store:
+        await store_svg_artifact(etag, result.svg)
+    prerender_stats["rendered"] += 1
+
+
+def schedule_prerender(gist: dict, client: str):
+    if not PRERENDER_ON_SAVE:
+        return
+
+    async def run():
+        try:
+            await prerender(gist, client)
+        except Exception as e:
+            prerender_stats["failed"] += 1
+            print(f"Pre-rendering gist {gist.get('id')} failed: {e!r}")
+
+    task = asyncio.get_running_loop().create_task(run())
+    prerender_tasks.add(task)
+    task.add_done_callback(prerender_tasks.discard)
+    prerender_stats["queued"] += 1
+
+
+@app.get("/m/{sample_id}.svg")
+async def sample_svg(sample_id: str, request: Request, rev: str = ""):
+    """Rendered SVG of a gist, optionally pinned to a revision"""
+    sample, error = await fetch_sample(sample_id, rev)
+    if error is not None:
+        return error
+
+    etag = artifact_etag(rev or sample.revision, sample.code)
+    headers = {
+        "ETag": etag,
+        "Cache-Control": artifact_cache_control(bool(rev)),
+        "Vary": "Accept-Encoding",
+    }
+    if etag_matches(request.headers.get("if-none-match", ""), etag):
+        return Response(status_code=304, headers=headers)
+
+    artifact = artifact_store.get(etag)
+    if artifact is None:
+        try:
+            svg, log, error = await render_sample(sample, client_id(request))
+        except (QueueFullError, RateLimitedError) as e:
+            return busy_response(e)
+        if not svg:
+            return render_failed(log, error)
+        artifact = await store_svg_artifact(etag, svg)
+    headers["X-SVG-Bytes-Saved"] = str(artifact.bytes_saved)
+    return artifact_response(request, artifact, headers)
+
+
+@app.get("/m/{sample_id}/thumb.png")
+async def sample_thumbnail(sample_id: str, request: Request, rev: str = ""):
+    """PNG thumbnail of a gist, for galleries and link previews"""
+    sample, error = await fetch_sample(sample_id, rev)
+    if error is not None:
+        return error
+
+    # Keyed by the source, so revisions that did not change the code share it
+    etag = thumbnail_etag(source_key(sample.code))
+    headers = {"ETag": etag, "Cache-Control": artifact_cache_control(bool(rev))}
+    if etag_matches(request.headers.get("if-none-match", ""), etag):
+        return Response(status_code=304, headers=headers)
+
+    artifact = thumbnail_store.get(etag)
+    if artifact is None:
+        try:
+            result, _ = await compile_async(
+                sample.code,
+                priority=EMBED,
+                client=client_id(request),
+                timeout=RENDER_TIMEOUT,
+                thumbnail=True,
+            )
+        except (QueueFullError, RateLimitedError) as e:
+            return busy_response(e)
+        if result.error != 0:
+            return render_failed(compile_log(result), result.error)
+        artifact = thumbnail_store.get(etag)
+        if artifact is None:
+            return render_failed("Thumbnail rendering failed", 0)
+    return Response(
+        artifact.variants["identity"], media_type=artifact.media_type, headers=headers
+    )
 
-        main_file = gist.get("files", {}).get("main.mp", {})
-        code = main_file.get("content", "")
 
-        # Compile the metapost code
-        result = mpost(code)
-        svg = result.svg if result.error == 0 else None
+@app.get("/m/{sample_id}", response_class=HTMLResponse)
+async def sample_view(sample_id: str, request: Request):
+    """View a metapost sample from GitHub Gist"""
+    try:
+        with timing.span("sample"):
+            sample = await sample_store.get(sample_id)
+
+        if sample is None:
+            context = {"request": request}
+            return templates.TemplateResponse("index.html", context=context)
 
         context = {
             "request": request,
-            "id": gist["id"],
-            "title": title,
-            "metapost": code,
-            "created": gist["created_at"],
-            "updated": gist["updated_at"],
-            "svg": svg,
+            "id": sample.id,
+            "title": sample.title,
+            "author": sample.owner,
+            "metapost": sample.code,
+            "created": sample.created,
+            "updated": sample.updated,
         }
-        return templates.TemplateResponse("embed.html", context=context)
+        return templates.TemplateResponse("index.html", context=context)
 
     except Exception:
         context = {"request": request}
-        return templates.TemplateResponse("embed.html", context=context)
+        return templates.TemplateResponse("index.html", context=context)
 
 
-def get_github_auth_headers():
-    """Get authentication headers for GitHub API requests"""
-    # Use client_id and client_secret for higher rate limits
-    # Format: https://api.github.com/gists?client_id=xxx&client_secret=yyy
-    return {}
+def template_version(name: str) -> str:
+    with open(os.path.join("templates", name), "rb") as f:
+        return hashlib.sha256(f.read()).hexdigest()[:16]
 
 
-@app.get("/u/{username}", response_class=HTMLResponse)
-async def user_view(username: str, request: Request):
-    """View user's metapost gists"""
-    try:
-        # Build URL with authentication for higher rate limits
-        list_url = f"{GITHUB_API_BASE}/users/{username}/gists?per_page=100"
-        # Fetch user's gists from GitHub
-        response = requests.get(
-            list_url, auth=(GITHUB_CLIENT_ID, GITHUB_CLIENT_SECRET), timeout=10
-        )
+# The optimizer settings change the inlined SVG, so they are part of it too
+EMBED_VERSION = f"{template_version('embed.html')}:{SVG_OPTIMIZE}:{SVG_PRECISION}"
+EMBED_MEDIA_TYPE = "text/html; charset=utf-8"
 
-        if response.status_code != 200:
-            print(f"GitHub API error: {response.status_code} - {response.text[:400]}")
-            context = {"request": request, "records": []}
-            return templates.TemplateResponse("user.html", context=context)
 
-        gists = response.json()
-        records: List[MetapostSample] = []
+def embed_etag(sample: Sample) -> str:
+    """Strong validator of the embed page of a sample revision"""
+    key = source_key(sample.code)
+    # The page links the assets by their fingerprinted names
+    version = f"{EMBED_VERSION}:{assets.version}"
+    digest = hashlib.sha256(
+        f"{sample.id}\0{sample.revision}\0{key}\0{version}".encode("utf-8")
+    )
+    return f'"{digest.hexdigest()[:32]}"'
 
-        # Limit to first 20 metapost gists to avoid timeout
-        count = 0
-        max_gists = 20
 
-        for gist in gists:
-            if count >= max_gists:
-                break
+@app.get("/m/{sample_id}/embed", response_class=HTMLResponse)
+async def sample_embed_view(sample_id: str, request: Request):
+    """Embed view of a metapost sample from GitHub Gist"""
+    try:
+        with timing.span("sample"):
+            sample = await sample_store.get(sample_id)
 
-            description = gist.get("description", "")
-            if "#metapost-sandbox" not in description:
-                continue
+        if sample is None:
+            context = {"request": request}
+            return templates.TemplateResponse("embed.html", context=context)
 
-            title = (
-                description.replace("#metapost-sandbox", "").strip()
-                if description
-                else "Untitled"
-            )
+        etag = embed_etag(sample)
+        headers = {
+            "ETag": etag,
+            "Cache-Control": artifact_cache_control(False),
+            "Vary": "Accept-Encoding",
+        }
+        if etag_matches(request.headers.get("if-none-match", ""), etag):
+            return Response(status_code=304, headers=headers)
 
-            # Fetch the full gist to get the content
+        page = embed_store.get(etag)
+        if page is None:
+            # Compile the metapost code, unless the store has its rendering
             try:
-                detail_url = f"{GITHUB_API_BASE}/gists/{gist['id']}"
-
-                gist_detail_response = requests.get(
-                    detail_url,
-                    auth=(GITHUB_CLIENT_ID, GITHUB_CLIENT_SECRET),
-                    timeout=60,
+                svg, _, error = await render_sample(sample, client_id(request))
+                # Like mpost(), keep nothing of a compile that timed out or died
+                transient = error < 0
+            except (QueueFullError, RateLimitedError):
+                svg, transient = "", True
+            saved = 0
+            if svg and SVG_OPTIMIZE:
+                svg, saved = await optimize_svg(svg)
+
+            context = {
+                "request": request,
+                "id": sample.id,
+                "title": sample.title,
+                "metapost": sample.code,
+                "created": sample.created,
+                "updated": sample.updated,
+                "svg": svg or None,
+            }
+            if transient:
+                # Not cached, the next view may find a free worker or more time
+                return templates.TemplateResponse(
+                    "embed.html", context=context, headers={"Cache-Control": "no-store"}
                 )
-                if gist_detail_response.status_code != 200:
-                    continue
-
-                gist_detail = gist_detail_response.json()
-                main_file = gist_detail.get("files", {}).get("main.mp", {})
-                code = main_file.get("content", "")
-
-                # Compile for SVG preview
-                result = mpost(code)
-                svg = result.svg if result.error == 0 else None
-
-                record = MetapostSample(
-                    id=gist["id"],
-                    author=gist["owner"]["login"],
-                    title=title,
-                    metapost=code,
-                    created=gist["created_at"],
-                    updated=gist["updated_at"],
-                    svg=svg,
+            with timing.span("template"):
+                html = templates.get_template("embed.html").render(context)
+            loop = asyncio.get_running_loop()
+            with timing.span("compress"):
+                page = await loop.run_in_executor(
+                    None, make_artifact, etag, EMBED_MEDIA_TYPE, html.encode("utf-8")
                 )
-                records.append(record)
-                count += 1
-            except Exception as e:
-                print(f"Error processing gist {gist['id']}: {e}")
-                continue
+            page.bytes_saved = saved
+            page.group = sample.id
+            embed_store.put(page)
+        headers["X-SVG-Bytes-Saved"] = str(page.bytes_saved)
+        return artifact_response(request, page, headers)
 
-        context = {"request": request, "records": records}
-        return templates.TemplateResponse("user.html", context=context)
+    except Exception:
+        context = {"request": request}
+        return templates.TemplateResponse("embed.html", context=context)
 
-    except Exception as e:
-        import traceback
 
-        print(f"Error in user_view: {e}")
-        print(traceback.format_exc())
-        context = {"request": request, "records": []}
-        return templates.TemplateResponse("user.html", context=context)
+GALLERY_PAGE_SIZE = int(os.environ.get("GALLERY_PAGE_SIZE", "12"))
+# Thumbnails pre-rendered at once in the background, across all gallery pages
+GALLERY_CONCURRENCY = int(os.environ.get("GALLERY_CONCURRENCY", "6"))
+# Created in lifespan, on the server's event loop
+gallery_limit: Optional[asyncio.Semaphore] = None
+# Samples whose thumbnail is queued for pre-rendering
+gallery_pending: Set[str] = set()
+
+
+def gallery_sample(sample: Sample) -> MetapostSample:
+    # The browser loads the thumbnail lazily; the endpoint renders it on demand
+    return MetapostSample(
+        id=sample.id,
+        author=sample.owner,
+        title=sample.title,
+        metapost=sample.code or "",
+        created=sample.created,
+        updated=sample.updated,
+        thumbnail=f"/m/{sample.id}/thumb.png",
+    )
 
-        gists = response.json()
-        records: List[MetapostSample] = []
 
-        # Limit to first 20 metapost gists to avoid timeout
-        count = 0
-        max_gists = 20
+async def prerender_thumbnail(sample: Sample, client: str):
+    """Render the thumbnail of a gallery card before the browser asks for it"""
+    async with gallery_limit:
+        if sample.code is None:
+            # Only known from the gist list so far
+            sample = await sample_store.get(sample.id)
+            if sample is None:
+                return
+        if thumbnail_etag(source_key(sample.code)) in thumbnail_store:
+            return
+        await compile_async(
+            sample.code,
+            priority=BACKGROUND,
+            client=client,
+            timeout=RENDER_TIMEOUT,
+            thumbnail=True,
+        )
 
-        for gist in gists:
-            if count >= max_gists:
-                break
 
-            description = gist.get("description", "")
-            if "#metapost-sandbox" not in description:
-                continue
+def schedule_thumbnails(samples: List[Sample], client: str):
+    """Pre-render the thumbnails of a gallery page without waiting for them"""
 
-            title = (
-                description.replace("#metapost-sandbox", "").strip()
-                if description
-                else "Untitled"
-            )
+    async def run(sample: Sample):
+        try:
+            await prerender_thumbnail(sample, client)
+        except QueueFullError:
+            # The pool is busy; the thumbnail endpoint will render it
+            pass
+        except Exception as e:
+            print(f"Pre-rendering the thumbnail of gist {sample.id} failed: {e!r}")
+        finally:
+            gallery_pending.discard(sample.id)
 
-            # Fetch the full gist to get the content
-            try:
-                gist_detail_response = requests.get(
-                    f"{GITHUB_API_BASE}/gists/{gist['id']}",
-                    timeout=5,
-                    auth=(GITHUB_CLIENT_ID, GITHUB_CLIENT_SECRET),
-                )
-                if gist_detail_response.status_code != 200:
-                    continue
-
-                gist_detail = gist_detail_response.json()
-                main_file = gist_detail.get("files", {}).get("main.mp", {})
-                code = main_file.get("content", "")
-
-                # Compile for SVG preview
-                result = mpost(code)
-                svg = result.svg if result.error == 0 else None
-
-                record = MetapostSample(
-                    id=gist["id"],
-                    author=gist["owner"]["login"],
-                    title=title,
-                    metapost=code,
-                    created=gist["created_at"],
-                    updated=gist["updated_at"],
-                    svg=svg,
-                )
-                records.append(record)
-                count += 1
-            except Exception as e:
-                print(f"Error processing gist {gist['id']}: {e}")
-                continue
+    loop = asyncio.get_running_loop()
+    for sample in samples:
+        if sample.id in gallery_pending:
+            # Another page view already queued it
+            continue
+        gallery_pending.add(sample.id)
+        task = loop.create_task(run(sample))
+        prerender_tasks.add(task)
+        task.add_done_callback(prerender_tasks.discard)
 
-        context = {"request": request, "records": records}
-        return templates.TemplateResponse("user.html", context=context)
 
-    except Exception as e:
-        import traceback
+@app.get("/u/{username}", response_class=HTMLResponse)
+async def user_view(username: str, request: Request):
+    """View user's metapost gists. The samples are loaded by user.js"""
+    context = {"request": request, "username": username}
+    return templates.TemplateResponse("user.html", context=context)
 
-        print(f"Error in user_view: {e}")
-        print(traceback.format_exc())
-        context = {"request": request, "records": []}
-        return templates.TemplateResponse("user.html", context=context)
+
+@app.get("/api/u/{username}/samples")
+async def user_samples(username: str, request: Request, cursor: str = ""):
+    """One page of a user's samples with their thumbnail URLs, and the next cursor"""
+    try:
+        with timing.span("sample"):
+            listed, next_cursor = await sample_store.list_user(
+                username, cursor, GALLERY_PAGE_SIZE
+            )
+    except ValueError:
+        return JSONResponse({"message": "Invalid cursor"}, status_code=400)
+    except Exception as e:
+        print(f"Error listing gists of {username}: {e}")
+        return JSONResponse({"message": "GitHub is unavailable"}, status_code=502)
+    if listed is None:
+        return JSONResponse({"message": "User not found"}, status_code=404)
+
+    schedule_thumbnails(listed, client_id(request))
+    samples = [gallery_sample(sample) for sample in listed]
+    return JSONResponse(
+        {
+            "samples": [
+                {
+                    "id": sample.id,
+                    "author": sample.author,
+                    "title": sample.title,
+                    "created": sample.created,
+                    "updated": sample.updated,
+                    "thumbnail": sample.thumbnail,
+                }
+                for sample in samples
+            ],
+            "next": next_cursor,
+        }
+    )
@@ -0,0 +1,251 @@
+"""Metrics in the Prometheus text exposition format.
+
+Hot paths only touch plain counters and histograms: an observation is a
+bisect and a few additions under a lock. Everything the components already
+count in their stats() (caches, queue, backends) is read by collectors
+at scrape time instead, so it costs nothing between scrapes.
+"""
+
+import abc
+import bisect
+import threading
+import time
+from contextvars import ContextVar
+from typing import Callable, Dict, Iterable, List, Optional, Sequence, Tuple
+
+# Seconds, from a cache hit to a compile that runs into the timeout
+LATENCY_BUCKETS = (
+    0.001,
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1,
+    2.5,
+    5,
+    10,
+    30,
+    60,
+)
+SIZE_BUCKETS = tuple(2**power for power in range(8, 24, 2))
+
+# A sample of a collected metric: its labels and value
+Sample = Tuple[Dict[str, str], float]
+# What a collector returns: (name, kind, help, samples) per metric
+Collected = Iterable[Tuple[str, str, str, List[Sample]]]
+
+# ASGI scope of the request being served, to label work done on its behalf
+current_scope: ContextVar[Optional[dict]] = ContextVar("current_scope", default=None)
+
+
+def escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def format_labels(labels: Dict[str, str]) -> str:
+    if not labels:
+        return ""
+    pairs = ",".join(f'{name}="{escape(str(value))}"' for name, value in labels.items())
+    return "{" + pairs + "}"
+
+
+def format_value(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value))
+
+
+def route_name(scope: Optional[dict]) -> str:
+    """Route template of a request, e.g. /m/{sample_id}.svg, to keep labels few"""
+    if scope is None:
+        return "none"
+    path = getattr(scope.get("route"), "path", None)
+    if path:
+        return path
+    # Mounted apps such as /static have no route
+    return scope.get("root_path") or "unmatched"
+
+
+class Metric(abc.ABC):
+    kind = "untyped"
+
+    def __init__(self, name: str, help: str, labels: Sequence[str] = ()):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self._lock = threading.Lock()
+
+    def label_dict(self, values: tuple) -> Dict[str, str]:
+        return dict(zip(self.labels, values))
+
+    @abc.abstractmethod
+    def render(self) -> List[str]:
+        """Exposition lines of every sample"""
+
+
+class Counter(Metric):
+    kind = "counter"
+
+    def __init__(self, name: str, help: str, labels: Sequence[str] = ()):
+        super().__init__(name, help, labels)
+        self._values: Dict[tuple, float] = {}
+
+    def inc(self, *labels: str, amount: float = 1):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+    def render(self) -> List[str]:
+        with self._lock:
+            values = list(self._values.items())
+        return [
+            f"{self.name}{format_labels(self.label_dict(labels))} {format_value(value)}"
+            for labels, value in values
+        ]
+
+
+class Gauge(Counter):
+    kind = "gauge"
+
+    def set(self, *labels: str, value: float):
+        with self._lock:
+            self._values[labels] = value
+
+
+class Histogram(Metric):
+    kind = "histogram"
+
+    def __init__(
+        self,
+        name: str,
+        help: str,
+        labels: Sequence[str] = (),
+        buckets: Sequence[float] = LATENCY_BUCKETS,
+    ):
+        super().__init__(name, help, labels)
+        self.buckets = tuple(buckets)
+        # Per label values: a count per bucket plus +Inf, the sum and the count
+        self._series: Dict[tuple, list] = {}
+
+    def observe(self, value: float, *labels: str):
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(labels)
+            if series is None:
+                series = [[0] * (len(self.buckets) + 1), 0.0, 0]
+                self._series[labels] = series
+            series[0][index] += 1
+            series[1] += value
+            series[2] += 1
+
+    def render(self) -> List[str]:
+        with self._lock:
+            series = [
+                (labels, list(counts), total, count)
+                for labels, (counts, total, count) in self._series.items()
+            ]
+        lines = []
+        bounds = [format_value(bound) for bound in self.buckets + (float("inf"),)]
+        for labels, counts, total, count in series:
+            label_dict = self.label_dict(labels)
+            cumulative = 0
+            for bound, bucket_count in zip(bounds, counts):
+                cumulative += bucket_count
+                bucket_labels = format_labels({**label_dict, "le": bound})
+                lines.append(f"{self.name}_bucket{bucket_labels} {cumulative}")
+            plain = format_labels(label_dict)
+            lines.append(f"{self.name}_sum{plain} {format_value(total)}")
+            lines.append(f"{self.name}_count{plain} {count}")
+        return lines
+
+
+class Registry:
+    def __init__(self):
+        self._metrics: List[Metric] = []
+        self._collectors: List[Callable[[], Collected]] = []
+
+    def counter(self, name: str, help: str, labels: Sequence[str] = ()) -> Counter:
+        return self._add(Counter(name, help, labels))
+
+    def gauge(self, name: str, help: str, labels: Sequence[str] = ()) -> Gauge:
+        return self._add(Gauge(name, help, labels))
+
+    def histogram(
+        self,
+        name: str,
+        help: str,
+        labels: Sequence[str] = (),
+        buckets: Sequence[float] = LATENCY_BUCKETS,
+    ) -> Histogram:
+        return self._add(Histogram(name, help, labels, buckets))
+
+    def collector(self, collect: Callable[[], Collected]):
+        """Register a function called at scrape time for metrics counted elsewhere"""
+        self._collectors.append(collect)
+        return collect
+
+    def render(self) -> str:
+        lines = []
+        for metric in self._metrics:
+            samples = metric.render()
+            if samples:
+                lines.append(f"# HELP {metric.name} {metric.help}")
+                lines.append(f"# TYPE {metric.name} {metric.kind}")
+                lines.extend(samples)
+        for collect in self._collectors:
+            try:
+                collected = list(collect())
+            except Exception as e:
+                print(f"Metrics collector failed: {e!r}")
+                continue
+            for name, kind, help, samples in collected:
+                lines.append(f"# HELP {name} {help}")
+                lines.append(f"# TYPE {name} {kind}")
+                lines.extend(
+                    f"{name}{format_labels(labels)} {format_value(value)}"
+                    for labels, value in samples
+                )
+        return "\n".join(lines) + "\n"
+
+    def _add(self, metric):
+        self._metrics.append(metric)
+        return metric
+
+
+class MetricsMiddleware:
+    """ASGI middleware timing requests by route and counting those in flight"""
+
+    def __init__(self, app, duration: Histogram, in_flight: Gauge):
+        self.app = app
+        self.duration = duration
+        self.in_flight = in_flight
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] not in ("http", "websocket"):
+            await self.app(scope, receive, send)
+            return
+        status = "500"
+
+        async def send_with_status(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = str(message["status"])
+            await send(message)
+
+        token = current_scope.set(scope)
+        start = time.perf_counter()
+        self.in_flight.inc(scope["type"])
+        try:
+            await self.app(scope, receive, send_with_status)
+        finally:
+            self.in_flight.inc(scope["type"], amount=-1)
+            if scope["type"] == "http":
+                self.duration.observe(
+                    time.perf_counter() - start,
+                    route_name(scope),
+                    scope["method"],
+                    status,
+                )
+            current_scope.reset(token)
@@ -0,0 +1,130 @@
+-- Long-lived MetaPost worker for the mplib compile backend.
+--
+-- Run with `luatex --luaonly mplib_worker.lua`. Jobs arrive on stdin as
+--
+--   JOB <workspace> <jobname> <svg|png> <points per pixel> <tracingstats>\n
+--
+-- where <workspace>/<jobname>.mp holds the source. Every job gets a fresh
+-- MetaPost instance, and the reply on stdout is
+--
+--   RESULT <status> <nbytes>\n<terminal output>
+--   FIG <charcode> <nbytes>\n<svg or png>   (once per shipped figure)
+--   LOG 0 <nbytes>\n<end of the log>        (if the instance returned one)
+--   END\n
+--
+-- A line that is not a valid JOB gets a RESULT 3 reply and END.
+
+kpse.set_program_name("mpost")
+
+local mplib = mplib or require("mplib")
+
+local kpse_formats = {
+  mp = "mp",
+  mem = "mp",
+  tfm = "tfm",
+  map = "map",
+  pfb = "type1 fonts",
+  enc = "enc files",
+}
+
+local function file_exists(path)
+  local handle = io.open(path, "rb")
+  if handle then
+    handle:close()
+    return true
+  end
+  return false
+end
+
+-- Like openout_any=p for the mpost binary: files are written in the
+-- workspace only, never by an absolute path or through ".."
+local function writable(name)
+  return name:sub(1, 1) ~= "/" and not name:find("..", 1, true)
+end
+
+local function finder(workspace)
+  return function(name, mode, ftype)
+    if mode == "w" then
+      if not writable(name) then
+        return nil
+      end
+      return workspace .. "/" .. name
+    end
+    if name:sub(1, 1) ~= "/" then
+      local local_path = workspace .. "/" .. name
+      if file_exists(local_path) then
+        return local_path
+      end
+      if ftype == "mp" and file_exists(local_path .. ".mp") then
+        return local_path .. ".mp"
+      end
+    end
+    return kpse.find_file(name, kpse_formats[ftype] or ftype) or name
+  end
+end
+
+local function reply(tag, arg, body)
+  io.stdout:write(string.format("%s %s %d\n", tag, arg, #body))
+  io.stdout:write(body)
+end
+
+-- The end-of-job statistics of tracingstats are the last lines of the log
+local LOG_TAIL_BYTES = 4096
+
+local function run(workspace, jobname, format, ppp, tracingstats)
+  local mp = mplib.new({
+    ini_version = true,
+    find_file = finder(workspace),
+    math_mode = "scaled",
+    job_name = jobname,
+  })
+  if not mp then
+    reply("RESULT", 3, "mplib: failed to create a MetaPost instance\n")
+    return
+  end
+  -- Preload plain silently, like the mpost binary does with its default format
+  mp:execute("input plain;")
+  if format == "png" then
+    mp:execute(string.format("hppp:=%s; vppp:=%s;", ppp, ppp))
+  end
+  if tracingstats == "1" then
+    mp:execute("tracingstats:=1;")
+  end
+  local result = mp:execute("input " .. jobname .. ";") or {}
+  local term = result.term or ""
+  if result.error and result.error ~= "" then
+    term = term .. result.error
+  end
+  reply("RESULT", result.status or 3, term)
+  for _, fig in ipairs(result.fig or {}) do
+    local image
+    if format == "png" then
+      image = fig:png()
+    else
+      image = fig:svg()
+    end
+    reply("FIG", fig:charcode() or 0, image or "")
+  end
+  local final = mp:finish()
+  local log = (result.log or "") .. (type(final) == "table" and final.log or "")
+  if log ~= "" then
+    reply("LOG", 0, log:sub(-LOG_TAIL_BYTES))
+  end
+end
+
+io.stdout:setvbuf("full")
+for line in io.stdin:lines() do
+  local workspace, jobname, format, ppp, tracingstats =
+    line:match("^JOB (%S+) (%S+) (%a+) ([%d.]+) ([01])$")
+  if workspace then
+    local ok, err = pcall(run, workspace, jobname, format, ppp, tracingstats)
+    if not ok then
+      reply("RESULT", 3, "mplib: " .. tostring(err) .. "\n")
+    end
+  else
+    -- Still answered, so the backend never waits for a reply that is not coming
+    reply("RESULT", 3, "mplib: malformed job: " .. line .. "\n")
+  end
+  io.stdout:write("END\n")
+  io.stdout:flush()
+end
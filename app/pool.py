@@ -0,0 +1,229 @@
+"""Bounded worker pool that keeps blocking compiles off the event loop.
+
+At most `workers` jobs run at once in a thread pool. Up to `max_queue`
+further jobs wait for a slot; beyond that, jobs are rejected right away
+with QueueFullError so that latency stays bounded under load.
+
+Waiting jobs are scheduled by priority class first (interactive before
+embed before background). Within a class, clients take turns, so one client
+with many queued jobs cannot delay everybody else. Per-client token buckets
+limit how fast a single client may submit work at all.
+"""
+
+import asyncio
+import contextvars
+import time
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Deque, List, Optional, Tuple
+
+INTERACTIVE = 0
+EMBED = 1
+BACKGROUND = 2
+PRIORITY_NAMES = ["interactive", "embed", "background"]
+
+
+class QueueFullError(Exception):
+    def __init__(self, retry_after: int = 1):
+        super().__init__("Compile queue is full, try again later")
+        self.retry_after = retry_after
+
+
+class RateLimitedError(Exception):
+    def __init__(self, retry_after: int = 1):
+        super().__init__("Too many compile requests, slow down")
+        self.retry_after = retry_after
+
+
+class TokenBucket:
+    def __init__(self, rate: float, burst: float):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+
+    def take(self) -> float:
+        """Take a token. Returns 0 on success, else the seconds until one is available"""
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0
+        return (1 - self.tokens) / self.rate
+
+
+class ClientQuotas:
+    def __init__(self, rate: float = 2, burst: float = 10, max_clients: int = 10000):
+        self.rate = rate
+        self.burst = burst
+        self.max_clients = max_clients
+        self.limited = 0
+        self._buckets: "OrderedDict[str, TokenBucket]" = OrderedDict()
+
+    def charge(self, client: str):
+        if self.rate <= 0:
+            return
+        bucket = self._buckets.pop(client, None) or TokenBucket(self.rate, self.burst)
+        self._buckets[client] = bucket
+        if len(self._buckets) > self.max_clients:
+            # Forget the least recently seen client; its bucket was refilling anyway
+            self._buckets.popitem(last=False)
+        wait = bucket.take()
+        if wait:
+            self.limited += 1
+            raise RateLimitedError(retry_after=max(1, round(wait)))
+
+
+class CompilePool:
+    def __init__(
+        self,
+        workers: int = 4,
+        max_queue: int = 32,
+        quotas: Optional[ClientQuotas] = None,
+    ):
+        self.workers = workers
+        self.max_queue = max_queue
+        self.quotas = quotas or ClientQuotas(rate=0)
+        self.running = 0
+        self.completed = 0
+        self.rejected = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+        # One queue per priority class, each holding a FIFO per client
+        self._queues: List["OrderedDict[str, Deque[asyncio.Future]]"] = [
+            OrderedDict() for _ in PRIORITY_NAMES
+        ]
+        self._queued = 0
+        self._executor = ThreadPoolExecutor(
+            max_workers=workers, thread_name_prefix="mpost"
+        )
+
+    @property
+    def queued(self) -> int:
+        return self._queued
+
+    async def run(
+        self,
+        fn: Callable,
+        *args,
+        priority: int = INTERACTIVE,
+        client: str = "",
+    ) -> Tuple[Any, float]:
+        """Run fn(*args) in the pool. Returns the result and the seconds spent queued"""
+        if client and priority != BACKGROUND:
+            self.quotas.charge(client)
+        start = time.monotonic()
+        await self._acquire(priority, client)
+        waited = time.monotonic() - start
+        self.total_wait += waited
+        self.max_wait = max(self.max_wait, waited)
+        loop = asyncio.get_running_loop()
+        # The job sees the context variables of the caller, e.g. its timeline
+        context = contextvars.copy_context()
+        future = loop.run_in_executor(self._executor, context.run, fn, *args)
+        try:
+            result = await asyncio.shield(future)
+        except asyncio.CancelledError:
+            # The thread cannot be interrupted; hold the slot until it is done
+            await asyncio.wait({future})
+            if not future.cancelled():
+                future.exception()
+            raise
+        finally:
+            self.completed += 1
+            self._release()
+        return result, waited
+
+    def stats(self) -> dict:
+        return {
+            "workers": self.workers,
+            "running": self.running,
+            "queued": self.queued,
+            "queued_by_priority": {
+                name: sum(len(waiters) for waiters in queue.values())
+                for name, queue in zip(PRIORITY_NAMES, self._queues)
+            },
+            "max_queue": self.max_queue,
+            "completed": self.completed,
+            "rejected": self.rejected,
+            "rate_limited": self.quotas.limited,
+            "avg_wait_ms": round(1000 * self.total_wait / max(self.completed, 1), 1),
+            "max_wait_ms": round(1000 * self.max_wait, 1),
+        }
+
+    def shutdown(self):
+        self._executor.shutdown(wait=False)
+
+    async def _acquire(self, priority: int, client: str):
+        if self.running < self.workers and not self._queued:
+            self.running += 1
+            return
+        if self._queued >= self.max_queue and not self._evict_below(priority):
+            self.rejected += 1
+            raise QueueFullError(retry_after=max(1, self._queued // self.workers))
+        waiter = asyncio.get_running_loop().create_future()
+        self._queues[priority].setdefault(client, deque()).append(waiter)
+        self._queued += 1
+        try:
+            await waiter
+        except asyncio.CancelledError:
+            if waiter.done() and not waiter.cancelled():
+                # The slot was handed to us just before we got cancelled
+                self._release()
+            else:
+                self._discard(priority, client, waiter)
+            raise
+
+    def _discard(self, priority: int, client: str, waiter: asyncio.Future):
+        waiters = self._queues[priority].get(client)
+        if waiters is not None and waiter in waiters:
+            waiters.remove(waiter)
+            self._queued -= 1
+            if not waiters:
+                del self._queues[priority][client]
+
+    def _evict_below(self, priority: int) -> bool:
+        """Make room by rejecting the newest job of a lower priority class"""
+        for lower in range(len(self._queues) - 1, priority, -1):
+            queue = self._queues[lower]
+            while queue:
+                client, waiters = next(reversed(queue.items()))
+                waiter = waiters.pop()
+                self._queued -= 1
+                if not waiters:
+                    del queue[client]
+                if waiter.done():
+                    # Cancelled, but its task has not run to leave the queue yet
+                    if self._queued < self.max_queue:
+                        return True
+                    continue
+                self.rejected += 1
+                waiter.set_exception(QueueFullError())
+                return True
+        return False
+
+    def _next_waiter(self):
+        for queue in self._queues:
+            if not queue:
+                continue
+            # Serve the client at the head, then send it to the back of the line
+            client, waiters = next(iter(queue.items()))
+            waiter = waiters.popleft()
+            self._queued -= 1
+            del queue[client]
+            if waiters:
+                queue[client] = waiters
+            return waiter
+        return None
+
+    def _release(self):
+        # Hand the slot directly to the next waiter, keeping `running` unchanged
+        while True:
+            waiter = self._next_waiter()
+            if waiter is None:
+                break
+            if not waiter.done():
+                waiter.set_result(None)
+                return
+        self.running -= 1
@@ -0,0 +1,425 @@
+"""Where samples (sandbox gists) are read from.
+
+`GitHubSampleStore` reads through the gist cache on every call. The
+`SQLiteSampleStore` mirror keeps every sample it sees, from reads and from
+saves, in a local database indexed by owner and update time. Sample views
+and gallery pages are then answered by local queries. GitHub is asked only
+on a miss or once an entry is older than `max_age`; if GitHub cannot be
+reached, the mirrored copy is served however old it is.
+
+Gist listings carry no file contents, so a sample first seen in a listing
+has no code until it is read once.
+"""
+
+import abc
+import asyncio
+import os
+import sqlite3
+import threading
+import time
+from dataclasses import dataclass
+from typing import Dict, List, Optional, Set, Tuple
+
+from app.gists import GistCache
+
+GALLERY_TAG = "#metapost-sandbox"
+
+
+def gist_title(description: str) -> str:
+    return description.replace(GALLERY_TAG, "").strip() if description else "Untitled"
+
+
+def gist_source(gist: dict) -> str:
+    return gist.get("files", {}).get("main.mp", {}).get("content", "")
+
+
+def gist_complete(gist: dict) -> bool:
+    """False if GitHub left part of the code out of a gist response"""
+    return not gist.get("files", {}).get("main.mp", {}).get("truncated")
+
+
+def gist_revision(gist: dict) -> str:
+    history = gist.get("history") or []
+    return history[0]["version"] if history else gist.get("updated_at", "")
+
+
+@dataclass
+class Sample:
+    id: str
+    owner: str
+    description: str
+    created: str
+    updated: str
+    revision: str
+    # None when only known from a gist listing
+    code: Optional[str] = None
+    # Last rendered SVG and the compile cache key of the source it came from
+    svg: Optional[str] = None
+    svg_key: str = ""
+
+    @property
+    def title(self) -> str:
+        return gist_title(self.description)
+
+    @property
+    def tagged(self) -> bool:
+        return GALLERY_TAG in self.description
+
+
+def sample_from_gist(gist: dict, detail: bool = True) -> Sample:
+    """A sample from a gist response; `detail` is False for gist list entries"""
+    return Sample(
+        id=gist["id"],
+        owner=gist["owner"]["login"],
+        description=gist.get("description") or "",
+        created=gist["created_at"],
+        updated=gist["updated_at"],
+        revision=gist_revision(gist),
+        code=gist_source(gist) if detail else None,
+    )
+
+
+class SampleStore(abc.ABC):
+    """Interface of the sample stores"""
+
+    @abc.abstractmethod
+    async def get(self, sample_id: str) -> Optional[Sample]:
+        """The latest revision of a sample, with its code. None if it does not exist"""
+
+    @abc.abstractmethod
+    async def list_user(
+        self, owner: str, cursor: str, limit: int
+    ) -> Tuple[Optional[List[Sample]], Optional[str]]:
+        """The next `limit` sandbox samples of a user and the cursor after them.
+
+        Cursors are opaque strings, "" for the first page. Returns None for
+        an unknown user and raises ValueError for a cursor it cannot read.
+        """
+
+    async def put(self, gist: dict):
+        """Remember a gist we got from GitHub, e.g. the response to a save"""
+
+    async def save_svg(self, sample_id: str, revision: str, svg_key: str, svg: str):
+        """Remember the rendering of a revision, if the store keeps renderings"""
+
+    def lookups(self) -> Dict[str, int]:
+        """Lookup counters by outcome, cheap enough for the metrics collector"""
+        return {}
+
+    async def stats(self) -> dict:
+        return self.lookups()
+
+    async def close(self):
+        pass
+
+
+class GitHubSampleStore(SampleStore):
+    def __init__(self, gists: GistCache, max_scan: int = 5):
+        self.gists = gists
+        # GitHub list pages scanned per gallery request before handing back a cursor
+        self.max_scan = max_scan
+
+    async def get(self, sample_id: str) -> Optional[Sample]:
+        gist = await self.gists.gist(sample_id)
+        return sample_from_gist(gist) if gist is not None else None
+
+    async def list_user(
+        self, owner: str, cursor: str, limit: int
+    ) -> Tuple[Optional[List[Sample]], Optional[str]]:
+        # The cursor is "<page>.<index>", the position of the next unread gist
+        # in the user's gist list
+        page, _, index = cursor.partition(".")
+        page, index = max(int(page or 1), 1), max(int(index or 0), 0)
+        found: List[Sample] = []
+        for _ in range(self.max_scan):
+            listing = await self.listing(owner, page)
+            if listing is None:
+                return None, None
+            gists, more = listing
+            for position in range(index, len(gists)):
+                sample = sample_from_gist(gists[position], detail=False)
+                if not sample.tagged:
+                    continue
+                found.append(sample)
+                if len(found) == limit:
+                    return found, f"{page}.{position + 1}"
+            if not more:
+                return found, None
+            page, index = page + 1, 0
+        return found, f"{page}.0"
+
+    async def listing(self, owner: str, page: int) -> Optional[Tuple[List[dict], bool]]:
+        """One page of a user's gist list, and whether there are more"""
+        entry = await self.gists.get(
+            f"/users/{owner}/gists", params={"per_page": 100, "page": page}
+        )
+        if entry is None:
+            return None
+        return entry.data, 'rel="next"' in entry.link
+
+    async def put(self, gist: dict):
+        if not gist_complete(gist):
+            return
+        self.gists.put(f"/gists/{gist['id']}", gist)
+        revision = gist_revision(gist)
+        if revision != gist.get("updated_at"):
+            # Revision URLs never change, so this entry stays valid
+            self.gists.put(f"/gists/{gist['id']}/{revision}", gist)
+
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS samples (
+    id TEXT PRIMARY KEY,
+    -- GitHub logins are case insensitive
+    owner TEXT NOT NULL COLLATE NOCASE,
+    description TEXT NOT NULL,
+    created TEXT NOT NULL,
+    updated TEXT NOT NULL,
+    revision TEXT NOT NULL,
+    tagged INTEGER NOT NULL,
+    code TEXT,
+    svg TEXT,
+    svg_key TEXT NOT NULL DEFAULT '',
+    synced REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS samples_owner ON samples (owner, tagged, updated, id);
+CREATE INDEX IF NOT EXISTS samples_updated ON samples (updated);
+CREATE TABLE IF NOT EXISTS owners (
+    owner TEXT PRIMARY KEY COLLATE NOCASE,
+    synced REAL NOT NULL
+);
+"""
+
+# Code, revision and rendering survive a listing as long as the gist did not
+# change since they were read
+UPSERT = """
+INSERT INTO samples
+    (id, owner, description, created, updated, revision, tagged, code, synced)
+VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+ON CONFLICT (id) DO UPDATE SET
+    owner = excluded.owner,
+    description = excluded.description,
+    created = excluded.created,
+    synced = excluded.synced,
+    tagged = excluded.tagged,
+    code = CASE
+        WHEN excluded.code IS NOT NULL THEN excluded.code
+        WHEN samples.updated = excluded.updated THEN samples.code
+    END,
+    revision = CASE
+        WHEN excluded.code IS NULL AND samples.updated = excluded.updated
+        THEN samples.revision ELSE excluded.revision
+    END,
+    svg = CASE WHEN samples.updated = excluded.updated THEN samples.svg END,
+    svg_key = CASE WHEN samples.updated = excluded.updated THEN samples.svg_key
+        ELSE '' END,
+    updated = excluded.updated
+"""
+
+COLUMNS = "id, owner, description, created, updated, revision, code, svg, svg_key"
+
+
+class SQLiteSampleStore(SampleStore):
+    def __init__(
+        self,
+        path: str,
+        upstream: GitHubSampleStore,
+        max_age: float = 300,
+        max_pages: int = 30,
+    ):
+        self.path = path
+        self.upstream = upstream
+        self.max_age = max_age
+        # Longest gist list mirrored per user, in pages of 100
+        self.max_pages = max_pages
+        self.hits = 0
+        self.misses = 0
+        self.stale_hits = 0
+        self.owner_syncs = 0
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.executescript(SCHEMA)
+        self._lock = threading.Lock()
+        self._syncs: Dict[str, asyncio.Task] = {}
+        self._background: Set[asyncio.Task] = set()
+
+    async def get(self, sample_id: str) -> Optional[Sample]:
+        row = await self._query(
+            f"SELECT {COLUMNS}, synced FROM samples WHERE id = ?", (sample_id,)
+        )
+        sample, synced = (Sample(*row[0][:-1]), row[0][-1]) if row else (None, 0.0)
+        if sample is not None and sample.code is not None:
+            if time.time() - synced < self.max_age:
+                self.hits += 1
+                return sample
+        try:
+            fresh = await self.upstream.get(sample_id)
+        except Exception as e:
+            if sample is None or sample.code is None:
+                raise
+            print(f"Serving mirrored sample {sample_id}: {e}")
+            self.stale_hits += 1
+            return sample
+        self.misses += 1
+        if fresh is None:
+            await self._write("DELETE FROM samples WHERE id = ?", (sample_id,))
+            return None
+        await self._upsert([fresh])
+        if sample is not None and sample.updated == fresh.updated:
+            fresh.svg, fresh.svg_key = sample.svg, sample.svg_key
+        return fresh
+
+    async def list_user(
+        self, owner: str, cursor: str, limit: int
+    ) -> Tuple[Optional[List[Sample]], Optional[str]]:
+        # The cursor is "<updated>|<id>" of the last sample handed out
+        after: Optional[Tuple[str, str]] = None
+        if cursor:
+            updated, separator, sample_id = cursor.rpartition("|")
+            if not separator:
+                raise ValueError(f"Invalid cursor {cursor!r}")
+            after = (updated, sample_id)
+
+        synced = await self._query(
+            "SELECT synced FROM owners WHERE owner = ?", (owner,)
+        )
+        if not synced:
+            if not await self._sync_owner(owner):
+                return None, None
+        elif time.time() - synced[0][0] >= self.max_age:
+            # Serve the mirror now and catch up with GitHub for the next page
+            task = asyncio.get_running_loop().create_task(self._sync_owner(owner))
+            self._background.add(task)
+            task.add_done_callback(self._background.discard)
+            task.add_done_callback(self._log_failure)
+
+        query = f"SELECT {COLUMNS} FROM samples WHERE owner = ? AND tagged = 1"
+        params: tuple = (owner,)
+        if after is not None:
+            query += " AND (updated, id) < (?, ?)"
+            params += after
+        query += " ORDER BY updated DESC, id DESC LIMIT ?"
+        rows = await self._query(query, params + (limit + 1,))
+        samples = [Sample(*row) for row in rows[:limit]]
+        if len(rows) <= limit:
+            return samples, None
+        return samples, f"{samples[-1].updated}|{samples[-1].id}"
+
+    async def put(self, gist: dict):
+        if not gist_complete(gist):
+            return
+        await self.upstream.put(gist)
+        await self._upsert([sample_from_gist(gist)])
+
+    async def save_svg(self, sample_id: str, revision: str, svg_key: str, svg: str):
+        await self._write(
+            "UPDATE samples SET svg = ?, svg_key = ? WHERE id = ? AND revision = ?",
+            (svg, svg_key, sample_id, revision),
+        )
+
+    def lookups(self) -> Dict[str, int]:
+        return {"hits": self.hits, "misses": self.misses, "stale_hits": self.stale_hits}
+
+    async def stats(self) -> dict:
+        rows = await self._query(
+            "SELECT (SELECT COUNT(*) FROM samples), (SELECT COUNT(*) FROM owners)", ()
+        )
+        samples, owners = rows[0]
+        return {
+            "path": self.path,
+            "samples": samples,
+            "owners": owners,
+            "max_age": self.max_age,
+            **self.lookups(),
+            "owner_syncs": self.owner_syncs,
+        }
+
+    async def close(self):
+        tasks = list(self._syncs.values()) + list(self._background)
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        with self._lock:
+            self._db.close()
+
+    def _log_failure(self, task: asyncio.Task):
+        if not task.cancelled() and task.exception() is not None:
+            print(f"Sample mirror sync failed: {task.exception()}")
+
+    async def _sync_owner(self, owner: str) -> bool:
+        """Mirror a user's gist list. False if GitHub does not know the user"""
+        task = self._syncs.get(owner)
+        if task is None:
+            task = asyncio.get_running_loop().create_task(self._walk_owner(owner))
+            self._syncs[owner] = task
+            task.add_done_callback(lambda _: self._syncs.pop(owner, None))
+        # Shielded, so a client that goes away does not cancel a shared sync
+        return await asyncio.shield(task)
+
+    async def _walk_owner(self, owner: str) -> bool:
+        self.owner_syncs += 1
+        started = time.time()
+        complete = False
+        for page in range(1, self.max_pages + 1):
+            listing = await self.upstream.listing(owner, page)
+            if listing is None:
+                await self._write("DELETE FROM samples WHERE owner = ?", (owner,))
+                await self._write("DELETE FROM owners WHERE owner = ?", (owner,))
+                return False
+            gists, more = listing
+            await self._upsert([sample_from_gist(gist, detail=False) for gist in gists])
+            if not more:
+                complete = True
+                break
+        if complete:
+            # Whatever the walk did not see again was deleted on GitHub
+            await self._write(
+                "DELETE FROM samples WHERE owner = ? AND synced < ?", (owner, started)
+            )
+        await self._write(
+            "INSERT OR REPLACE INTO owners (owner, synced) VALUES (?, ?)",
+            (owner, time.time()),
+        )
+        return True
+
+    async def _upsert(self, samples: List[Sample]):
+        now = time.time()
+        await self._write(
+            UPSERT,
+            [
+                (
+                    sample.id,
+                    sample.owner,
+                    sample.description,
+                    sample.created,
+                    sample.updated,
+                    sample.revision,
+                    int(sample.tagged),
+                    sample.code,
+                    now,
+                )
+                for sample in samples
+            ],
+            many=True,
+        )
+
+    async def _query(self, query: str, params: tuple) -> list:
+        def run():
+            with self._lock:
+                return self._db.execute(query, params).fetchall()
+
+        return await asyncio.get_running_loop().run_in_executor(None, run)
+
+    async def _write(self, query: str, params, many: bool = False):
+        def run():
+            with self._lock, self._db:
+                if many:
+                    self._db.executemany(query, params)
+                else:
+                    self._db.execute(query, params)
+
+        await asyncio.get_running_loop().run_in_executor(None, run)
@@ -0,0 +1,175 @@
+"""Lossless-looking size optimizations for the SVG that mpost writes.
+
+mpost prints coordinates with six decimals, repeats the full style of every
+path and wraps figures in groups that do nothing. This pass:
+
+* rounds numbers in geometry and styles, keeping `precision` decimals and
+  at least `precision` significant digits, so tiny scale factors survive;
+* moves styles used more than once into a <style> sheet of classes whose
+  names carry a hash of the document, so SVGs inlined in one page do not
+  clash;
+* drops identity transforms and collapses groups that are empty or have
+  no attributes.
+
+The root's width, height and viewBox are never touched. Note that class
+rules lose to page CSS where inline styles would not, so callers that
+restyle SVG contents with CSS should not use this pass. Anything that
+cannot be parsed is returned unchanged.
+"""
+
+import hashlib
+import math
+import re
+import xml.etree.ElementTree as ET
+from collections import Counter
+from typing import Dict
+
+SVG_NS = "http://www.w3.org/2000/svg"
+XLINK_NS = "http://www.w3.org/1999/xlink"
+ET.register_namespace("", SVG_NS)
+ET.register_namespace("xlink", XLINK_NS)
+
+NUMBER = re.compile(r"-?(?:\d+\.?\d*|\.\d+)(?:[eE][-+]?\d+)?")
+# In styles, leave hex colors and digits inside names such as cmr10 alone
+STYLE_NUMBER = re.compile(r"(?<![#\w.])" + NUMBER.pattern)
+GEOMETRY = {
+    "d",
+    "points",
+    "transform",
+    "x",
+    "y",
+    "x1",
+    "y1",
+    "x2",
+    "y2",
+    "cx",
+    "cy",
+    "r",
+    "rx",
+    "ry",
+    "dx",
+    "dy",
+    "stroke-width",
+    "font-size",
+}
+IDENTITY = re.compile(
+    r"\s*(?:matrix\(\s*1[\s,]+0[\s,]+0[\s,]+1[\s,]+0[\s,]+0\s*\)"
+    r"|translate\(\s*0(?:[\s,]+0)?\s*\)"
+    r"|scale\(\s*1(?:[\s,]+1)?\s*\)"
+    r"|rotate\(\s*0\s*\))\s*"
+)
+# Whitespace is significant inside these
+TEXT_TAGS = {f"{{{SVG_NS}}}text", f"{{{SVG_NS}}}tspan", f"{{{SVG_NS}}}style"}
+GROUP = f"{{{SVG_NS}}}g"
+
+
+def format_number(text: str, precision: int) -> str:
+    value = float(text)
+    if value == 0 or not math.isfinite(value):
+        return "0" if value == 0 else text
+    decimals = max(precision, precision - 1 - math.floor(math.log10(abs(value))))
+    formatted = f"{value:.{decimals}f}"
+    if "." in formatted:
+        formatted = formatted.rstrip("0").rstrip(".")
+    if formatted.startswith("0."):
+        formatted = formatted[1:]
+    elif formatted.startswith("-0."):
+        formatted = "-" + formatted[2:]
+    if formatted == "-0":
+        return "0"
+    return formatted if len(formatted) <= len(text) else text
+
+
+def round_numbers(value: str, precision: int, pattern=NUMBER) -> str:
+    return pattern.sub(lambda match: format_number(match.group(), precision), value)
+
+
+def normalize_style(style: str, precision: int) -> str:
+    declarations = []
+    for declaration in style.split(";"):
+        name, _, value = declaration.partition(":")
+        if name.strip() and value.strip():
+            value = round_numbers(value.strip(), precision, STYLE_NUMBER)
+            declarations.append(f"{name.strip()}:{value}")
+    return ";".join(declarations)
+
+
+def tidy(element: ET.Element, precision: int, styles: Counter):
+    """Round, normalize and strip one subtree, counting the styles it uses"""
+    for name, value in list(element.attrib.items()):
+        if name == "style":
+            value = normalize_style(value, precision)
+            if value:
+                element.set(name, value)
+                styles[value] += 1
+            else:
+                del element.attrib[name]
+        elif name in GEOMETRY:
+            element.set(name, round_numbers(value, precision))
+    transform = element.get("transform")
+    if transform is not None and IDENTITY.sub("", transform) == "":
+        del element.attrib["transform"]
+
+    if element.tag in TEXT_TAGS:
+        return
+    if element.text and not element.text.strip():
+        element.text = None
+    for child in element:
+        if child.tail and not child.tail.strip():
+            child.tail = None
+        tidy(child, precision, styles)
+
+
+def collapse_groups(parent: ET.Element):
+    for child in list(parent):
+        collapse_groups(child)
+        if child.tag != GROUP or child.tail:
+            continue
+        index = list(parent).index(child)
+        if len(child) == 0 and not child.text and "id" not in child.attrib:
+            parent.remove(child)
+        elif not child.attrib and not child.text:
+            parent.remove(child)
+            for offset, grandchild in enumerate(list(child)):
+                parent.insert(index + offset, grandchild)
+
+
+def use_classes(root: ET.Element, styles: Counter, scope: str):
+    shared: Dict[str, str] = {}
+    for style, count in styles.most_common():
+        if count > 1:
+            shared[style] = f"{scope}{len(shared):x}"
+    if not shared:
+        return
+    for element in root.iter():
+        name = shared.get(element.get("style", ""))
+        if name is not None:
+            del element.attrib["style"]
+            classes = element.get("class")
+            element.set("class", f"{classes} {name}" if classes else name)
+    sheet = ET.Element(f"{{{SVG_NS}}}style")
+    sheet.text = "".join(f".{name}{{{style}}}" for style, name in shared.items())
+    root.insert(0, sheet)
+
+
+def optimize(svg: str, precision: int = 3) -> str:
+    """Optimized SVG, or the input if that would not be any smaller"""
+    try:
+        root = ET.fromstring(svg)
+    except ET.ParseError:
+        return svg
+    if root.tag != f"{{{SVG_NS}}}svg":
+        return svg
+    styles: Counter = Counter()
+    for child in root:
+        tidy(child, precision, styles)
+    if root.text and not root.text.strip():
+        root.text = None
+    for child in root:
+        if child.tail and not child.tail.strip():
+            child.tail = None
+    collapse_groups(root)
+    scope = "m" + hashlib.sha1(svg.encode("utf-8")).hexdigest()[:6] + "-"
+    use_classes(root, styles, scope)
+    optimized = ET.tostring(root, encoding="unicode")
+    return optimized if len(optimized) < len(svg) else svg
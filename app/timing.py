@@ -0,0 +1,167 @@
+"""Phase timing of requests, sent back as a Server-Timing header.
+
+TimingMiddleware gives every HTTP request a Timeline in a context variable.
+Code anywhere on the request's path adds spans to it with span() and
+record(); compile jobs see it too, because the worker pool runs them in the
+context of the request that queued them. Phases that repeat, like
+optimizing every figure, add up. Spans that end after the response has
+started only make it into the JSON log line, if that is turned on.
+"""
+
+import json
+import re
+import threading
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Any, Dict, Iterator, Optional
+
+from app.metrics import Histogram, route_name
+
+# Server-Timing metric names are HTTP tokens
+NOT_TOKEN = re.compile(r"[^!#$%&'*+.^_`|~0-9A-Za-z-]")
+
+
+class Stopwatch:
+    """Durations of consecutive phases, e.g. of one backend job"""
+
+    def __init__(self):
+        self.laps: Dict[str, float] = {}
+        self._last = time.perf_counter()
+
+    def lap(self, name: str):
+        """End the current phase, which started where the previous one ended"""
+        now = time.perf_counter()
+        self.laps[name] = self.laps.get(name, 0.0) + now - self._last
+        self._last = now
+
+
+class Timeline:
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.phases: Dict[str, float] = {}
+        # Extra fields of the JSON log line
+        self.fields: Dict[str, Any] = {}
+        # Compile jobs add to it from the worker threads
+        self._lock = threading.Lock()
+
+    def add(self, name: str, seconds: float):
+        with self._lock:
+            self.phases[name] = self.phases.get(name, 0.0) + seconds
+
+    def elapsed(self) -> float:
+        return time.perf_counter() - self.start
+
+    def snapshot(self) -> Dict[str, float]:
+        with self._lock:
+            return dict(self.phases)
+
+    def header(self) -> str:
+        phases = list(self.snapshot().items())
+        phases.append(("total", self.elapsed()))
+        return ", ".join(
+            f"{NOT_TOKEN.sub('-', name)};dur={seconds * 1000:.1f}"
+            for name, seconds in phases
+        )
+
+
+current_timeline: ContextVar[Optional[Timeline]] = ContextVar(
+    "current_timeline", default=None
+)
+
+
+@contextmanager
+def span(name: str) -> Iterator[None]:
+    """Time a block as a phase of the current request, if there is one"""
+    timeline = current_timeline.get()
+    if timeline is None:
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        timeline.add(name, time.perf_counter() - start)
+
+
+def record(name: str, seconds: float):
+    """Add a phase timed elsewhere to the current request"""
+    timeline = current_timeline.get()
+    if timeline is not None:
+        timeline.add(name, seconds)
+
+
+def record_laps(laps: Dict[str, float], prefix: str = ""):
+    """Add the phases of a Stopwatch to the current request"""
+    timeline = current_timeline.get()
+    if timeline is not None:
+        for name, seconds in laps.items():
+            timeline.add(prefix + name, seconds)
+
+
+def note(name: str, value: Any):
+    """Add a field to the JSON log line of the current request"""
+    timeline = current_timeline.get()
+    if timeline is not None:
+        timeline.fields[name] = value
+
+
+class TimingMiddleware:
+    """ASGI middleware adding Server-Timing headers and, optionally, log lines"""
+
+    def __init__(
+        self,
+        app,
+        header: bool = True,
+        log: bool = False,
+        phases: Optional[Histogram] = None,
+    ):
+        self.app = app
+        self.header = header
+        self.log = log
+        # Observed per route and phase, if given
+        self.phases = phases
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        timeline = Timeline()
+        status = 500
+
+        async def send_with_timing(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+                if self.header:
+                    headers = list(message.get("headers", []))
+                    headers.append((b"server-timing", timeline.header().encode()))
+                    message = {**message, "headers": headers}
+            await send(message)
+
+        token = current_timeline.set(timeline)
+        try:
+            await self.app(scope, receive, send_with_timing)
+        finally:
+            current_timeline.reset(token)
+            self._finish(scope, timeline, status)
+
+    def _finish(self, scope, timeline: Timeline, status: int):
+        route = route_name(scope)
+        phases = timeline.snapshot()
+        if self.phases is not None:
+            for name, seconds in phases.items():
+                self.phases.observe(seconds, route, name)
+        if self.log:
+            line = {
+                "route": route,
+                "method": scope["method"],
+                "path": scope["path"],
+                "status": status,
+                "total_ms": round(timeline.elapsed() * 1000, 1),
+                "phases_ms": {
+                    name: round(seconds * 1000, 1) for name, seconds in phases.items()
+                },
+                **timeline.fields,
+            }
+            print(json.dumps(line))
@@ -0,0 +1,190 @@
+"""Isolated scratch directories for mpost runs.
+
+Every compile gets a directory of its own, preferably on a RAM-backed mount,
+taken from a pool of pre-created directories and wiped when it is handed
+back. A background janitor reclaims workspaces that were never returned and
+directories left behind by earlier server processes.
+"""
+
+import os
+import shutil
+import tempfile
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+from typing import Dict, List, Optional
+
+PREFIX = "mpost-sandbox-"
+
+
+def default_root() -> str:
+    """Prefer a tmpfs mount, fall back to the system temp dir"""
+    shm = "/dev/shm"
+    if os.path.isdir(shm) and os.access(shm, os.W_OK):
+        return shm
+    return tempfile.gettempdir()
+
+
+def pid_alive(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+def directory_size(path: str) -> int:
+    total = 0
+    for root, _, files in os.walk(path):
+        for name in files:
+            try:
+                total += os.lstat(os.path.join(root, name)).st_size
+            except OSError:
+                continue
+    return total
+
+
+class Workspace:
+    def __init__(self, path: str):
+        self.path = path
+        self.leased_at = 0.0
+
+
+class WorkspaceManager:
+    def __init__(
+        self,
+        root: Optional[str] = None,
+        pool_size: int = 8,
+        max_age: float = 300,
+        janitor_interval: float = 60,
+    ):
+        self.root = root or default_root()
+        self.base = os.path.join(self.root, f"{PREFIX}{os.getpid()}")
+        self.pool_size = pool_size
+        self.max_age = max_age
+        self.janitor_interval = janitor_interval
+        self.created = 0
+        self.reclaimed = 0
+        self._idle: List[Workspace] = []
+        self._leased: Dict[str, Workspace] = {}
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._janitor: Optional[threading.Thread] = None
+
+    def start(self):
+        """Pre-create the pool and start the janitor"""
+        os.makedirs(self.base, exist_ok=True)
+        with self._lock:
+            while len(self._idle) < self.pool_size:
+                self._idle.append(self._create())
+        self._janitor = threading.Thread(
+            target=self._janitor_loop, name="workspace-janitor", daemon=True
+        )
+        self._janitor.start()
+
+    def close(self):
+        self._stop.set()
+        shutil.rmtree(self.base, ignore_errors=True)
+
+    def acquire(self) -> Workspace:
+        with self._lock:
+            workspace = self._idle.pop() if self._idle else self._create()
+            workspace.leased_at = time.monotonic()
+            self._leased[workspace.path] = workspace
+        return workspace
+
+    def release(self, workspace: Workspace):
+        with self._lock:
+            leased = self._leased.pop(workspace.path, None) is not None
+        if not leased:
+            # Already reclaimed by the janitor
+            shutil.rmtree(workspace.path, ignore_errors=True)
+            return
+        try:
+            self._wipe(workspace.path)
+        except OSError:
+            shutil.rmtree(workspace.path, ignore_errors=True)
+            return
+        with self._lock:
+            if len(self._idle) < self.pool_size:
+                self._idle.append(workspace)
+                return
+        shutil.rmtree(workspace.path, ignore_errors=True)
+
+    @contextmanager
+    def lease(self):
+        workspace = self.acquire()
+        try:
+            yield workspace
+        finally:
+            self.release(workspace)
+
+    def stats(self) -> dict:
+        with self._lock:
+            idle, leased = len(self._idle), len(self._leased)
+        return {
+            "root": self.root,
+            "idle": idle,
+            "leased": leased,
+            "created": self.created,
+            "reclaimed": self.reclaimed,
+            "disk_bytes": directory_size(self.base),
+        }
+
+    def _create(self) -> Workspace:
+        path = os.path.join(self.base, uuid.uuid4().hex)
+        os.makedirs(path)
+        self.created += 1
+        return Workspace(path)
+
+    def _wipe(self, path: str):
+        with os.scandir(path) as entries:
+            for entry in entries:
+                if entry.is_dir(follow_symlinks=False):
+                    shutil.rmtree(entry.path)
+                else:
+                    os.unlink(entry.path)
+
+    def _janitor_loop(self):
+        while not self._stop.wait(self.janitor_interval):
+            try:
+                self.sweep()
+            except Exception as e:
+                print(f"Workspace janitor failed: {e}")
+
+    def sweep(self):
+        """Reclaim leaked workspaces and directories of dead server processes"""
+        now = time.monotonic()
+        with self._lock:
+            expired = [
+                workspace
+                for workspace in self._leased.values()
+                if now - workspace.leased_at > self.max_age
+            ]
+            for workspace in expired:
+                del self._leased[workspace.path]
+            known = set(self._leased) | {workspace.path for workspace in self._idle}
+        for workspace in expired:
+            shutil.rmtree(workspace.path, ignore_errors=True)
+            self.reclaimed += 1
+
+        # Strays are only removed once they are old, so a workspace created
+        # while we scan is never mistaken for one
+        cutoff = time.time() - self.max_age
+        with os.scandir(self.base) as entries:
+            for entry in entries:
+                if entry.path not in known and entry.stat().st_mtime < cutoff:
+                    shutil.rmtree(entry.path, ignore_errors=True)
+                    self.reclaimed += 1
+
+        with os.scandir(self.root) as entries:
+            for entry in entries:
+                if not entry.name.startswith(PREFIX) or entry.path == self.base:
+                    continue
+                pid = entry.name[len(PREFIX) :]
+                if pid.isdigit() and not pid_alive(int(pid)):
+                    shutil.rmtree(entry.path, ignore_errors=True)
+                    self.reclaimed += 1
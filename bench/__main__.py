@@ -0,0 +1,155 @@
+"""Benchmarks of the compile path and the HTTP routes, runnable offline.
+
+    python -m bench micro             # mpost() alone, per sketch of the corpus
+    python -m bench load              # concurrent HTTP load against uvicorn
+    python -m bench all --save        # both, then store them as the baseline
+
+Results are compared with the baseline file when it exists; the command
+exits with status 1 if a latency percentile or the throughput got worse by
+more than the tolerance. The app is configured through the environment as
+usual (MPOST_BIN, MPOST_BACKEND, MPOST_WORKERS, ...).
+"""
+
+import argparse
+import json
+import os
+import sys
+
+# The app finds its templates and static files relative to the repository
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+os.chdir(ROOT)
+sys.path.insert(0, ROOT)
+
+from bench import corpus, load, micro  # noqa: E402
+from bench.stats import (  # noqa: E402
+    compare,
+    environment,
+    load_baseline,
+    own_peak_rss_kb,
+    print_table,
+    save_baseline,
+)
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(prog="python -m bench", description=__doc__)
+    parser.add_argument("suite", choices=["micro", "load", "all"], nargs="?")
+    parser.add_argument(
+        "--sketches", default="", help="comma separated corpus sketches (all)"
+    )
+    parser.add_argument("--runs", type=int, default=20, help="runs per sketch")
+    parser.add_argument(
+        "--timeout", type=float, default=20, help="compile timeout in seconds"
+    )
+    parser.add_argument(
+        "--pathological-timeout",
+        type=float,
+        default=2,
+        help="timeout of the sketches that never finish",
+    )
+    parser.add_argument(
+        "--scenarios",
+        default=",".join(load.SCENARIOS),
+        help="comma separated load scenarios",
+    )
+    parser.add_argument(
+        "--requests", type=int, default=200, help="requests per scenario"
+    )
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--gists", type=int, default=60, help="gists of the fake user")
+    parser.add_argument(
+        "--github-latency",
+        type=float,
+        default=50,
+        help="milliseconds the fake GitHub API takes per request",
+    )
+    parser.add_argument(
+        "--github-jitter", type=float, default=0, help="± milliseconds of latency"
+    )
+    parser.add_argument("--baseline", default=os.path.join("bench", "baseline.json"))
+    parser.add_argument(
+        "--save", action="store_true", help="store the results as the baseline"
+    )
+    parser.add_argument(
+        "--tolerance",
+        type=float,
+        default=0.2,
+        help="relative change that counts as a regression",
+    )
+    parser.add_argument(
+        "--min-delta-ms",
+        type=float,
+        default=1,
+        help="smallest latency change that counts as a regression",
+    )
+    parser.add_argument("--output", help="also write the results to this file")
+    return parser.parse_args()
+
+
+def main() -> int:
+    args = parse_args()
+    suite = args.suite or "all"
+    scenarios = args.scenarios.split(",")
+    unknown = set(scenarios) - set(load.SCENARIOS)
+    if unknown:
+        print(f"Unknown scenarios: {', '.join(sorted(unknown))}")
+        return 2
+    try:
+        sketches = corpus.by_name(args.sketches)
+    except ValueError as e:
+        print(e)
+        return 2
+    results = {"environment": environment(), "peak_rss_kb": {}}
+
+    if suite in ("micro", "all"):
+        results["micro"] = micro.run(
+            sketches,
+            args.runs,
+            args.timeout,
+            args.pathological_timeout,
+        )
+        print_table("mpost() by sketch", results["micro"])
+        # Measured before the load suite, whose server is a child process too
+        peak = own_peak_rss_kb()
+        results["peak_rss_kb"].update(bench=peak["self"], mpost=peak["children"])
+
+    if suite in ("load", "all"):
+        results["load"], results["peak_rss_kb"]["server"] = load.run(
+            scenarios,
+            args.requests,
+            args.concurrency,
+            args.gists,
+            args.github_latency / 1000,
+            args.github_jitter / 1000,
+        )
+        print_table(
+            f"HTTP at concurrency {args.concurrency}, GitHub latency "
+            f"{args.github_latency:g} ms",
+            results["load"],
+        )
+    print(f"\nPeak RSS (KB): {json.dumps(results['peak_rss_kb'])}")
+
+    if args.output:
+        save_baseline(args.output, results)
+    baseline = load_baseline(args.baseline)
+    regressions = []
+    if baseline is not None:
+        print(f"\nCompared with {args.baseline}")
+        regressions = compare(results, baseline, args.tolerance, args.min_delta_ms)
+    if args.save:
+        # A run of one suite keeps the baseline of the other
+        merged = {**(baseline or {}), **results}
+        merged["peak_rss_kb"] = {
+            **(baseline or {}).get("peak_rss_kb", {}),
+            **results["peak_rss_kb"],
+        }
+        save_baseline(args.baseline, merged)
+        print(f"\nSaved the baseline to {args.baseline}")
+    if regressions:
+        print(f"\n{len(regressions)} regressions: {', '.join(regressions)}")
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,115 @@
+"""Sketches the benchmarks compile, from the editor's placeholder to known
+pathological programs. Each one stands for a kind of load the sandbox sees.
+"""
+
+from dataclasses import dataclass
+
+
+@dataclass
+class Sketch:
+    name: str
+    code: str
+    # Runs into the timeout or a resource limit on purpose
+    pathological: bool = False
+
+
+PLACEHOLDER = """
+beginfig(0);
+width:=100;
+rotation:=45;
+
+pen calligraphicpen ;
+calligraphicpen := makepen ((0, 0)--(width,0 ) rotated rotation) ;
+
+z0 = (x1+150, 0);
+z1 = (0, y0+250);
+z2 = (x1+250, y1+250);
+z3 = (x2+250, y1);
+z4 = (x2, y0);
+pickup calligraphicpen;
+draw z0..z1..z2..z3..z4 withcolor white;
+endfig;
+end
+"""
+
+PLAIN_EX = """
+input plain_ex;
+beginfig(1);
+u := 1cm;
+for n = 3 upto 12:
+  path p;
+  p := vpolygon(n) scaled (n * u / 4);
+  draw p withcolor (n / 12) * cyan;
+  for t = 0 upto n - 1:
+    drawarrow point t of p -- (point t of p + 5mm * udir t of p);
+  endfor
+endfor
+path q;
+q := (0, 0){dir 30} .. (4u, 2u) .. {dir -30}(8u, 0);
+draw q;
+draw q mirr (1, 0) dashed evenly;
+draw (xtime 2u of q, 0) -- (xtime 2u of q, 3u) withcolor magenta;
+label.top(decimal signum(tand 40), (4u, 3u));
+endfig;
+end
+"""
+
+LABELS = "\n".join(
+    ["beginfig(1);", "u := 4mm;"]
+    + [
+        f'label("x{i}", ({i % 20} * u, {i // 20} * u));\n'
+        f'dotlabel.urt("p{i}", ({i % 20} * u, {i // 20} * u + 2));'
+        for i in range(200)
+    ]
+    + ["endfig;", "end"]
+)
+
+MULTI_FIGURE = "\n".join(
+    f"""beginfig({n});
+path c;
+c := fullcircle scaled ({n} * 1cm);
+fill c withcolor ({n} / 12)[white, blue];
+for k = 1 upto {4 * n}:
+  draw c rotated (k * 360 / {4 * n}) shifted ({n} * 2mm, 0);
+endfor
+endfig;"""
+    for n in range(1, 13)
+) + "\nend\n"
+
+FOREVER = """
+beginfig(1);
+x := 0;
+forever:
+  x := (x + 1) mod 1000;
+endfor
+endfig;
+end
+"""
+
+RECURSION = """
+vardef deep(expr n) = deep(n + 1) + 1 enddef;
+beginfig(1);
+draw (0, 0) -- (deep(0), 0);
+endfig;
+end
+"""
+
+SKETCHES = [
+    Sketch("placeholder", PLACEHOLDER),
+    Sketch("plain_ex", PLAIN_EX),
+    Sketch("labels", LABELS),
+    Sketch("multi_figure", MULTI_FIGURE),
+    Sketch("forever", FOREVER, pathological=True),
+    Sketch("recursion", RECURSION, pathological=True),
+]
+
+
+def by_name(names: str) -> list:
+    """The sketches named in a comma separated list, all of them for an empty one"""
+    if not names:
+        return list(SKETCHES)
+    wanted = names.split(",")
+    unknown = set(wanted) - {sketch.name for sketch in SKETCHES}
+    if unknown:
+        raise ValueError(f"Unknown sketches: {', '.join(sorted(unknown))}")
+    return [sketch for sketch in SKETCHES if sketch.name in wanted]
@@ -0,0 +1,140 @@
+"""A local stand-in for the parts of the GitHub API the sandbox reads.
+
+It serves a fixed set of public gists of one user, each holding a sketch
+of the corpus, with ETags and 304 answers like GitHub, after a configurable
+delay per request. The load tests point GITHUB_API_BASE at it, so they run
+offline and the GitHub latency is under control.
+"""
+
+import asyncio
+import hashlib
+import json
+import random
+import socket
+import threading
+import time
+from typing import Dict, List
+
+import uvicorn
+from fastapi import FastAPI, Request, Response
+
+from app.store import GALLERY_TAG
+from bench.corpus import SKETCHES
+
+
+def make_gists(owner: str, count: int) -> List[dict]:
+    """Gists of owner cycling through the corpus, pathological sketches excluded"""
+    sketches = [sketch for sketch in SKETCHES if not sketch.pathological]
+    gists = []
+    for index in range(count):
+        sketch = sketches[index % len(sketches)]
+        # A comment of its own keeps every gist a separate compile
+        code = f"% gist {index}\n{sketch.code}"
+        gist_id = hashlib.sha1(f"{owner}/{index}".encode("utf-8")).hexdigest()[:20]
+        revision = hashlib.sha1(code.encode("utf-8")).hexdigest()
+        gists.append(
+            {
+                "id": gist_id,
+                "description": f"{sketch.name} {index} {GALLERY_TAG}",
+                "public": True,
+                "owner": {"login": owner},
+                "created_at": "2024-01-01T00:00:00Z",
+                "updated_at": f"2024-01-01T00:{index // 60:02d}:{index % 60:02d}Z",
+                "history": [{"version": revision}],
+                "files": {"main.mp": {"filename": "main.mp", "content": code}},
+            }
+        )
+    return gists
+
+
+def create_app(owner: str, gists: List[dict], latency: float, jitter: float):
+    app = FastAPI()
+    by_id: Dict[str, dict] = {gist["id"]: gist for gist in gists}
+    # GitHub lists the most recently updated first
+    listed = sorted(gists, key=lambda gist: gist["updated_at"], reverse=True)
+    app.state.requests = 0
+
+    async def delay():
+        app.state.requests += 1
+        await asyncio.sleep(max(0.0, latency + random.uniform(-jitter, jitter)))
+
+    async def not_found() -> Response:
+        await delay()
+        return Response(status_code=404)
+
+    async def reply(request: Request, data, headers: dict = None) -> Response:
+        await delay()
+        body = json.dumps(data).encode("utf-8")
+        etag = f'"{hashlib.sha1(body).hexdigest()}"'
+        headers = {**(headers or {}), "ETag": etag, "X-RateLimit-Remaining": "4999"}
+        if request.headers.get("if-none-match") == etag:
+            return Response(status_code=304, headers=headers)
+        return Response(body, media_type="application/json", headers=headers)
+
+    @app.get("/gists/{gist_id}")
+    async def gist(gist_id: str, request: Request):
+        if gist_id not in by_id:
+            return await not_found()
+        return await reply(request, by_id[gist_id])
+
+    @app.get("/gists/{gist_id}/{revision}")
+    async def gist_revision(gist_id: str, revision: str, request: Request):
+        return await gist(gist_id, request)
+
+    @app.get("/users/{login}/gists")
+    async def user_gists(
+        login: str, request: Request, page: int = 1, per_page: int = 30
+    ):
+        if login.lower() != owner.lower():
+            return await not_found()
+        start = (page - 1) * per_page
+        headers = {}
+        if start + per_page < len(listed):
+            url = f"{request.base_url}users/{login}/gists?per_page={per_page}"
+            headers["Link"] = f'<{url}&page={page + 1}>; rel="next"'
+        return await reply(request, listed[start : start + per_page], headers)
+
+    return app
+
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+class FakeGitHub:
+    """The fake API served from a background thread"""
+
+    def __init__(
+        self,
+        owner: str = "bench",
+        gists: int = 60,
+        latency: float = 0.05,
+        jitter: float = 0.0,
+    ):
+        self.owner = owner
+        self.gists = make_gists(owner, gists)
+        self.app = create_app(owner, self.gists, latency, jitter)
+        self.port = free_port()
+        self.url = f"http://127.0.0.1:{self.port}"
+        self._server = uvicorn.Server(
+            uvicorn.Config(self.app, port=self.port, log_level="warning")
+        )
+        self._thread = threading.Thread(target=self._server.run, daemon=True)
+
+    @property
+    def requests(self) -> int:
+        return self.app.state.requests
+
+    def start(self):
+        self._thread.start()
+        deadline = time.monotonic() + 10
+        while not self._server.started:
+            if time.monotonic() > deadline or not self._thread.is_alive():
+                raise RuntimeError("The fake GitHub API did not start")
+            time.sleep(0.02)
+
+    def stop(self):
+        self._server.should_exit = True
+        self._thread.join(timeout=5)
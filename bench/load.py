@@ -0,0 +1,184 @@
+"""Concurrent HTTP load against a real server process.
+
+The app runs under uvicorn in a child process, configured through the
+environment to read gists from the fake GitHub API and to keep its sample
+mirror in a temporary directory. Each scenario sends a fixed number of
+requests from a fixed number of concurrent clients:
+
+* compile: POST /api/compile with sources no cache has seen;
+* compile_cached: POST /api/compile with one source over and over;
+* embed: GET /m/{id}/embed over the fake gists, compiled on first view;
+* user: GET /u/{username} and the samples API behind the gallery.
+
+Client quotas are off, since every request comes from the same address.
+"""
+
+import asyncio
+import itertools
+import os
+import subprocess
+import sys
+import tempfile
+import time
+import uuid
+from typing import Callable, Dict, List, Optional, Tuple
+
+import httpx
+
+from bench.corpus import SKETCHES
+from bench.fake_github import FakeGitHub, free_port
+from bench.stats import process_peak_rss_kb, summarize
+
+SCENARIOS = ["compile", "compile_cached", "embed", "user"]
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+class AppServer:
+    def __init__(self, github_url: str, workdir: str):
+        self.port = free_port()
+        self.url = f"http://127.0.0.1:{self.port}"
+        self.env = {
+            **os.environ,
+            "GITHUB_API_BASE": github_url,
+            "SAMPLE_DB": os.path.join(workdir, "samples.sqlite3"),
+            "MPOST_CACHE_DIR": "",
+            "MPOST_CLIENT_RATE": "0",
+        }
+        self.process: Optional[subprocess.Popen] = None
+
+    def start(self, timeout: float = 120):
+        self.process = subprocess.Popen(
+            [
+                sys.executable,
+                "-m",
+                "uvicorn",
+                "app.main:app",
+                "--port",
+                str(self.port),
+                "--log-level",
+                "warning",
+            ],
+            cwd=ROOT,
+            env=self.env,
+        )
+        # Startup builds the formats and assets before it serves anything
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            if self.process.poll() is not None:
+                raise RuntimeError("The app exited during startup")
+            try:
+                if httpx.get(f"{self.url}/about", timeout=1).status_code == 200:
+                    return
+            except httpx.HTTPError:
+                pass
+            time.sleep(0.2)
+        raise RuntimeError("The app did not start in time")
+
+    def peak_rss_kb(self) -> Optional[int]:
+        return process_peak_rss_kb(self.process.pid) if self.process else None
+
+    def stop(self):
+        if self.process is not None:
+            self.process.terminate()
+            try:
+                self.process.wait(timeout=10)
+            except subprocess.TimeoutExpired:
+                self.process.kill()
+
+
+def request_factory(scenario: str, github: FakeGitHub) -> Callable:
+    """A function (client, index) sending the index-th request of a scenario"""
+    sketches = [sketch for sketch in SKETCHES if not sketch.pathological]
+    token = uuid.uuid4().hex[:8]
+
+    if scenario == "compile":
+
+        def send(client: httpx.AsyncClient, index: int):
+            sketch = sketches[index % len(sketches)]
+            code = f"% load {token} {index}\n{sketch.code}"
+            return client.post("/api/compile", json={"code": code})
+
+    elif scenario == "compile_cached":
+
+        def send(client: httpx.AsyncClient, index: int):
+            return client.post("/api/compile", json={"code": sketches[0].code})
+
+    elif scenario == "embed":
+
+        def send(client: httpx.AsyncClient, index: int):
+            gist = github.gists[index % len(github.gists)]
+            return client.get(f"/m/{gist['id']}/embed")
+
+    elif scenario == "user":
+
+        def send(client: httpx.AsyncClient, index: int):
+            if index % 2:
+                return client.get(f"/api/u/{github.owner}/samples")
+            return client.get(f"/u/{github.owner}")
+
+    else:
+        raise ValueError(f"Unknown scenario {scenario!r}")
+    return send
+
+
+async def drive(base_url: str, send: Callable, requests: int, concurrency: int):
+    """Send requests from concurrent clients. Returns latencies, errors and wall time"""
+    latencies: List[float] = []
+    errors = 0
+    counter = itertools.count()
+    limits = httpx.Limits(max_connections=concurrency)
+    async with httpx.AsyncClient(
+        base_url=base_url, limits=limits, timeout=120
+    ) as client:
+
+        async def worker():
+            nonlocal errors
+            while True:
+                index = next(counter)
+                if index >= requests:
+                    return
+                start = time.perf_counter()
+                try:
+                    response = await send(client, index)
+                    failed = response.status_code >= 400
+                except httpx.HTTPError:
+                    failed = True
+                latencies.append(time.perf_counter() - start)
+                errors += failed
+
+        started = time.perf_counter()
+        await asyncio.gather(*(worker() for _ in range(concurrency)))
+        return latencies, errors, time.perf_counter() - started
+
+
+def run(
+    scenarios: List[str],
+    requests: int,
+    concurrency: int,
+    gists: int,
+    github_latency: float,
+    github_jitter: float,
+) -> Tuple[Dict[str, dict], Optional[int]]:
+    """Summaries per scenario, and the peak resident memory of the server in KB"""
+    github = FakeGitHub(gists=gists, latency=github_latency, jitter=github_jitter)
+    github.start()
+    results: Dict[str, dict] = {}
+    peak_rss_kb = None
+    with tempfile.TemporaryDirectory(prefix="mpost-bench-") as workdir:
+        server = AppServer(github.url, workdir)
+        try:
+            server.start()
+            for scenario in scenarios:
+                send = request_factory(scenario, github)
+                github_before = github.requests
+                latencies, errors, wall = asyncio.run(
+                    drive(server.url, send, requests, concurrency)
+                )
+                summary = summarize(latencies, wall, errors)
+                summary["github_requests"] = github.requests - github_before
+                results[scenario] = summary
+            peak_rss_kb = server.peak_rss_kb()
+        finally:
+            server.stop()
+            github.stop()
+    return results, peak_rss_kb
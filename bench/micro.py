@@ -0,0 +1,62 @@
+"""Micro-benchmarks of mpost() alone, in this process and without HTTP.
+
+Every run of a sketch gets a comment of its own, so it misses the compile
+cache and measures a full compile; the "/cached" rows repeat one source and
+measure cache hits. Pathological sketches run a few times only, with a
+short timeout, and are not cached by design.
+"""
+
+import time
+import uuid
+from typing import Dict, List
+
+from bench.corpus import Sketch
+from bench.stats import summarize
+
+PATHOLOGICAL_RUNS = 3
+
+
+def run(
+    sketches: List[Sketch], runs: int, timeout: float, pathological_timeout: float
+) -> Dict[str, dict]:
+    # Imported here, so that the caller can configure the app through the
+    # environment first
+    from app import main
+
+    main.compiler_version()
+    main.workspace_manager.start()
+    main.format_manager.prepare()
+    token = uuid.uuid4().hex[:8]
+    results = {}
+    try:
+        for sketch in sketches:
+            count = min(runs, PATHOLOGICAL_RUNS) if sketch.pathological else runs
+            limit = pathological_timeout if sketch.pathological else timeout
+            latencies, errors = [], 0
+            started = time.perf_counter()
+            for index in range(count):
+                code = f"% bench {token} {index}\n{sketch.code}"
+                start = time.perf_counter()
+                result = main.mpost(code, timeout=limit)
+                latencies.append(time.perf_counter() - start)
+                errors += result.error != 0
+            results[sketch.name] = summarize(
+                latencies, time.perf_counter() - started, errors
+            )
+            if sketch.pathological:
+                continue
+
+            latencies = []
+            started = time.perf_counter()
+            for _ in range(runs):
+                start = time.perf_counter()
+                main.mpost(code, timeout=limit)
+                latencies.append(time.perf_counter() - start)
+            results[f"{sketch.name}/cached"] = summarize(
+                latencies, time.perf_counter() - started
+            )
+    finally:
+        main.compile_backend.close()
+        main.format_manager.close()
+        main.workspace_manager.close()
+    return results
@@ -0,0 +1,138 @@
+"""Latency summaries, peak memory and the comparison with a stored baseline"""
+
+import json
+import os
+import platform
+import resource
+import sys
+from typing import Dict, List, Optional
+
+# Summary fields compared with the baseline, and whether higher is better. The
+# throughput of sequential runs only restates their latency
+LATENCIES = {"p50_ms": False, "p95_ms": False, "p99_ms": False}
+COMPARED = {"micro": LATENCIES, "load": {**LATENCIES, "throughput": True}}
+
+
+def percentile(sorted_values: List[float], fraction: float) -> float:
+    """Linear interpolation between the closest ranks"""
+    if not sorted_values:
+        return 0.0
+    position = (len(sorted_values) - 1) * fraction
+    low = int(position)
+    high = min(low + 1, len(sorted_values) - 1)
+    return sorted_values[low] + (sorted_values[high] - sorted_values[low]) * (
+        position - low
+    )
+
+
+def summarize(latencies: List[float], wall: float, errors: int = 0) -> dict:
+    """Summary of request or run latencies in seconds, over wall seconds"""
+    values = sorted(latencies)
+    return {
+        "count": len(values),
+        "errors": errors,
+        "p50_ms": round(percentile(values, 0.50) * 1000, 2),
+        "p95_ms": round(percentile(values, 0.95) * 1000, 2),
+        "p99_ms": round(percentile(values, 0.99) * 1000, 2),
+        "max_ms": round(values[-1] * 1000, 2) if values else 0.0,
+        "throughput": round(len(values) / wall, 2) if wall > 0 else 0.0,
+    }
+
+
+def own_peak_rss_kb() -> Dict[str, int]:
+    """Peak resident memory of this process and of the largest of its children"""
+    scale = 1024 if sys.platform == "darwin" else 1
+    return {
+        "self": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss // scale,
+        "children": resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss // scale,
+    }
+
+
+def process_peak_rss_kb(pid: int) -> Optional[int]:
+    """Peak resident memory of another process, where /proc tells"""
+    try:
+        with open(f"/proc/{pid}/status") as status:
+            for line in status:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1])
+    except (OSError, ValueError, IndexError):
+        pass
+    return None
+
+
+def environment() -> dict:
+    return {
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpus": os.cpu_count(),
+    }
+
+
+def load_baseline(path: str) -> Optional[dict]:
+    if not os.path.exists(path):
+        return None
+    with open(path) as f:
+        return json.load(f)
+
+
+def save_baseline(path: str, results: dict):
+    with open(path, "w") as f:
+        json.dump(results, f, indent=2, sort_keys=True)
+        f.write("\n")
+
+
+def compare(
+    results: dict, baseline: dict, tolerance: float, min_delta_ms: float = 1.0
+) -> List[str]:
+    """Print every compared figure next to the baseline. Returns the regressions.
+
+    Latencies must also change by min_delta_ms to count, so that the noise
+    of sub-millisecond cache hits is not a regression.
+    """
+    regressions = []
+    for suite, fields in COMPARED.items():
+        for name, summary in sorted(results.get(suite, {}).items()):
+            before = baseline.get(suite, {}).get(name)
+            if before is None:
+                print(f"{suite}/{name}: not in the baseline")
+                continue
+            for field, higher_is_better in fields.items():
+                old, new = before.get(field), summary.get(field)
+                if not old or new is None:
+                    continue
+                change = (new - old) / old
+                worse = -change if higher_is_better else change
+                if field.endswith("_ms") and abs(new - old) < min_delta_ms:
+                    worse = 0
+                flag = ""
+                if worse > tolerance:
+                    flag = "  REGRESSION"
+                    regressions.append(f"{suite}/{name} {field}")
+                print(
+                    f"{suite}/{name} {field}: {old:g} -> {new:g} "
+                    f"({change:+.1%}){flag}"
+                )
+    for name, new in sorted(results.get("peak_rss_kb", {}).items()):
+        old = baseline.get("peak_rss_kb", {}).get(name)
+        if old and new:
+            change = (new - old) / old
+            flag = ""
+            if change > tolerance:
+                flag = "  REGRESSION"
+                regressions.append(f"peak_rss_kb/{name}")
+            print(f"peak_rss_kb/{name}: {old} -> {new} ({change:+.1%}){flag}")
+    return regressions
+
+
+def print_table(title: str, summaries: Dict[str, dict]):
+    print(f"\n{title}")
+    print(
+        f"{'':<22}{'count':>7}{'errors':>8}{'p50 ms':>10}{'p95 ms':>10}"
+        f"{'p99 ms':>10}{'per s':>10}"
+    )
+    for name, summary in summaries.items():
+        print(
+            f"{name:<22}{summary['count']:>7}{summary['errors']:>8}"
+            f"{summary['p50_ms']:>10.1f}{summary['p95_ms']:>10.1f}"
+            f"{summary['p99_ms']:>10.1f}{summary['throughput']:>10.1f}"
+        )
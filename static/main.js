@@ -26,6 +26,19 @@ let currentUser = null;
 let compileAbortController = null;
 let compileDebouncer = null;
 
+// Live compile session over /ws/compile, with the SVG the server thinks we have
+let compileSocket = null;
+let compileSocketOpening = null;
+let liveUnavailable = false;
+let liveSeq = 0;
+let liveSVG = "";
+let liveHash = "";
+let renderedSVG = null;
+
+// Identifies this editor to the server, so a newer compile supersedes the older one
+const compileSession =
+	window.crypto?.randomUUID?.() ?? `${Date.now()}-${Math.random().toString(16).slice(2)}`;
+
 const COMPILE_DELAY = 500;
 const MIN_PANE_WIDTH = 200;
 
@@ -265,15 +278,151 @@ function exportSVG() {
 	URL.revokeObjectURL(url);
 }
 
+/**
+ * Show a compiled SVG in the result pane
+ * @param {string} svg - SVG document
+ */
+function showSVG(svg) {
+	if (svg === renderedSVG) return;
+	renderedSVG = svg;
+	document.getElementById("result").innerHTML = svg;
+
+	const originalSVG = document.querySelector("#result svg");
+	if (originalSVG) {
+		// Expand viewBox by 10% with padding
+		const width = parseFloat(originalSVG.getAttribute("width")) || 0;
+		const height = parseFloat(originalSVG.getAttribute("height")) || 0;
+		const newViewBox = `-20 -20 ${width * 1.1} ${height * 1.1}`;
+
+		originalSVG.setAttribute("viewBox", newViewBox);
+		originalSVG.setAttribute("id", "originalSVG");
+		annotate(originalSVG);
+	}
+}
+
+/**
+ * Show the log of a failed compile
+ * @param {Object} result - Compile result with stdout and stderr
+ */
+function showCompileError(result) {
+	showLog(`${result.stdout || ""}\n${result.stderr || ""}`.trim());
+	document.getElementById("result").innerHTML = "<p>Error compiling</p>";
+	renderedSVG = null;
+}
+
+/**
+ * Apply the splices of a delta result to an SVG
+ * @param {string} svg - SVG the delta is based on
+ * @param {Array<[number, number, string]>} ops - [start, end, text] in ascending order
+ * @returns {string}
+ */
+function applyDelta(svg, ops) {
+	const parts = [];
+	let position = 0;
+	for (const [start, end, text] of ops) {
+		parts.push(svg.slice(position, start), text);
+		position = end;
+	}
+	parts.push(svg.slice(position));
+	return parts.join("");
+}
+
+/**
+ * Handle a message of the live compile session
+ * @param {MessageEvent} event
+ */
+function onCompileMessage(event) {
+	const message = JSON.parse(event.data);
+	const latest = message.seq === liveSeq;
+
+	if (message.type === "result" && message.error === 0) {
+		if (message.delta) {
+			if (message.base !== liveHash) {
+				// Lost track of the SVG: start over with the full document
+				compileSocket.send(JSON.stringify({ type: "resync" }));
+				if (latest) doCompile({ preview: true });
+				return;
+			}
+			liveSVG = applyDelta(liveSVG, message.delta);
+		} else if (message.svg !== undefined) {
+			// An empty SVG means nothing was drawn
+			liveSVG = message.svg;
+		}
+		liveHash = message.hash;
+		// Results of older edits still keep the SVG in step, but are not shown
+		if (!latest) return;
+		showLog(message.stdout || "Compiled successfully");
+		showSVG(liveSVG);
+	} else if (latest) {
+		if (message.type === "result") {
+			showCompileError(message);
+		} else {
+			showLog(message.message || "Compile failed");
+		}
+	}
+}
+
+/**
+ * Open the live compile session, or return null if it is not available
+ * @returns {Promise<?WebSocket>}
+ */
+function openCompileSocket() {
+	if (compileSocket) return Promise.resolve(compileSocket);
+	if (liveUnavailable || !window.WebSocket) return Promise.resolve(null);
+	if (compileSocketOpening) return compileSocketOpening;
+
+	compileSocketOpening = new Promise((resolve) => {
+		const scheme = location.protocol === "https:" ? "wss:" : "ws:";
+		const socket = new WebSocket(`${scheme}//${location.host}/ws/compile`);
+		let opened = false;
+		socket.addEventListener("open", () => {
+			opened = true;
+			compileSocket = socket;
+			compileSocketOpening = null;
+			liveSVG = "";
+			liveHash = "";
+			resolve(socket);
+		});
+		socket.addEventListener("message", onCompileMessage);
+		socket.addEventListener("close", () => {
+			if (compileSocket === socket) compileSocket = null;
+			if (!opened) {
+				// Blocked on the way, e.g. by a proxy: stay with HTTP
+				liveUnavailable = true;
+				compileSocketOpening = null;
+			}
+			resolve(null);
+		});
+	});
+	return compileSocketOpening;
+}
+
 /**
  * Compile metapost code and display result
+ * @param {Object} [options]
+ * @param {boolean} [options.preview] - Live preview compile, which gets a shorter server timeout
  */
-async function doCompile() {
+async function doCompile({ preview = false } = {}) {
 	if (!editor) return;
 
 	const code = editor.getValue();
 	showLog("Compiling...");
 
+	const socket = await openCompileSocket();
+	if (socket?.readyState === WebSocket.OPEN) {
+		liveSeq += 1;
+		socket.send(
+			JSON.stringify({
+				type: "compile",
+				seq: liveSeq,
+				code,
+				mode: preview === true ? "preview" : "compile",
+			}),
+		);
+		return;
+	}
+
+	// Fall back to one HTTP request per compile
 	// Cancel previous request if still pending
 	if (compileAbortController) {
 		compileAbortController.abort();
@@ -284,32 +433,28 @@ async function doCompile() {
 		const response = await fetch("/api/compile", {
 			method: "POST",
 			headers: { "Content-Type": "application/json" },
-			body: JSON.stringify({ code }),
+			body: JSON.stringify({
+				code,
+				session: compileSession,
+				mode: preview === true ? "preview" : "compile",
+				// The preview shows the last figure only, which comes back as `svg`
+				figures: [],
+			}),
 			signal: compileAbortController.signal,
 		});
 
+		// Superseded by a newer compile from this editor
+		if (response.status === 409) return;
+
 		const result = await response.json();
 
 		if (!response.ok || !result.svg) {
-			showLog(`${result.stdout || ""}\n${result.stderr || ""}`.trim());
-			document.getElementById("result").innerHTML = "<p>Error compiling</p>";
+			showCompileError(result);
 			return;
 		}
 
 		showLog(result.stdout || "Compiled successfully");
-		document.getElementById("result").innerHTML = result.svg;
-
-		const originalSVG = document.querySelector("#result svg");
-		if (originalSVG) {
-			// Expand viewBox by 10% with padding
-			const width = parseFloat(originalSVG.getAttribute("width")) || 0;
-			const height = parseFloat(originalSVG.getAttribute("height")) || 0;
-			const newViewBox = `-20 -20 ${width * 1.1} ${height * 1.1}`;
-
-			originalSVG.setAttribute("viewBox", newViewBox);
-			originalSVG.setAttribute("id", "originalSVG");
-			annotate(originalSVG);
-		}
+		showSVG(result.svg);
 	} catch (error) {
 		if (error.name === "AbortError") return;
 		console.error("Compile failed:", error);
@@ -367,7 +512,10 @@ document.addEventListener("DOMContentLoaded", async () => {
 			// Debounced auto-compile
 			editor.on("change", () => {
 				clearTimeout(compileDebouncer);
-				compileDebouncer = setTimeout(doCompile, COMPILE_DELAY);
+				compileDebouncer = setTimeout(
+					() => doCompile({ preview: true }),
+					COMPILE_DELAY,
+				);
 			});
 
 			// Load sample data from meta tags
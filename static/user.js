@@ -0,0 +1,118 @@
+/**
+ * User gallery
+ * Loads the samples of /u/{username} page by page as the visitor scrolls
+ */
+
+const PLACEHOLDER_ICON =
+	"https://upload.wikimedia.org/wikipedia/commons/1/10/Metapost-icon.svg";
+
+/**
+ * Build the card of one sample
+ * @param {Object} sample - Sample from /api/u/{username}/samples
+ * @returns {HTMLAnchorElement}
+ */
+function renderCard(sample) {
+	const card = document.createElement("a");
+	card.className = "mpost-item card";
+	card.href = `/m/${sample.id}`;
+
+	const preview = document.createElement("img");
+	if (sample.thumbnail) {
+		preview.className = "result";
+		preview.src = sample.thumbnail;
+		preview.loading = "lazy";
+		preview.decoding = "async";
+		// Rendered on demand, so a sample that does not compile has none
+		preview.addEventListener(
+			"error",
+			() => {
+				preview.className = "result placeholder";
+				preview.src = PLACEHOLDER_ICON;
+			},
+			{ once: true },
+		);
+	} else {
+		preview.className = "result placeholder";
+		preview.src = PLACEHOLDER_ICON;
+	}
+	preview.alt = "";
+	card.appendChild(preview);
+
+	const title = document.createElement("h2");
+	title.className = "title";
+	title.textContent = sample.title;
+	card.appendChild(title);
+
+	const updated = document.createElement("div");
+	updated.className = "updated";
+	updated.textContent = sample.updated;
+	card.appendChild(updated);
+
+	return card;
+}
+
+/**
+ * Fetch one page of samples
+ * @param {string} username - GitHub user name
+ * @param {string} cursor - Cursor returned with the previous page
+ * @returns {Promise<{samples: Object[], next: ?string}>}
+ */
+async function fetchSamples(username, cursor) {
+	const params = new URLSearchParams({ cursor });
+	const response = await fetch(
+		`/api/u/${encodeURIComponent(username)}/samples?${params}`,
+	);
+	if (!response.ok) {
+		const error = await response.json().catch(() => ({}));
+		throw new Error(error.message || `HTTP ${response.status}`);
+	}
+	return response.json();
+}
+
+document.addEventListener("DOMContentLoaded", () => {
+	const gallery = document.getElementById("gallery");
+	const status = document.getElementById("gallery-status");
+	if (!gallery || !status) return;
+
+	const username = gallery.dataset.username;
+	let cursor = "";
+	let loading = false;
+	let shown = 0;
+
+	const observer = new IntersectionObserver(
+		(entries) => {
+			if (entries.some((entry) => entry.isIntersecting)) loadMore();
+		},
+		{ rootMargin: "400px" },
+	);
+
+	async function loadMore() {
+		if (loading || cursor === null) return;
+		loading = true;
+		status.textContent = "Loading samples…";
+		try {
+			const page = await fetchSamples(username, cursor);
+			for (const sample of page.samples) {
+				gallery.appendChild(renderCard(sample));
+			}
+			shown += page.samples.length;
+			cursor = page.next;
+		} catch (error) {
+			status.textContent = `Could not load samples: ${error.message}`;
+			observer.disconnect();
+			return;
+		} finally {
+			loading = false;
+		}
+
+		if (cursor === null) {
+			observer.disconnect();
+			status.textContent = shown ? "" : "No samples yet.";
+		} else if (status.getBoundingClientRect().top < window.innerHeight + 400) {
+			// The page is still not full, so the observer will not fire again
+			loadMore();
+		}
+	}
+
+	observer.observe(status);
+});
@@ -0,0 +1,87 @@
+import pytest
+
+from app.lint import format_diagnostics, lint, needs_end
+
+
+def messages(mp_code: str):
+    return [diagnostic.message for diagnostic in lint(mp_code).errors]
+
+
+@pytest.mark.parametrize(
+    "mp_code",
+    [
+        'beginfig(1); label("100% sure", origin); endfig; end',
+        'beginfig(1); message "50%"; draw (0,0)--(1,1); endfig; end',
+        "beginfig(1); label(btex $x$ % not a comment etex, origin); endfig; end",
+        'beginfig(1); label(btex "begingroup fi etex, origin); endfig; end',
+        "verbatimtex\n\\def\\x{enddef}\netex\nbeginfig(1); endfig; end",
+        "def twice(expr p) = begingroup save q; q = p; q + q endgroup enddef;\n"
+        "beginfig(1); draw origin shifted twice((1,1)); endfig; end",
+        "def outer = def inner = begingroup 1 endgroup enddef; enddef;\n"
+        "outer; beginfig(1); endfig; end",
+        "vardef f(expr x) = if x > 0: begingroup x endgroup else: 0 fi enddef;\n"
+        "beginfig(1); for i = 1 upto 3: draw (i,f(i)); endfor; endfig; end",
+        # Macro tricks are left to mpost
+        "def open = begingroup enddef; def close = endgroup enddef;\n"
+        "beginfig(1); open; close; endfig; end",
+        "let stop = endfig; beginfig(1); stop; end",
+        "input boxes; beginfig(1); endfig; end",
+        "% endfig fi enddef\nbeginfig(1); endfig; end",
+    ],
+)
+def test_valid_programs_pass(mp_code):
+    assert messages(mp_code) == []
+
+
+@pytest.mark.parametrize(
+    "mp_code, expected",
+    [
+        ('beginfig(1); label("oops,\norigin); endfig; end', "Incomplete string token"),
+        ("beginfig(1); draw (0,0)--(1,1); endfig; enddef; end", "Extra `enddef'"),
+        ("beginfig(1); endfig; endfor; end", "Extra `endfor'"),
+        ("beginfig(1); fi; endfig; end", "Extra `fi'"),
+        ("beginfig(1); else: endfig; end", "Extra `else'"),
+        ("beginfig(1); endfig; endgroup; end", "Extra `endgroup'"),
+        ("def f = 1\nbeginfig(1); endfig; end", "definition of f"),
+        ("for i = 1 upto 3: draw (i,i);\nend", "text of a for loop"),
+        ("beginfig(1); draw (0,0)--(1,1); end", "inside a group at level 1"),
+    ],
+)
+def test_errors(mp_code, expected):
+    errors = messages(mp_code)
+    assert len(errors) == 1
+    assert expected in errors[0]
+
+
+def test_warnings_are_not_errors():
+    # An earlier figure was shipped, and mpost only warns about an open if
+    result = lint("beginfig(1); endfig; beginfig(2); if true: draw origin; end")
+    assert result.errors == []
+    assert len(result.diagnostics) == 2
+
+
+def test_unterminated_tex_is_left_to_mpost():
+    assert messages("beginfig(1); label(btex $x$, origin); enddef; end") == []
+
+
+def test_diagnostic_position():
+    mp_code = "beginfig(1);\ndraw origin; fi; endfig; end"
+    [error] = lint(mp_code).errors
+    assert (error.line, error.column) == (2, 15)
+    assert format_diagnostics(mp_code, [error]) == (
+        "! Extra `fi'.\nl.2 draw origin; fi\n                   ; endfig; end\n"
+    )
+
+
+@pytest.mark.parametrize(
+    "mp_code, expected",
+    [
+        ("beginfig(1); endfig;", True),
+        ("beginfig(1); endfig; end", False),
+        ("beginfig(1); endfig; end;\n% done\n", False),
+        ("dump", False),
+        ('message "end"', True),
+    ],
+)
+def test_needs_end(mp_code, expected):
+    assert needs_end(mp_code) == expected
@@ -0,0 +1,120 @@
+import os
+import re
+import xml.etree.ElementTree as ET
+
+import pytest
+
+from app.svgopt import NUMBER, SVG_NS, optimize
+
+DATA = os.path.join(os.path.dirname(__file__), "data")
+SHAPE = f"{{{SVG_NS}}}path"
+
+
+def read(name: str) -> str:
+    with open(os.path.join(DATA, name)) as file_object:
+        return file_object.read()
+
+
+def style_rules(root: ET.Element) -> dict:
+    rules = {}
+    for sheet in root.iter(f"{{{SVG_NS}}}style"):
+        for name, body in re.findall(r"\.([\w-]+)\{([^}]*)\}", sheet.text):
+            rules[name] = body
+    return rules
+
+
+def declarations(style: str) -> dict:
+    pairs = (item.partition(":") for item in style.split(";") if item.strip())
+    return {name.strip(): value.strip() for name, _, value in pairs}
+
+
+def numbers(text: str) -> list:
+    return [float(number) for number in NUMBER.findall(text)]
+
+
+def shapes(svg: str) -> list:
+    """Each path as its ancestors' clip paths, coordinates and effective style"""
+    root = ET.fromstring(svg)
+    rules = style_rules(root)
+    found = []
+
+    def walk(element: ET.Element, clips: tuple):
+        if element.get("clip-path"):
+            clips += (element.get("clip-path"),)
+        if element.tag == SHAPE:
+            style = element.get("style", "")
+            for name in element.get("class", "").split():
+                style += ";" + rules[name]
+            found.append((clips, numbers(element.get("d")), declarations(style)))
+        for child in element:
+            walk(child, clips)
+
+    walk(root, ())
+    return found
+
+
+def assert_same_drawing(before: str, after: str):
+    old, new = shapes(before), shapes(after)
+    assert len(old) == len(new)
+    for (old_clips, old_d, old_style), (new_clips, new_d, new_style) in zip(old, new):
+        assert old_clips == new_clips
+        assert new_d == pytest.approx(old_d, abs=1e-3)
+        assert new_style.keys() == old_style.keys()
+        for name, value in old_style.items():
+            assert numbers(new_style[name]) == pytest.approx(numbers(value), abs=1e-2)
+            assert re.sub(NUMBER, "", new_style[name]) == re.sub(NUMBER, "", value)
+
+
+def root_size(svg: str) -> tuple:
+    root = ET.fromstring(svg)
+    return root.get("width"), root.get("height"), root.get("viewBox")
+
+
+@pytest.mark.parametrize(
+    "name", ["multi-1.svg", "multi-2.svg", "clip.svg", "dashed.svg"]
+)
+def test_smaller_and_same_drawing(name):
+    svg = read(name)
+    optimized = optimize(svg)
+    assert len(optimized) < len(svg)
+    assert root_size(optimized) == root_size(svg)
+    assert_same_drawing(svg, optimized)
+
+
+def test_figures_of_one_program_do_not_share_classes():
+    # The editor shows every figure of a program in the same page
+    first, second = optimize(read("multi-1.svg")), optimize(read("multi-2.svg"))
+    first_classes = set(style_rules(ET.fromstring(first)))
+    second_classes = set(style_rules(ET.fromstring(second)))
+    assert first_classes and second_classes
+    assert not first_classes & second_classes
+
+
+def test_clip_path_is_kept():
+    optimized = optimize(read("clip.svg"))
+    root = ET.fromstring(optimized)
+    [clip] = root.iter(f"{{{SVG_NS}}}clipPath")
+    assert clip.get("id") == "clip1"
+    assert len(clip) == 1
+    [group] = [g for g in root.iter(f"{{{SVG_NS}}}g") if g.get("clip-path")]
+    assert group.get("clip-path") == "url(#clip1)"
+    assert len(group) == 2
+    # The empty group with an identity transform is gone
+    assert len(list(root.iter(f"{{{SVG_NS}}}g"))) == 1
+
+
+def test_dashes_and_colors_are_kept_apart():
+    styles = [style for _, _, style in shapes(optimize(read("dashed.svg")))]
+    red, red_again, green_dotted, green = styles
+    assert red == red_again
+    assert red["stroke"] == "rgb(100%,0%,0%)"
+    assert red["stroke-dasharray"] == "3 3"
+    assert green_dotted["stroke"] == "rgb(0%,50.19%,0%)"
+    assert green_dotted["stroke-dasharray"] == "0 2.491"
+    assert green_dotted["stroke-linecap"] == "butt"
+    assert "stroke-dasharray" not in green
+
+
+def test_unparsable_input_is_returned_unchanged():
+    svg = read("dashed.svg").replace("</svg>", "")
+    assert optimize(svg) == svg